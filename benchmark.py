@@ -0,0 +1,505 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2021  Nathaniel MacArthur-Warner
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Measure the performance of creator.py without touching the real
+# orthophoto servers: every provider in creator.URLS is redirected to a local
+# stub server, which answers ArcGIS 'export' and WMS 'GetMap' requests with
+# synthetic images of the requested size.
+
+import argparse
+import hashlib
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from PIL import Image
+
+try:
+    import resource
+except ImportError:             # not available on Windows
+    resource = None
+
+import creator
+
+
+CASES = ('download', 'region', 'join', 'cache')
+
+
+def make_noise(size, sigma, seed):
+    """Return an 'L' image of Gaussian noise around 128, like
+    Image.effect_noise(), but reproducible: the same seed always gives the
+    same image"""
+    # Turns uniform random bytes into Gaussian values
+    table = [min(255, max(0, round(128 + sigma * statistics.NormalDist().inv_cdf(
+        (i + 0.5) / 256)))) for i in range(256)]
+    rng = random.Random(seed)
+    return Image.frombytes('L', size, rng.randbytes(size[0] * size[1])) \
+        .point(table)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Answer the requests of creator.py like an orthophoto server would.
+
+    The size of the image is read from the 'size' (ArcGIS) or the
+    'width' and 'height' (WMS) query parameters, and its format from the
+    'format' parameter. Images have an ETag, and requests with a matching
+    If-None-Match header get a 304 Not Modified answer. GET /_stats
+    returns the counters of the server.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/_stats':
+            with self.server.lock:
+                self._send(200, 'application/json',
+                           json.dumps(self.server.stats).encode())
+            return
+        query = {k.lower(): v[0] for k, v in
+                 urllib.parse.parse_qs(url.query).items()}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            with self.server.lock:
+                self.server.stats['errors'] += 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        try:
+            if 'size' in query:
+                width, height = (int(v) for v in query['size'].split(','))
+            else:
+                width, height = int(query['width']), int(query['height'])
+        except (KeyError, ValueError):
+            self._send(400, 'text/plain', b'Missing image size')
+            return
+        fmt = query.get('format', 'png').lower()
+        if 'jpg' in fmt or 'jpeg' in fmt:
+            fmt = 'JPEG'
+        else:
+            fmt = 'PNG'
+        data = self.server.get_image(width, height, fmt)
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()[:16]
+        if self.headers.get('If-None-Match') == etag:
+            with self.server.lock:
+                self.server.stats['requests'] += 1
+                self.server.stats['not_modified'] += 1
+            self._send(304, 'image/' + fmt.lower(), b'', etag)
+            return
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['bytes'] += len(data)
+        self._send(200, 'image/' + fmt.lower(), data, etag)
+
+    def _send(self, code, content_type, data, etag=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        # Send a tenth of a second worth of data at a time
+        chunk = max(1, bandwidth // 10)
+        for start in range(0, len(data), chunk):
+            self.wfile.write(data[start:start + chunk])
+            time.sleep(0.1)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """A local stand-in for the orthophoto servers, see StubHandler"""
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=0, error_rate=0.0):
+        """Construct a StubServer.
+
+        Params:
+            port: port to listen to on localhost. 0 picks a free port
+            latency: delay before answering each request, in seconds
+            bandwidth: bytes per second sent for each request. 0 is unlimited
+            error_rate: fraction of the requests answered with a 503 error
+        """
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'bytes': 0,
+                      'not_modified': 0}
+        self._images = {}
+
+    def get_image(self, width, height, fmt):
+        """Return a synthetic image, encoded in fmt.
+
+        The image only depends on its size, so that every response to the
+        same request has the same size, in every thread and every run.
+        """
+        key = (width, height, fmt)
+        with self.lock:
+            if key not in self._images:
+                # Noise and gradients: compresses about as badly as a real
+                # photo
+                im = Image.merge('RGB', [
+                    make_noise((width, height), 48, repr(key)),
+                    Image.linear_gradient('L').resize((width, height)),
+                    Image.radial_gradient('L').resize((width, height))])
+                bio = io.BytesIO()
+                im.save(bio, format=fmt)
+                self._images[key] = bio.getvalue()
+            return self._images[key]
+
+
+def serve(port, latency, bandwidth, error_rate, ready=None):
+    """Run a StubServer until the process is terminated"""
+    server = StubServer(port, latency, bandwidth, error_rate)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    else:
+        print('Stub server listening on http://127.0.0.1:%d' %
+              server.server_address[1])
+    server.serve_forever()
+
+
+def redirect_urls(port):
+    """Point every provider of creator.URLS to the stub server"""
+    for name, url in creator.URLS.items():
+        parts = urllib.parse.urlsplit(url)
+        creator.URLS[name] = urllib.parse.urlunsplit(
+            ('http', '127.0.0.1:%d' % port, parts.path, parts.query, ''))
+
+
+def get_stats(port):
+    with urllib.request.urlopen('http://127.0.0.1:%d/_stats' % port) as f:
+        return json.load(f)
+
+
+def get_folder_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size
+
+
+def get_usage():
+    """Return (cpu seconds, peak RSS in MB) of this process and its children"""
+    times = os.times()
+    cpu = times.user + times.system + times.children_user + times.children_system
+    if resource is None:
+        return cpu, None
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return cpu, rss * scale / 1000000
+
+
+def get_region_args(options, workdir, *extra):
+    """Return the creator.py options of a region download"""
+    return creator.parse_args([
+        '--bbox', options['bbox'], '--provider', options['provider'],
+        '--cols', str(options['cols']), '--theight', str(options['theight']),
+        '--tile_format', options['tile_format'],
+        '--png_compression', str(options['png_compression']),
+        '--scenery_folder', os.path.join(workdir, 'scenery'),
+        '--cache_dir', os.path.join(workdir, 'cache'), '--overwrite'] +
+        (['--jobs', str(options['jobs'])] if options['jobs'] else []) +
+        list(extra))
+
+
+def bench_download(options, workdir):
+    """Download buckets one at a time with ImageProvider.download()"""
+    args = get_region_args(options, workdir)
+    provider = creator.get_provider(args)
+    buckets = creator.buckets_in_bbox(*args['bbox'][0])[:options['count']]
+    for bucket in buckets:
+        outpath = creator.get_output_path(args['scenery_folder'], bucket)
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        provider.download(bucket, outpath, args['cache_dir'],
+                          **creator.get_download_options(args))
+    provider.close()
+    return {'buckets': len(buckets)}
+
+
+def bench_region(options, workdir):
+    """Download a whole region with the pipeline of download_region()"""
+    args = get_region_args(options, workdir)
+    provider = creator.get_provider(args)
+    buckets = creator.buckets_in_bbox(*args['bbox'][0])
+    failed = creator.download_region(provider, buckets, args)
+    provider.close()
+    return {'buckets': len(buckets) - len(failed), 'failed': len(failed)}
+
+
+def bench_cache(options, workdir):
+    """Assemble a region again, with all its tiles in the tile cache.
+
+    The region is downloaded once beforehand; only the second run is
+    measured, including its traffic.
+    """
+    args = get_region_args(options, workdir, '--cache_size', '100000')
+    provider = creator.get_provider(args)
+    buckets = creator.buckets_in_bbox(*args['bbox'][0])
+    creator.download_region(provider, buckets, args)
+    shutil.rmtree(args['scenery_folder'])
+    before = get_stats(options['port'])
+    start = time.perf_counter()
+    cpu_start = get_usage()[0]
+    failed = creator.download_region(provider, buckets, args)
+    provider.close()
+    after = get_stats(options['port'])
+    return {'buckets': len(buckets) - len(failed), 'failed': len(failed),
+            'wall_s': time.perf_counter() - start,
+            'cpu_s': get_usage()[0] - cpu_start,
+            'requests': after['requests'] - before['requests'],
+            'errors': after['errors'] - before['errors'],
+            'bytes_downloaded': after['bytes'] - before['bytes']}
+
+
+def bench_join(options, workdir):
+    """Join local tiles into orthophotos, for several tile layouts"""
+    results = []
+    for cols in options['join_cols']:
+        for theight in options['join_theights']:
+            twidth = theight * 2
+            tiles = []
+            for i in range(cols * cols):
+                path = os.path.join(workdir, 'tile_%d.png' % i)
+                Image.merge('RGB', [
+                    make_noise((twidth, theight), 48 + i, 2 * i),
+                    Image.linear_gradient('L').resize((twidth, theight)),
+                    make_noise((twidth, theight), 16, 2 * i + 1)]).save(path)
+                tiles.append(path)
+            for low_memory in (False, True):
+                outpath = os.path.join(workdir, 'join.png')
+                start = time.perf_counter()
+                cpu_start = get_usage()[0]
+                for i in range(options['count']):
+                    creator.commit_orthophoto(creator.assemble_orthophoto(
+                        tiles, outpath, tnum=(cols, cols),
+                        low_memory=low_memory))
+                wall = time.perf_counter() - start
+                results.append({
+                    'name': 'join', 'cols': cols, 'theight': theight,
+                    'low_memory': low_memory, 'buckets': options['count'],
+                    'wall_s': wall, 'cpu_s': get_usage()[0] - cpu_start,
+                    'buckets_per_s': options['count'] / wall,
+                    'bytes_written': os.path.getsize(outpath)})
+            for path in tiles:
+                os.remove(path)
+    return results
+
+
+def run_case(name, options, results):
+    """Run a benchmark in this process, and put its results on the queue"""
+    logging.basicConfig(level=(logging.DEBUG if options['verbose']
+                               else logging.WARNING))
+    redirect_urls(options['port'])
+    workdir = tempfile.mkdtemp(prefix='photoscenery-benchmark-')
+    try:
+        before = get_stats(options['port'])
+        start = time.perf_counter()
+        cpu_start = get_usage()[0]
+        result = globals()['bench_' + name](options, workdir)
+        wall = time.perf_counter() - start
+        cpu, rss = get_usage()
+        after = get_stats(options['port'])
+        if isinstance(result, dict):
+            result = dict({
+                'name': name, 'wall_s': wall, 'cpu_s': cpu - cpu_start,
+                'requests': after['requests'] - before['requests'],
+                'errors': after['errors'] - before['errors'],
+                'bytes_downloaded': after['bytes'] - before['bytes'],
+                'bytes_written': get_folder_size(
+                    os.path.join(workdir, 'scenery')),
+            }, **result)
+            result['buckets_per_s'] = result['buckets'] / result['wall_s']
+            result = [result]
+        for r in result:
+            r['peak_rss_mb'] = rss
+        results.put(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_benchmarks(options):
+    """Run the benchmarks, each one in its own process, so that its peak
+    memory use and CPU time are measured on their own.
+
+    Returns:
+        The list of results, one dict per benchmark.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results_queue = ctx.Queue()
+    server = ctx.Process(target=serve, daemon=True, args=(
+        0, options['latency'], options['bandwidth'], options['error_rate'],
+        results_queue))
+    server.start()
+    options = dict(options, port=results_queue.get())
+    results = []
+    try:
+        for name in options['cases']:
+            logging.info('Running benchmark %s', name)
+            process = ctx.Process(target=run_case,
+                                  args=(name, options, results_queue))
+            process.start()
+            # Read the results before join(), so that the queue can be flushed
+            while True:
+                try:
+                    results.extend(results_queue.get(timeout=1))
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        logging.error('Benchmark %s failed', name)
+                        break
+            process.join()
+    finally:
+        server.terminate()
+    return results
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, compared to a baseline if there is one"""
+    print('%-36s %9s %9s %9s %10s %10s %9s' % (
+        'benchmark', 'buckets/s', 'wall s', 'cpu s', 'MB down', 'MB out',
+        'peak MB'))
+    for r in results:
+        label = get_label(r)
+        line = '%-36s %9.2f %9.2f %9.2f %10.1f %10.1f %9s' % (
+            label, r['buckets_per_s'], r['wall_s'], r['cpu_s'],
+            r.get('bytes_downloaded', 0) / 1000000,
+            r['bytes_written'] / 1000000,
+            '%.0f' % r['peak_rss_mb'] if r['peak_rss_mb'] else '-')
+        if baseline and label in baseline:
+            line += '  %+.0f%%' % (100 * (r['buckets_per_s'] /
+                                          baseline[label]['buckets_per_s'] - 1))
+        print(line)
+
+
+def get_label(result):
+    if result['name'] != 'join':
+        return result['name']
+    return 'join cols=%d theight=%d%s' % (
+        result['cols'], result['theight'],
+        ' low_memory' if result['low_memory'] else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""\
+Benchmark creator.py against a local stub server. Nothing is downloaded from
+the real orthophoto providers.""")
+    parser.add_argument('--cases', default=','.join(CASES),
+                        help='Comma-separated list of benchmarks among %s. Defaults to all of them' % ', '.join(CASES))
+    parser.add_argument('--provider', default='ArcGIS', choices=list(creator.URLS.keys()),
+                        help='Provider whose URL format is used. ArcGIS and USGS use the ArcGIS export API, the others WMS GetMap')
+    parser.add_argument('--bbox', default='47.0,11.0,47.25,11.5', metavar='LATLL,LONLL,LATUR,LONUR',
+                        help='Region of the region and cache benchmarks. Defaults to %(default)s')
+    parser.add_argument('--count', type=int, default=4,
+                        help='Number of buckets of the download and join benchmarks. Defaults to %(default)s')
+    parser.add_argument('--cols', type=int, default=2, help='Defaults to %(default)s')
+    parser.add_argument('--theight', type=int, default=256, help='Defaults to %(default)s')
+    parser.add_argument('--tile_format', '--tile-format', default='png', choices=('jpeg', 'png'),
+                        help='Format of the tiles requested to the stub server. Defaults to %(default)s')
+    parser.add_argument('--png_compression', '--png-compression', type=int, default=6, choices=range(10),
+                        help='zlib compression level of the PNG orthophotos. Defaults to %(default)s')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Worker processes of the region benchmarks. Defaults to the number of CPUs')
+    parser.add_argument('--join_cols', '--join-cols', default='1,2,4',
+                        help='Values of cols of the join benchmark. Defaults to %(default)s')
+    parser.add_argument('--join_theights', '--join-theights', default='256,512',
+                        help='Values of theight of the join benchmark. Defaults to %(default)s')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Latency of the stub server, in seconds. Defaults to %(default)s')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='Bandwidth of the stub server per request, in kilobytes per second. Defaults to unlimited')
+    parser.add_argument('--error_rate', '--error-rate', type=float, default=0.0,
+                        help='Fraction of the requests the stub server answers with a 503 error. Defaults to %(default)s')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='Save the results to this JSON file. Defaults to %(default)s')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='Compare the results to those saved in a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='With --compare, exit with an error if a benchmark is this fraction slower than before. Defaults to %(default)s')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Only run the stub server on PORT, e.g. to test creator.py by hand')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=(logging.DEBUG if args['verbose'] else logging.INFO))
+
+    if args['serve'] is not None:
+        serve(args['serve'], args['latency'], args['bandwidth'] * 1000,
+              args['error_rate'])
+        sys.exit(0)
+
+    cases = args['cases'].split(',')
+    for name in cases:
+        if name not in CASES:
+            parser.error('unknown benchmark %s' % name)
+    options = dict(args, cases=cases, bandwidth=args['bandwidth'] * 1000,
+                   join_cols=[int(v) for v in args['join_cols'].split(',')],
+                   join_theights=[int(v) for v in args['join_theights'].split(',')])
+
+    baseline = None
+    if args['compare']:
+        with open(args['compare']) as f:
+            baseline = {get_label(r): r for r in json.load(f)['results']}
+
+    results = run_benchmarks(options)
+    print_results(results, baseline)
+    with open(args['output'], 'w') as f:
+        json.dump({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'options': {k: v for k, v in options.items() if k != 'verbose'},
+            'results': results,
+        }, f, indent=2)
+    logging.info('Results saved to %s', args['output'])
+
+    if baseline:
+        slower = [get_label(r) for r in results if get_label(r) in baseline and
+                  r['buckets_per_s'] < (1 - args['tolerance']) *
+                  baseline[get_label(r)]['buckets_per_s']]
+        if slower:
+            logging.error('Slower than %s: %s', args['compare'], ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -60,39 +60,14 @@ print "WARNING: This may really strain remote ressources and cost the provider\n
 print "         real \$\$\$, so use with care and if in doubt, ask before using!\n\n";
 sleep(5);
 
-# Sample the tiles and download the indexes that weren't downloaded in this run
-my %seenIDX = ();
-for (my $lat=$latLL; $lat <= $latUR; $lat=$lat+0.05) {
-    for (my $lon=$lonLL; $lon <= $lonUR; $lon=$lon+0.05) {
-        $lat = sprintf("%.4f", $lat);
-        $lon = sprintf("%.4f", $lon);
-	my $cmd = "python3 creator.py --lat \"$lat\" --lon \"$lon\" --info_only";
-	print "cmd=$cmd\n";
-        my $output = `$cmd`;
-        if ($output !~ /Index: (\d+)/) {
-            print "ERROR: could not get tile index from command result.\n";
-            print "       result was: $output\n";
-            exit 9;
-        }
-        my $tileIDX = $1;
-        if ( !exists($seenIDX{$tileIDX}) ) {
-            # needs download
-            print "Tile $tileIDX needs download\n";
-            $seenIDX{$tileIDX} = 1;
-            
-  	    my $cmd = "python3 creator.py --index $tileIDX @ARGV";
-            print "cmd=$cmd\n";
-            $output = `python3 creator.py --index $tileIDX @ARGV`;
-            print $output;
-	    print "\n";
-            
-        } else {
-            # already fetched
-            #print "$lat, $lon: $tileIDX\n";
-        }
-        
-    }
+# Let creator.py enumerate the buckets of the box and download them all in
+# a single process.
+my $cmd = "python3 creator.py --bbox=\"$latLL,$lonLL,$latUR,$lonUR\" @ARGV";
+print "cmd=$cmd\n";
+my $status = system($cmd);
+if ($status != 0) {
+    print "ERROR: creator.py failed (exit status " . ($status >> 8) . ")\n";
+    exit 9;
 }
 
-
 print "all done.\n"
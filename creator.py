@@ -21,32 +21,185 @@
 
 import math
 import argparse
+import bisect
+import collections
+import contextlib
+import email.utils
+import hashlib
+import heapq
+import http.server
+import io
+import json
+import multiprocessing
 import requests
 import logging
 import os
 import platform
+import queue
+import random
 import re
+import socket
+import sqlite3
+import struct
 import sys
 import tempfile
-from PIL import Image, UnidentifiedImageError
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageStat, UnidentifiedImageError
+
+try:
+    import numpy
+except ImportError:             # numpy is optional, see the README
+    numpy = None
 
 
 # Ortophoto servers
 # The url is a format string. 'tbounds(minlon,minlat,maxlon,maxlat)' is used for tile bounds and 'tsize(width,height)' for tile size, in pixels.
+# 'tformat' is the image format, as the server names it (see 'formats' in PROVIDER_OPTIONS).
 URLS = {
     # ArcGIS. suitable for the entire world. under restrictive license, see https://www.esri.com/en-us/legal/terms/full-master-agreement
-    'ArcGIS': 'http://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export?bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&bboxSR=4326&size={tsize[0]},{tsize[1]}&imageSR=4326&format=png24&f=image',
+    'ArcGIS': 'http://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/export?bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&bboxSR=4326&size={tsize[0]},{tsize[1]}&imageSR=4326&format={tformat}&f=image',
     # PNOA. only Spain. license CC-BY
     # https://pnoa.ign.es/presentacion-y-objetivo
-    'PNOA': 'https://www.ign.es/wms-inspire/pnoa-ma?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=OI.OrthoimageCoverage&SRS=EPSG:4326&BBOX={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&WIDTH={tsize[0]}&HEIGHT={tsize[1]}&FORMAT=image/png',
+    'PNOA': 'https://www.ign.es/wms-inspire/pnoa-ma?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetMap&LAYERS=OI.OrthoimageCoverage&SRS=EPSG:4326&BBOX={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&WIDTH={tsize[0]}&HEIGHT={tsize[1]}&FORMAT={tformat}',
     # USGS. United States only. Public domain license, see:
     # https://www.usgs.gov/faqs/what-are-terms-uselicensing-map-services-and-data-national-map?qt-news_science_products=0#qt-news_science_products
-    'USGS': 'https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/export?bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&bboxSR=4326&size={tsize[0]},{tsize[1]}&imageSR=4326&format=png24&f=image',
+    'USGS': 'https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/export?bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&bboxSR=4326&size={tsize[0]},{tsize[1]}&imageSR=4326&format={tformat}&f=image',
     #geoportal.gov.pl only Poland (licence unknown, apart general statment as free to download not sure if via this view service)[!!! theight must be set as not larger than 1024 !!!]
-    'GeoportalPL': 'https://mapy.geoportal.gov.pl/wss/service/PZGIK/ORTO/WMS/HighResolution?REQUEST=GetMap&VERSION=1.3.0&TRANSPARENT=TRUE&LAYERS=RASTER&STYLES=&CRS=CRS:84&EXCEPTIONS=xml&BBOX={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&WIDTH={tsize[0]}&HEIGHT={tsize[1]}&FORMAT=image/png',
+    'GeoportalPL': 'https://mapy.geoportal.gov.pl/wss/service/PZGIK/ORTO/WMS/HighResolution?REQUEST=GetMap&VERSION=1.3.0&TRANSPARENT=TRUE&LAYERS=RASTER&STYLES=&CRS=CRS:84&EXCEPTIONS=xml&BBOX={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&WIDTH={tsize[0]}&HEIGHT={tsize[1]}&FORMAT={tformat}',
     # geoservice bayern (DE/Bavaria); License CC-BY  https://geodatenonline.bayern.de/geodatenonline/seiten/wms_dop80cm
     # Max image size is 4000x4000, so you need to supply --theight 1024 or something like that
-    'geoservices.bayern.de': 'https://geoservices.bayern.de/wms/v2/ogc_dop80_oa.cgi?version=1.1.1&service=WMS&request=GetMap&layers=by_dop80c&bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&width={tsize[0]}&height={tsize[1]}&srs=EPSG:4326&exceptions=xml&format=image/png',
+    'geoservices.bayern.de': 'https://geoservices.bayern.de/wms/v2/ogc_dop80_oa.cgi?version=1.1.1&service=WMS&request=GetMap&layers=by_dop80c&bbox={tbounds[0]},{tbounds[1]},{tbounds[2]},{tbounds[3]}&width={tsize[0]}&height={tsize[1]}&srs=EPSG:4326&exceptions=xml&format={tformat}',
+}
+
+# Per-provider settings, passed as keyword arguments to ImageProvider.
+# 'max_connections' is the maximum number of tiles downloaded in parallel from
+# the provider. 'rate' is the initial number of requests per second; it is
+# lowered when the server answers 429/503 and raised again, up to 'max_rate',
+# while requests succeed. Be gentle with the smaller servers.
+# 'max_size' is the largest width or height of an image the server returns,
+# in pixels (see --mosaic). 'formats' maps the tile formats the server can
+# send (see TILE_FORMATS) to their name in the url.
+PROVIDER_OPTIONS = {
+    'ArcGIS': {'max_connections': 8, 'rate': 8.0, 'max_rate': 32.0,
+               'max_size': 4096, 'formats': {'png': 'png24', 'jpeg': 'jpg'}},
+    'PNOA': {'max_connections': 4, 'rate': 4.0, 'max_rate': 8.0,
+             'max_size': 4096,
+             'formats': {'png': 'image/png', 'jpeg': 'image/jpeg'}},
+    'USGS': {'max_connections': 4, 'rate': 4.0, 'max_rate': 16.0,
+             'max_size': 4096, 'formats': {'png': 'png24', 'jpeg': 'jpg'}},
+    'GeoportalPL': {'max_connections': 2, 'rate': 2.0, 'max_rate': 4.0,
+                    'max_size': 1024,
+                    'formats': {'png': 'image/png', 'jpeg': 'image/jpeg'}},
+    'geoservices.bayern.de': {'max_connections': 2, 'rate': 2.0,
+                              'max_rate': 4.0, 'max_size': 4000,
+                              'formats': {'png': 'image/png',
+                                          'jpeg': 'image/jpeg'}},
+}
+
+# Areas the regional providers have imagery for: coarse polygons of
+# (lon, lat) vertices, drawn inside the land borders and a little offshore,
+# so that a bucket inside a polygon is entirely covered. Providers missing
+# here cover the whole world. See Coverage.
+COVERAGE = {
+    'PNOA': [
+        # mainland Spain, without Portugal, Andorra and Gibraltar
+        [(-9.4, 43.3), (-8.0, 43.9), (-5.5, 43.75), (-3.5, 43.6),
+         (-1.8, 43.4), (-1.4, 43.05), (-0.7, 42.85), (0.7, 42.75),
+         (1.3, 42.35), (1.9, 42.35), (3.1, 42.4), (3.4, 42.4), (3.5, 41.8),
+         (2.4, 41.2), (1.1, 40.6), (0.0, 39.4), (0.4, 38.75), (-0.5, 37.5),
+         (-2.0, 36.6), (-4.4, 36.6), (-5.3, 36.25), (-5.7, 35.95),
+         (-6.4, 36.4), (-7.0, 37.05), (-7.4, 37.1), (-7.3, 37.5),
+         (-6.95, 38.2), (-7.0, 38.9), (-7.1, 39.6), (-6.85, 40.2),
+         (-6.8, 41.0), (-6.2, 41.55), (-6.6, 41.9), (-8.2, 42.15),
+         (-8.9, 41.95), (-9.4, 42.3)],
+        # Balearic Islands
+        [(1.1, 38.6), (4.5, 38.6), (4.5, 40.2), (1.1, 40.2)],
+        # Canary Islands
+        [(-18.3, 27.5), (-13.2, 27.5), (-13.2, 29.5), (-18.3, 29.5)],
+    ],
+    'USGS': [
+        # contiguous United States, without Canada and Mexico
+        [(-124.9, 48.35), (-123.3, 48.15), (-123.0, 48.8), (-122.8, 48.95),
+         (-95.2, 48.95), (-92.0, 48.2), (-89.5, 47.0), (-84.5, 46.4),
+         (-83.5, 45.8), (-82.5, 43.0), (-83.1, 42.2), (-83.2, 41.8),
+         (-79.1, 42.6), (-79.0, 43.25), (-76.4, 43.5), (-76.0, 44.2),
+         (-74.9, 44.95), (-71.5, 44.95), (-71.1, 45.3), (-70.3, 46.0),
+         (-69.2, 47.35), (-68.2, 47.25), (-67.85, 47.0), (-67.85, 45.7),
+         (-67.0, 44.7), (-70.0, 43.4), (-69.7, 41.4), (-71.7, 41.0),
+         (-73.8, 40.0), (-74.8, 38.6), (-75.3, 35.2), (-78.0, 33.6),
+         (-80.4, 31.9), (-81.0, 30.5), (-79.8, 27.0), (-79.9, 25.3),
+         (-81.9, 24.4), (-82.9, 27.0), (-84.5, 29.5), (-89.2, 28.9),
+         (-94.0, 29.3), (-97.0, 27.5), (-97.0, 25.9), (-97.5, 26.2),
+         (-99.2, 26.8), (-99.6, 27.6), (-100.3, 28.4), (-101.4, 29.9),
+         (-104.0, 30.7), (-104.7, 30.7), (-106.4, 31.9), (-108.15, 31.85),
+         (-108.15, 31.4), (-111.1, 31.4), (-114.75, 32.55), (-117.0, 32.6),
+         (-117.4, 32.6), (-118.8, 33.7), (-120.8, 34.3), (-121.1, 35.5),
+         (-122.7, 37.4), (-124.0, 40.0), (-124.7, 42.8), (-124.3, 46.0)],
+        # Hawaii
+        [(-160.5, 18.8), (-154.6, 18.8), (-154.6, 22.3), (-160.5, 22.3)],
+        # Puerto Rico
+        [(-67.35, 17.85), (-65.2, 17.85), (-65.2, 18.6), (-67.35, 18.6)],
+    ],
+    'GeoportalPL': [
+        [(14.3, 53.9), (16.0, 54.35), (18.5, 54.9), (19.5, 54.4),
+         (22.7, 54.3), (23.4, 54.0), (23.8, 53.2), (23.5, 52.6),
+         (23.1, 52.3), (23.5, 51.6), (24.0, 50.9), (23.8, 50.4),
+         (22.6, 49.6), (22.5, 49.15), (21.9, 49.4), (20.9, 49.4),
+         (19.9, 49.3), (19.2, 49.55), (18.8, 49.7), (18.0, 50.05),
+         (17.0, 50.35), (16.3, 50.7), (15.3, 51.0), (14.9, 50.95),
+         (15.0, 51.3), (14.7, 52.1), (14.6, 52.6), (14.2, 53.3)],
+    ],
+    'geoservices.bayern.de': [
+        [(9.4, 49.8), (9.5, 50.15), (10.1, 50.35), (10.7, 50.3),
+         (11.5, 50.35), (12.1, 50.2), (12.5, 49.7), (12.9, 49.3),
+         (13.5, 48.95), (13.7, 48.75), (13.4, 48.55), (13.0, 48.3),
+         (12.8, 47.8), (12.95, 47.55), (12.2, 47.7), (11.0, 47.5),
+         (10.4, 47.5), (9.8, 47.6), (10.1, 48.0), (10.2, 48.6),
+         (10.35, 49.0), (10.0, 49.5)],
+    ],
+}
+
+# Providers tried in turn by --provider auto, best first: the first one
+# that covers a bucket entirely is used for it. The last one should cover
+# the whole world, see COVERAGE
+AUTO_PROVIDERS = ('geoservices.bayern.de', 'PNOA', 'GeoportalPL', 'USGS',
+                  'ArcGIS')
+
+# Formats of the downloaded tiles: MIME type and extension of the files in
+# the cache. JPEG is several times smaller than PNG for photos, but lossy.
+TILE_FORMATS = {
+    'png': ('image/png', 'png'),
+    'jpeg': ('image/jpeg', 'jpg'),
+}
+
+UNIFORM_POLICIES = ('full', 'tiny', 'skip')
+# Default maximum standard deviation of the bands of a uniform tile, and
+# maximum difference between the mean colours of the tiles of a bucket
+UNIFORM_THRESHOLD = 3.0
+# Size of the downsampled view of a tile whose statistics are computed
+UNIFORM_VIEW = 64
+# Size of the orthophotos written for uniform buckets with --uniform tiny
+UNIFORM_SIZE = 64
+# Marker of the buckets whose tiles are all fully transparent, in place of
+# their colour. They never get an orthophoto
+NO_DATA = 'no data'
+
+# HTTP status codes after which a tile request is worth retrying
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# Size of the chunks used to write downloaded tiles to disk, in bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Output formats (--format) -> formats written by ImageProvider.download()
+OUTPUT_FORMATS = {
+    'png': ('png',),
+    'dds': ('dds',),
+    'both': ('png', 'dds'),
 }
 
 # Tile height, in degrees. This is a constant for FG
@@ -89,9 +242,14 @@ def clear_cache(cache_dir, provider):
             if entry.is_dir() and provider in ("ALL", entry.name):
                 clear_cache_subdir(entry)
 
+    if os.path.exists(os.path.join(cache_dir, TileCache.INDEX_NAME)):
+        cache = TileCache(cache_dir)
+        cache.forget(provider)
+        cache.close()
+
 
 # Regexp matching the basenames of files that creator.py puts in cache
-cached_file_cre = re.compile(r"^(tmp)?tile-.+\.png") # random suffix allowed
+cached_file_cre = re.compile(r"^(tmp)?tile-.+\.(png|jpg)") # random suffix allowed
 
 def clear_cache_subdir(direntry):
     """Clear a subdirectory of the tile cache directory.
@@ -121,38 +279,562 @@ def clear_cache_subdir(direntry):
         os.rmdir(direntry)
 
 
+class TileCache:
+    """Index of the tiles kept in the cache directory across runs.
+
+    By default, cached tiles are deleted as soon as the bucket they were
+    downloaded for is assembled. With a TileCache, they are kept, so that
+    the same area can be assembled again (in another format, after a
+    crash...) without downloading anything. When the cached tiles take
+    more than max_bytes, the least recently used ones are deleted.
+
+    A non-persistent TileCache is opened when the cache directory has an
+    index but no cache is wanted for this run: the tiles are deleted once
+    assembled, as without a TileCache, and removed from the index, so
+    that the index never lists tiles that are no longer on disk.
+
+    The index is an SQLite database in the base cache directory, keyed by
+    provider and tile file name (which encodes tsize and tbounds). The
+    names of the cached tiles of a provider are loaded with a single
+    query, and checked against the directory of the provider with a single
+    os.scandir(), so that looking up a tile needs no other file system
+    access.
+
+    Methods are thread safe.
+    """
+
+    INDEX_NAME = 'index.sqlite'
+
+    def __init__(self, cache_dir, max_bytes=None, persistent=True):
+        """Open (or create) the index of a cache directory.
+
+        Params:
+            cache_dir: base cache directory
+            max_bytes: maximum size of the cached tiles, in bytes. None
+                       means no limit
+            persistent: whether tiles are kept after they are assembled
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.INDEX_NAME),
+                                   check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS tiles ('
+                         'provider TEXT, name TEXT, size INTEGER, '
+                         'last_used REAL, PRIMARY KEY (provider, name)) '
+                         'WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS tiles_last_used '
+                         'ON tiles (last_used)')
+        self._db.commit()
+        self._names = {}        # provider -> set of cached tile names
+        self._pinned = {}       # (provider, name) -> number of users
+
+    def _provider_names(self, provider):
+        names = self._names.get(provider)
+        if names is None:
+            names = {row[0] for row in self._db.execute(
+                'SELECT name FROM tiles WHERE provider = ?', (provider,))}
+            names = self._names[provider] = self._check_disk(provider, names)
+        return names
+
+    def _check_disk(self, provider, names):
+        """Make the index of a provider match the tiles in its directory:
+        forget the tiles that were deleted, and add those that were
+        downloaded without the index (e.g. by a crashed run)
+
+        Returns:
+            The names of the tiles on disk.
+        """
+        on_disk = {}
+        try:
+            with os.scandir(os.path.join(self.cache_dir, provider)) as it:
+                for entry in it:
+                    if entry.is_file() and cached_file_cre.match(entry.name) \
+                            and not entry.name.startswith('tmp'):
+                        on_disk[entry.name] = entry
+        except FileNotFoundError:
+            pass
+        missing = names - on_disk.keys()
+        if missing:
+            logging.info('%d tiles of %s are in the cache index but not on '
+                         'disk, forgetting them', len(missing), provider)
+            self._db.executemany(
+                'DELETE FROM tiles WHERE provider = ? AND name = ?',
+                [(provider, name) for name in missing])
+        now = time.time()
+        self._db.executemany(
+            'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+            [(provider, name, on_disk[name].stat().st_size, now)
+             for name in on_disk.keys() - names])
+        self._db.commit()
+        return set(on_disk)
+
+    def _pin(self, key):
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def lookup(self, provider, name):
+        """Whether a tile is in cache. If it is, it is marked as used, and
+        protected from eviction until release()"""
+        with self._lock:
+            if name not in self._provider_names(provider):
+                return False
+            self._db.execute('UPDATE tiles SET last_used = ? '
+                             'WHERE provider = ? AND name = ?',
+                             (time.time(), provider, name))
+            self._pin((provider, name))
+            return True
+
+    def add(self, provider, name, size):
+        """Record a tile that was just stored in cache. It is protected from
+        eviction until release()"""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                             (provider, name, size, time.time()))
+            self._provider_names(provider).add(name)
+            self._pin((provider, name))
+
+    def release(self, provider, names):
+        """Allow the eviction of tiles returned by lookup() or add(), then
+        evict tiles if the cache is over budget"""
+        with self._lock:
+            for name in names:
+                key = (provider, name)
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+            self._db.commit()
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used tiles until the cache fits in
+        max_bytes"""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            total = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM tiles').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for provider, name, size in self._db.execute(
+                    'SELECT provider, name, size FROM tiles '
+                    'ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
+                if (provider, name) in self._pinned:
+                    continue
+                path = os.path.join(self.cache_dir, provider, name)
+                logging.debug("Evicting cached tile '%s'", path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self._provider_names(provider).discard(name)
+                evicted.append((provider, name))
+                total -= size
+            self._db.executemany(
+                'DELETE FROM tiles WHERE provider = ? AND name = ?', evicted)
+            self._db.commit()
+        logging.debug('Evicted %d tiles from the cache', len(evicted))
+
+    def forget(self, provider, names=None):
+        """Remove a provider (or 'ALL' providers) from the index, or only
+        the given tile names of a provider"""
+        with self._lock:
+            if names is not None:
+                names = list(names)
+                self._db.executemany(
+                    'DELETE FROM tiles WHERE provider = ? AND name = ?',
+                    [(provider, name) for name in names])
+                provider_names = self._provider_names(provider)
+                for name in names:
+                    provider_names.discard(name)
+                    self._pinned.pop((provider, name), None)
+            elif provider == 'ALL':
+                self._db.execute('DELETE FROM tiles')
+                self._names.clear()
+            else:
+                self._db.execute('DELETE FROM tiles WHERE provider = ?',
+                                 (provider,))
+                self._names.pop(provider, None)
+            self._db.commit()
+
+    def stats(self):
+        """Return a {provider: (number of tiles, bytes)} dict"""
+        with self._lock:
+            return {provider: (count, size) for provider, count, size in
+                    self._db.execute('SELECT provider, COUNT(*), SUM(size) '
+                                     'FROM tiles GROUP BY provider')}
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+def print_cache_stats(cache_dir):
+    """Print the number and size of the tiles in a persistent cache"""
+    if not os.path.exists(os.path.join(cache_dir, TileCache.INDEX_NAME)):
+        print('No persistent tile cache in %s' % cache_dir)
+        return
+    cache = TileCache(cache_dir)
+    stats = cache.stats()
+    cache.close()
+    for provider, (count, size) in sorted(stats.items()):
+        print('%s: %d tiles, %.1f MB' % (provider, count, size / 1e6))
+    print('Total: %d tiles, %.1f MB' % (
+        sum(count for count, size in stats.values()),
+        sum(size for count, size in stats.values()) / 1e6))
+
+
+class Metrics:
+    """Timings and counters of the stages of a run.
+
+    Each stage (e.g. 'http_ttfb', 'decode', 'encode') has a histogram of
+    its durations, in seconds; counters hold totals such as bytes
+    downloaded or cache hits. Worker processes record into their own
+    Metrics; their snapshot() is merge()d back into the parent's.
+    """
+    # Upper bounds of the histogram buckets, in seconds
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+              1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # stage -> [count, sum, min, max, bucket counts]
+            self.stages = {}
+            self.counters = {}
+
+    def observe(self, stage, seconds):
+        """Record that a stage took 'seconds'"""
+        i = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            s = self.stages.get(stage)
+            if s is None:
+                s = self.stages[stage] = [0, 0.0, seconds, seconds,
+                                          [0] * (len(self.BOUNDS) + 1)]
+            s[0] += 1
+            s[1] += seconds
+            s[2] = min(s[2], seconds)
+            s[3] = max(s[3], seconds)
+            s[4][i] += 1
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        """Context manager recording the time spent in its block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def total(self, stage):
+        """Return the time spent in a stage so far, in seconds"""
+        with self._lock:
+            s = self.stages.get(stage)
+            return s[1] if s else 0.0
+
+    def snapshot(self):
+        """Return the metrics as plain data, e.g. to send them to another
+        process"""
+        with self._lock:
+            return ({k: [s[0], s[1], s[2], s[3], list(s[4])]
+                     for k, s in self.stages.items()}, dict(self.counters))
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot() to these"""
+        stages, counters = snapshot
+        with self._lock:
+            for k, o in stages.items():
+                s = self.stages.get(k)
+                if s is None:
+                    self.stages[k] = [o[0], o[1], o[2], o[3], list(o[4])]
+                    continue
+                s[0] += o[0]
+                s[1] += o[1]
+                s[2] = min(s[2], o[2])
+                s[3] = max(s[3], o[3])
+                s[4] = [a + b for a, b in zip(s[4], o[4])]
+            for k, v in counters.items():
+                self.counters[k] = self.counters.get(k, 0) + v
+
+    def _quantile(self, s, q):
+        """Estimate a quantile from the histogram of a stage"""
+        rank = q * s[0]
+        seen = 0
+        for bound, n in zip(self.BOUNDS + (s[3],), s[4]):
+            seen += n
+            if seen >= rank:
+                return min(max(bound, s[2]), s[3])
+        return s[3]
+
+    def summary(self):
+        """Return a dict summarizing the stages and the counters"""
+        stages, counters = self.snapshot()
+        return {
+            'stages': {k: {'count': s[0], 'total_s': s[1],
+                           'mean_s': s[1] / s[0], 'min_s': s[2],
+                           'max_s': s[3], 'p50_s': self._quantile(s, 0.5),
+                           'p90_s': self._quantile(s, 0.9),
+                           'p99_s': self._quantile(s, 0.99)}
+                       for k, s in sorted(stages.items())},
+            'counters': dict(sorted(counters.items())),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text format, e.g. for the
+        textfile collector of node_exporter"""
+        stages, counters = self.snapshot()
+        lines = ['# HELP photoscenery_stage_seconds Time spent in each stage of creator.py',
+                 '# TYPE photoscenery_stage_seconds histogram']
+        for k, s in sorted(stages.items()):
+            cumulative = 0
+            for bound, n in zip(self.BOUNDS + (float('inf'),), s[4]):
+                cumulative += n
+                lines.append('photoscenery_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                             % (k, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+            lines.append('photoscenery_stage_seconds_sum{stage="%s"} %r' % (k, s[1]))
+            lines.append('photoscenery_stage_seconds_count{stage="%s"} %d' % (k, s[0]))
+        for k, v in sorted(counters.items()):
+            lines.append('# TYPE photoscenery_%s_total counter' % k)
+            lines.append('photoscenery_%s_total %d' % (k, v))
+        # Write atomically, the collector may read the file at any time
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def log_summary(self):
+        for k, s in self.summary()['stages'].items():
+            logging.info('%-16s %6d x  total %8.2f s  mean %7.4f s  p90 %7.4f s',
+                         k, s['count'], s['total_s'], s['mean_s'], s['p90_s'])
+        for k, v in self.summary()['counters'].items():
+            logging.info('%-16s %d', k, v)
+
+
+# Metrics of this process
+METRICS = Metrics()
+
+
+def _run_with_metrics(func, *args, **kwargs):
+    """Run func in a worker process, and return (its result, the metrics
+    recorded meanwhile) so that the parent can merge them"""
+    METRICS.reset()
+    return func(*args, **kwargs), METRICS.snapshot()
+
+
+class TimedFile:
+    """Wrap a file object opened for writing, and measure the time spent
+    and the bytes written in write().
+
+    fileno() is hidden on purpose, so that PIL writes through write()
+    rather than directly to the file descriptor.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        n = self._f.write(data)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return n
+
+    def fileno(self):
+        raise io.UnsupportedOperation('fileno')
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+class SamplingProfiler:
+    """Sample the stacks of all the threads of the process at regular
+    intervals, to see where the time goes in the download threads too.
+
+    The result is written in the 'folded stacks' format read by
+    flamegraph.pl and speedscope: one line per distinct stack, with the
+    number of times it was seen.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True,
+                                        name='profiler')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s@%s:%d' % (code.co_name,
+                                               os.path.basename(code.co_filename),
+                                               code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, n in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, n))
+
+
+class TileDownloadError(Exception):
+    """A tile (or the tiles of a bucket) could not be downloaded.
+
+    Attributes:
+        retryable: whether trying again later may succeed
+        retry_after: delay requested by the server, in seconds, or None
+    """
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Convert a Retry-After header to a delay in seconds (or None)"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RateLimiter:
+    """Token bucket limiting the request rate to a provider.
+
+    The rate adapts to the server: it is halved when the server says it
+    is overloaded (slow_down()), and raised by a small step after every
+    successful request (speed_up()), between min_rate and max_rate. The
+    rate is cut at most once per congestion window (1 / rate seconds), so
+    that a burst of throttled responses to requests that were in flight
+    together only halves it once.
+    A Retry-After delay pauses all requests until it has elapsed.
+
+    Methods are thread safe.
+    """
+
+    def __init__(self, rate, max_rate=None, min_rate=0.1):
+        """Construct a RateLimiter.
+
+        Params:
+            rate: initial rate, in requests per second
+            max_rate: maximum rate, in requests per second. Defaults to rate
+            min_rate: minimum rate, in requests per second
+        """
+        self.rate = rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.min_rate = min(min_rate, rate)
+        # additive increase step: ~40 successes to go from 0 to max_rate
+        self._step = self.max_rate / 40.0
+        self._tokens = 1.0
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._last_cut = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                else:
+                    wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self, retry_after=None):
+        """Lower the rate after the server reported it is overloaded"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if (self._last_cut is not None
+                    and now - self._last_cut < 1.0 / self.rate):
+                return
+            self._last_cut = now
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self._tokens = min(self._tokens, 0.0)
+        logging.info('Lowering request rate to %.2f/s', self.rate)
+
+    def speed_up(self):
+        """Raise the rate after a successful request"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self._step)
+
+
+# Latitude bands of the tile grid: a tile whose latitude is in
+# [TILE_WIDTH_BANDS[i-1], TILE_WIDTH_BANDS[i]) is TILE_WIDTHS[i] degrees wide
+TILE_WIDTH_BANDS = (-89.0, -86.0, -83.0, -76.0, -62.0, -22.0,
+                    22.0, 62.0, 76.0, 83.0, 86.0, 89.0)
+TILE_WIDTHS = (12.0, 4.0, 2.0, 1.0, 0.5, 0.25, 0.125,
+               0.25, 0.5, 1.0, 2.0, 4.0, 12.0)
+
+
 def get_tile_width(lat):
     """ Gets the width of a FG tile, in degrees. In FG, the width of a tile depends on the latitude """
-    if lat >= 89.0:
-        return 12.0
-    elif lat >= 86.0:
-        return 4.0
-    elif lat >= 83.0:
-        return 2.0
-    elif lat >= 76.0:
-        return 1.0
-    elif lat >= 62.0:
-        return 0.5
-    elif lat >= 22.0:
-        return 0.25
-    elif lat >= -22.0:
-        return 0.125
-    elif lat >= -62.0:
-        return 0.25
-    elif lat >= -76.0:
-        return 0.5
-    elif lat >= -83.0:
-        return 1.0
-    elif lat >= -86.0:
-        return 2.0
-    elif lat >= -89.0:
-        return 4.0
-    else:
-        return 12.0
+    return TILE_WIDTHS[bisect.bisect_right(TILE_WIDTH_BANDS, lat)]
+
 
+def get_tile_widths(lat):
+    """Vectorized get_tile_width(), for a NumPy array of latitudes"""
+    return numpy.asarray(TILE_WIDTHS)[
+        numpy.searchsorted(TILE_WIDTH_BANDS, lat, side='right')]
 
 
 class Bucket(object):
+    __slots__ = ('lon', 'lat', 'x', 'y')
+
     def __init__(self, lon, lat, x, y):
         self.lon = lon
         self.lat = lat
@@ -231,6 +913,603 @@ class Bucket(object):
         return cls(lon, lat, x, y)
 
 
+class BucketArray:
+    """A collection of buckets, stored as NumPy arrays.
+
+    BucketArray mirrors Bucket, but each method works on all the buckets
+    at once, so that millions of positions can be turned into buckets at
+    NumPy speed. The results are the same as those of Bucket, element by
+    element. Indexing with an integer returns a Bucket; indexing with a
+    slice, an array of indices or a boolean mask returns a BucketArray.
+
+    Requires NumPy.
+    """
+    __slots__ = ('lon', 'lat', 'x', 'y')
+
+    def __init__(self, lon, lat, x, y):
+        if numpy is None:
+            raise RuntimeError('NumPy is required to use BucketArray')
+        self.lon = numpy.asarray(lon, dtype=numpy.int64)
+        self.lat = numpy.asarray(lat, dtype=numpy.int64)
+        self.x = numpy.asarray(x, dtype=numpy.int64)
+        self.y = numpy.asarray(y, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.lon)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, numpy.integer)):
+            return Bucket(int(self.lon[key]), int(self.lat[key]),
+                          int(self.x[key]), int(self.y[key]))
+        return BucketArray(self.lon[key], self.lat[key], self.x[key],
+                           self.y[key])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_tile_width(self):
+        """Return the width of every bucket, in degrees"""
+        return get_tile_widths(self.lat)
+
+    def get_index(self):
+        return (((self.lon + 180) << 14) + ((self.lat + 90) << 6) +
+                (self.y << 3) + self.x)
+
+    def get_bounds(self):
+        """Return the bounds of the buckets, as in Bucket.get_bounds(), but
+        with an array of values for each key"""
+        width = self.get_tile_width()
+        return {
+            'min_lat': self.lat + 0.125 * self.y,
+            'max_lat': self.lat + 0.125 * (self.y + 1),
+            'min_lon': self.lon + self.x * width,
+            'max_lon': self.lon + (self.x + 1) * width,
+            'center_lat': 0.5 * (self.lat + 0.125 * self.y + self.lat + 0.125 * (self.y + 1)),
+            'center_lon': 0.5 * (self.lon + self.x * width + self.lon + (self.x + 1) * width)
+        }
+
+    def get_base_path(self):
+        """Return the list of the base paths of the buckets"""
+        # Buckets share few 1x1 degree cells: format each cell only once
+        cells, inverse = numpy.unique((self.lon + 180) * 256 + self.lat + 90,
+                                      return_inverse=True)
+        paths = [Bucket(cell // 256 - 180, cell % 256 - 90, 0, 0).get_base_path()
+                 for cell in cells.tolist()]
+        return [paths[i] for i in inverse.ravel().tolist()]
+
+    def unique(self):
+        """Return the distinct buckets, in the order they first appear"""
+        indices, first = numpy.unique(self.get_index(), return_index=True)
+        return self[numpy.sort(first)]
+
+    @classmethod
+    def from_buckets(cls, buckets):
+        """ Factory method: create a BucketArray from Bucket objects """
+        buckets = list(buckets)
+        return cls([b.lon for b in buckets], [b.lat for b in buckets],
+                   [b.x for b in buckets], [b.y for b in buckets])
+
+    @classmethod
+    def from_index(cls, index):
+        """ Factory method: create a BucketArray from FlightGear indices """
+        if numpy is None:
+            raise RuntimeError('NumPy is required to use BucketArray')
+        index = numpy.asarray(index, dtype=numpy.int64)
+        lon = (index >> 14) - 180
+        lat = ((index - ((lon + 180) << 14)) >> 6) - 90
+        y = (index - (((lon + 180) << 14) + ((lat + 90) << 6))) >> 3
+        x = index - ((((lon + 180) << 14) + ((lat + 90) << 6)) + (y << 3))
+        return cls(lon, lat, x, y)
+
+    @classmethod
+    def from_lon_lat(cls, d_lon, d_lat):
+        """ Factory method: create a BucketArray from arrays of lon, lat """
+        if numpy is None:
+            raise RuntimeError('NumPy is required to use BucketArray')
+        d_lon = numpy.asarray(d_lon, dtype=numpy.float64)
+        d_lat = numpy.asarray(d_lat, dtype=numpy.float64)
+        lat = numpy.floor(d_lat)
+        y = numpy.floor((d_lat - lat) * 8)
+        width = get_tile_widths(lat)
+        lon = numpy.maximum(numpy.floor(numpy.floor(d_lon / width) * width), -180)
+        x = numpy.floor((d_lon - lon) / width)
+        return cls(lon, lat, x, y)
+
+
+def get_tile_name(tbounds, tsize, ext='png'):
+    """Return the name of the file of a tile in the cache"""
+    # The .08f gives us millimeter precision, so we can be sure not to
+    # inadvertently reuse a cached tile that doesn't quite correspond to
+    # the current tbounds.
+    return "tile-{w}x{h}_{min_lon:.08f}-{min_lat:.08f}" \
+           "_{max_lon:.08f}-{max_lat:.08f}.{ext}" \
+        .format(w=tsize[0], h=tsize[1], min_lon=tbounds[0],
+                min_lat=tbounds[1], max_lon=tbounds[2], max_lat=tbounds[3],
+                ext=ext)
+
+
+def get_tiles(bucket, tnum=(1,1), theight=512):
+    """Split a bucket into the tiles requested from the providers.
+
+    Params:
+        bucket: a Bucket object
+        tnum: (cols,rows) number of tiles in the bucket
+        theight: height of a tile, in pixels
+
+    Returns:
+        A (tsize, tbounds_list) tuple: the size of every tile, in pixels,
+        and the (minlon,minlat,maxlon,maxlat) bounds of each tile, first
+        cols, then rows.
+    """
+    # final size of a tile, in pixels. Width depends on the latitude. Both sizes must be power of two
+    tsize = (int(theight * ((get_tile_width(bucket.lat)) / TILE_HEIGHT)), theight)
+    # bounds of the bucket
+    bounds = bucket.get_bounds()
+    # width of the bucket, in degrees
+    bwidth = get_tile_width(bucket.lat)
+    # size of the tile, in degrees
+    gtwidth = bwidth / tnum[0]
+    gtheight = TILE_HEIGHT / tnum[1]
+    tbounds_list = []
+    for r in range(0, tnum[1]):
+        for c in range(0, tnum[0]):
+            min_lon = bounds['min_lon'] + c * gtwidth
+            min_lat = bounds['min_lat'] + r * gtheight
+            max_lon = min_lon + gtwidth
+            max_lat = min_lat + gtheight
+            tbounds_list.append((min_lon, min_lat, max_lon, max_lat))
+    return tsize, tbounds_list
+
+
+def buckets_in_bbox(lat_ll, lon_ll, lat_ur, lon_ur):
+    """Enumerate every bucket that intersects a bounding box.
+
+    The buckets are computed from the tile grid itself rather than by
+    sampling, so no bucket is missed or returned twice. A box whose
+    lon_ll is greater than its lon_ur is taken to cross the antimeridian.
+
+    Params:
+        lat_ll, lon_ll: lower left corner of the box, in degrees
+        lat_ur, lon_ur: upper right corner of the box, in degrees
+
+    Returns:
+        A list of Bucket objects, from south to north and west to east.
+    """
+    if lat_ll > lat_ur:
+        raise ValueError('Invalid bounding box: latLL {} is north of latUR {}'
+                         .format(lat_ll, lat_ur))
+    if lon_ll > lon_ur:
+        return (buckets_in_bbox(lat_ll, lon_ll, lat_ur, 180.0) +
+                buckets_in_bbox(lat_ll, -180.0, lat_ur, lon_ur))
+
+    buckets = []
+    seen = set()
+    # Buckets are TILE_HEIGHT (1/8 degree) high everywhere, so walk the rows
+    # of the grid. A bucket that only touches the edge of the box is not
+    # part of it, unless the box is degenerate (a point or a line).
+    first_row = min(math.floor(lat_ll / TILE_HEIGHT), 90 * 8 - 1)
+    last_row = min(max(math.ceil(lat_ur / TILE_HEIGHT) - 1, first_row),
+                   90 * 8 - 1)
+    for row in range(max(first_row, -90 * 8), last_row + 1):
+        row_lat = row * TILE_HEIGHT
+        # The width only depends on the integer latitude of the bucket
+        width = get_tile_width(math.floor(row_lat))
+        first_col = math.floor(max(lon_ll, -180.0) / width)
+        last_col = max(math.ceil(min(lon_ur, 180.0) / width) - 1, first_col)
+        if last_col * width >= 180.0:
+            last_col -= 1
+        for col in range(first_col, last_col + 1):
+            # The center of a grid cell is unambiguously inside its bucket
+            bucket = Bucket.from_lon_lat((col + 0.5) * width,
+                                         row_lat + 0.5 * TILE_HEIGHT)
+            index = bucket.get_index()
+            if index not in seen:
+                seen.add(index)
+                buckets.append(bucket)
+    return buckets
+
+
+def _get_polygon_intervals(polygons, lat, below=False):
+    """Return the sorted (west, east) longitude intervals of a parallel
+    that are inside a set of polygons (even-odd rule). Edges along the
+    parallel count as inside the polygons north of it, or south of it if
+    below is True"""
+    crossings = []
+    for polygon in polygons:
+        for (lon0, lat0), (lon1, lat1) in zip(polygon, polygon[1:] + polygon[:1]):
+            # half-open, so that a vertex on the parallel counts once
+            if below and (lat0 < lat) != (lat1 < lat):
+                crossings.append(lon0 + (lat - lat0) * (lon1 - lon0) /
+                                 (lat1 - lat0))
+            elif not below and (lat0 <= lat) != (lat1 <= lat):
+                crossings.append(lon0 + (lat - lat0) * (lon1 - lon0) /
+                                 (lat1 - lat0))
+    crossings.sort()
+    return list(zip(crossings[::2], crossings[1::2]))
+
+
+def _intersect_intervals(a, b):
+    """Intersection of two sorted lists of disjoint intervals"""
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        west = max(a[i][0], b[j][0])
+        east = min(a[i][1], b[j][1])
+        if west < east:
+            result.append((west, east))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class Coverage:
+    """The buckets that a set of polygons covers entirely, e.g. the area a
+    provider has imagery for (see COVERAGE).
+
+    The polygons are rasterised once to a bitmap of bucket indices, one
+    row of buckets (1/8 degree) at a time, so that checking a bucket is a
+    single lookup. A bucket is covered if it is inside the polygons at
+    the bottom and top of its row, and at every vertex in between.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = [list(polygon) for polygon in polygons]
+        lats = [lat for polygon in self.polygons for lon, lat in polygon]
+        indices = []
+        for row in range(math.floor(min(lats) / TILE_HEIGHT),
+                         math.ceil(max(lats) / TILE_HEIGHT)):
+            south = row * TILE_HEIGHT
+            north = south + TILE_HEIGHT
+            width = get_tile_width(math.floor(south))
+            samples = {(south, False), (north, True)}
+            samples.update((lat, False) for lat in lats if south < lat < north)
+            intervals = None
+            for lat, below in samples:
+                found = _get_polygon_intervals(self.polygons, lat, below)
+                intervals = (found if intervals is None else
+                             _intersect_intervals(intervals, found))
+            for west, east in intervals:
+                for col in range(math.ceil(west / width),
+                                 math.floor(east / width)):
+                    indices.append(Bucket.from_lon_lat(
+                        (col + 0.5) * width, south + 0.5 * TILE_HEIGHT).get_index())
+        self.base = min(indices, default=0)
+        self.bits = bytearray((max(indices, default=0) - self.base) // 8 + 1)
+        for index in indices:
+            index -= self.base
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count = len(indices)
+
+    def __contains__(self, bucket):
+        index = bucket.get_index() - self.base
+        return (0 <= index < len(self.bits) * 8 and
+                bool(self.bits[index >> 3] >> (index & 7) & 1))
+
+    def __len__(self):
+        return self.count
+
+
+# Mean radius of the Earth, in km
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = math.pi / 180 * EARTH_RADIUS
+# Routes are split in segments of at most this many degrees, short enough
+# for distances to be computed in a local flat projection
+ROUTE_STEP = 0.25
+
+
+def _get_route_segments(route):
+    """Split a route in short segments, see ROUTE_STEP.
+
+    Longitudes are unwrapped, so that a leg crossing the antimeridian
+    takes the short way: they may fall outside [-180, 180].
+
+    Returns:
+        A list of ((lat, lon), (lat, lon), distance along the route to the
+        start of the segment, in km) tuples.
+    """
+    points = [tuple(route[0])]
+    for lat, lon in route[1:]:
+        plat, plon = points[-1]
+        lon = plon + (lon - plon + 180) % 360 - 180
+        n = max(1, math.ceil(max(abs(lat - plat), abs(lon - plon)) / ROUTE_STEP))
+        points.extend((plat + (lat - plat) * i / n, plon + (lon - plon) * i / n)
+                      for i in range(1, n + 1))
+    if len(points) == 1:
+        points.append(points[0])
+    segments = []
+    along = 0.0
+    for a, b in zip(points[:-1], points[1:]):
+        segments.append((a, b, along))
+        kx = _get_scale((a[0] + b[0]) / 2)
+        along += math.hypot((b[1] - a[1]) * kx, (b[0] - a[0]) * KM_PER_DEGREE)
+    return segments
+
+
+def _get_scale(lat):
+    """Return the number of km per degree of longitude at a latitude"""
+    return KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat), 90.0))), 0.001)
+
+
+def _point_segment(px, py, qx, qy):
+    """Return (distance, t) from point p to the segment from (0, 0) to q,
+    where t * q is the nearest point of the segment"""
+    length2 = qx * qx + qy * qy
+    t = 0.0 if length2 == 0 else min(max((px * qx + py * qy) / length2, 0.0), 1.0)
+    return math.hypot(px - t * qx, py - t * qy), t
+
+
+def _segment_rect_distance(qx, qy, xmin, ymin, xmax, ymax):
+    """Return the distance between the segment from (0, 0) to q and a
+    rectangle"""
+    # Liang-Barsky: does the segment cross the rectangle?
+    t0, t1 = 0.0, 1.0
+    for p, d in ((-qx, -xmin), (qx, xmax), (-qy, -ymin), (qy, ymax)):
+        if p == 0:
+            if d < 0:
+                break
+        else:
+            t = d / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+    else:
+        if t0 <= t1:
+            return 0.0
+    # Otherwise the nearest points are an end of the segment or a corner
+    corners = ((xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax))
+    return min([_point_segment(x, y, qx, qy)[0] for x, y in corners] +
+               [math.hypot(max(xmin - x, 0, x - xmax), max(ymin - y, 0, y - ymax))
+                for x, y in ((0.0, 0.0), (qx, qy))])
+
+
+def _get_route_position(segment, bucket, bounds):
+    """Locate a bucket relative to a segment of a route.
+
+    Returns:
+        A (distance from the segment to the bucket, distance from the
+        segment to the center of the bucket, position of the center along
+        the route) tuple, in km.
+    """
+    (alat, alon), (blat, blon), along = segment
+    kx = _get_scale((alat + blat) / 2)
+    # the bucket may be on the other side of the antimeridian
+    shift = 360.0 * round((bounds['center_lon'] - alon) / 360.0)
+    distance = _segment_rect_distance(
+        (blon - alon) * kx, (blat - alat) * KM_PER_DEGREE,
+        (bounds['min_lon'] - shift - alon) * kx, (bounds['min_lat'] - alat) * KM_PER_DEGREE,
+        (bounds['max_lon'] - shift - alon) * kx, (bounds['max_lat'] - alat) * KM_PER_DEGREE)
+    return (distance,) + _locate_on_route([segment], bounds['center_lat'],
+                                          bounds['center_lon'])
+
+
+def _locate_on_route(segments, lat, lon):
+    """Return the (distance, position along the route) of the point of the
+    segments of a route nearest to (lat, lon), in km"""
+    best = None
+    for (alat, alon), (blat, blon), along in segments:
+        kx = _get_scale((alat + blat) / 2)
+        shift = 360.0 * round((lon - alon) / 360.0)
+        qx, qy = (blon - alon) * kx, (blat - alat) * KM_PER_DEGREE
+        d, t = _point_segment((lon - shift - alon) * kx,
+                              (lat - alat) * KM_PER_DEGREE, qx, qy)
+        if best is None or d < best[0]:
+            best = (d, along + t * math.hypot(qx, qy))
+    return best
+
+
+def _find_buckets_near_route(segments, distance):
+    """Find the buckets within distance (km) of the segments of a route.
+
+    Returns:
+        A dict of (distance to their center, position of their center
+        along the route, Bucket) tuples, in km, by bucket index.
+    """
+    found = {}
+    for segment in segments:
+        (alat, alon), (blat, blon), along = segment
+        dlat = distance / KM_PER_DEGREE
+        lat_ll = max(min(alat, blat) - dlat, -90.0)
+        lat_ur = min(max(alat, blat) + dlat, 90.0)
+        dlon = distance / _get_scale(max(abs(lat_ll), abs(lat_ur)))
+        lon_ll = min(alon, blon) - dlon
+        lon_ur = max(alon, blon) + dlon
+        if lon_ur - lon_ll >= 360.0:
+            lon_ll, lon_ur = -180.0, 180.0
+        # buckets_in_bbox() takes lon_ll > lon_ur across the antimeridian
+        if not -180.0 <= lon_ll <= 180.0:
+            lon_ll = (lon_ll + 180.0) % 360.0 - 180.0
+        if not -180.0 <= lon_ur <= 180.0:
+            lon_ur = (lon_ur + 180.0) % 360.0 - 180.0
+        for bucket in buckets_in_bbox(lat_ll, lon_ll, lat_ur, lon_ur):
+            bounds = bucket.get_bounds()
+            d, center, position = _get_route_position(segment, bucket, bounds)
+            if d > distance:
+                continue
+            index = bucket.get_index()
+            if index not in found or (center, position) < found[index][:2]:
+                found[index] = (center, position, bucket)
+    return found
+
+
+def buckets_near_route(route, distance):
+    """Enumerate every bucket within some distance of a route.
+
+    Distances are computed in a flat projection around each segment of the
+    route, which is accurate to a small fraction of the distance for the
+    corridors used in practice.
+
+    Params:
+        route: list of (lat, lon) waypoints, in degrees. A single waypoint
+               gives the buckets within distance of a point
+        distance: in km
+
+    Returns:
+        A list of Bucket objects, in the order they are met along the route
+        (by the position of their center).
+    """
+    found = _find_buckets_near_route(_get_route_segments(route), distance)
+    return [bucket for center, position, bucket in
+            sorted(found.values(), key=lambda f: (f[1], f[0]))]
+
+
+def plan_route(route, distance, airports=(), radius=0.0):
+    """Enumerate the buckets along a route and around airports.
+
+    Params:
+        route: list of (lat, lon) waypoints, may be empty
+        distance: distance from the route, in km
+        airports: list of (lat, lon) of airports
+        radius: distance from the airports, in km
+
+    Returns:
+        A list of Bucket objects, sorted along the route. The buckets of
+        an airport come at the position of the airport along the route,
+        from the nearest to the farthest. Without a route, the airports
+        come in order.
+    """
+    keys = {}
+    segments = _get_route_segments(route) if route else []
+    if segments:
+        for index, (center, position, bucket) in _find_buckets_near_route(
+                segments, distance).items():
+            keys[index] = ((position, center), bucket)
+    for n, (lat, lon) in enumerate(airports):
+        # position of the airport along the route
+        position = _locate_on_route(segments, lat, lon)[1] if segments else n
+        for index, (center, _, bucket) in _find_buckets_near_route(
+                _get_route_segments([(lat, lon)]), radius).items():
+            if index not in keys or (position, center) < keys[index][0]:
+                keys[index] = ((position, center), bucket)
+    return [bucket for key, bucket in sorted(keys.values(), key=lambda k: k[0])]
+
+
+def parse_levels(value):
+    """Parse a comma-separated list of cols for the --levels argument"""
+    try:
+        levels = sorted({int(v) for v in value.split(',')})
+    except ValueError:
+        levels = []
+    if not levels or levels[0] < 1:
+        raise argparse.ArgumentTypeError(
+            "expected a list of cols such as '1,2,4', got '{}'".format(value))
+    if any(levels[-1] % cols for cols in levels):
+        raise argparse.ArgumentTypeError(
+            'every level must divide the highest one, got {}'.format(value))
+    return levels
+
+
+def parse_providers(value):
+    """Parse a comma-separated list of providers for --providers"""
+    providers = [v.strip() for v in value.split(',') if v.strip()]
+    unknown = [name for name in providers if name not in URLS]
+    if not providers or unknown:
+        raise argparse.ArgumentTypeError(
+            'expected a list of providers among {}, got {}'.format(
+                ', '.join(URLS), value))
+    return providers
+
+
+def parse_bbox(value):
+    """Parse a 'latLL,lonLL,latUR,lonUR' command line argument"""
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError(
+            "expected 'latLL,lonLL,latUR,lonUR', got '{}'".format(value))
+    lat_ll, lon_ll, lat_ur, lon_ur = bbox
+    if not (-90 <= lat_ll <= 90 and -90 <= lat_ur <= 90 and
+            -180 <= lon_ll <= 180 and -180 <= lon_ur <= 180):
+        raise argparse.ArgumentTypeError(
+            "latitudes must be within [-90, 90] and longitudes within "
+            "[-180, 180], got '{}'".format(value))
+    if lat_ll > lat_ur:
+        # a lonLL east of lonUR is fine: the box crosses the antimeridian
+        raise argparse.ArgumentTypeError(
+            "latLL must not be north of latUR, got '{}'".format(value))
+    return bbox
+
+
+def parse_point(value):
+    """Parse a 'lat,lon' command line argument"""
+    try:
+        point = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        point = ()
+    if len(point) != 2 or not -90 <= point[0] <= 90:
+        raise argparse.ArgumentTypeError(
+            "expected 'lat,lon', got '{}'".format(value))
+    return point
+
+
+def load_route(value):
+    """Parse the --route argument into a list of (lat, lon) waypoints.
+
+    value is either the path of a GPX file (track points, else route
+    points, else waypoints) or of a FlightGear route manager file, or a
+    list of 'lat,lon' waypoints separated by spaces or semicolons.
+    """
+    if not os.path.isfile(value):
+        try:
+            route = [parse_point(v) for v in re.split(r'[;\s]+', value.strip())]
+        except argparse.ArgumentTypeError:
+            raise argparse.ArgumentTypeError(
+                "'{}' is neither a route file nor a list of 'lat,lon' "
+                "waypoints".format(value)) from None
+        return route
+
+    try:
+        root = xml.etree.ElementTree.parse(value).getroot()
+    except (OSError, xml.etree.ElementTree.ParseError) as e:
+        raise argparse.ArgumentTypeError(
+            "cannot read route '{}': {}".format(value, e))
+    route = []
+    if root.tag.rsplit('}', 1)[-1] == 'gpx':
+        points = {'trkpt': [], 'rtept': [], 'wpt': []}
+        for element in root.iter():
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag in points:
+                points[tag].append((float(element.get('lat')),
+                                    float(element.get('lon'))))
+        route = points['trkpt'] or points['rtept'] or points['wpt']
+    else:
+        # FlightGear route: <route><wp><lat>..</lat><lon>..</lon></wp>...
+        # Waypoints without coordinates (e.g. runways) are skipped
+        for wp in root.iter('wp'):
+            lat, lon = wp.findtext('lat'), wp.findtext('lon')
+            if lat is not None and lon is not None:
+                route.append((float(lat), float(lon)))
+    if not route:
+        raise argparse.ArgumentTypeError(
+            "no waypoints with coordinates in '{}'".format(value))
+    return route
+
+
+class Mosaic:
+    """A single request covering several neighbour tiles, possibly of
+    several buckets, see ImageProvider.plan_mosaics()."""
+
+    def __init__(self, tbounds, tsize, tiles):
+        """Construct a Mosaic.
+
+        Params:
+            tbounds: bounds of the request, in degrees
+            tsize: size of the request, in pixels
+            tiles: list of (cache file name, (left, upper, right, lower) box
+                   in the image) of the tiles in the mosaic
+        """
+        self.tbounds = tbounds
+        self.tsize = tsize
+        self.tiles = tiles
+        self.lock = threading.Lock()
+        self.done = False
+
+
 class ImageProvider:
     """Download an image from a URL.
 
@@ -251,67 +1530,497 @@ class ImageProvider:
     cache directory, and only reused when fetching the same bucket from
     the same provider.
 
+    Tiles are downloaded concurrently by a pool of at most
+    max_connections threads, which share a single HTTP session so that
+    connections to the provider are kept alive and reused. The pool is
+    shared by all the buckets fetched through the same ImageProvider.
+
     """
 
-    def __init__(self, name, url):
+    def __init__(self, name, url, max_connections=4, rate=4.0, max_rate=None,
+                 max_retries=5, backoff=1.0, max_backoff=120.0, cache=None,
+                 max_size=None, formats=None, tile_format='png'):
         """Construct an ImageProvider instance.
 
         Params:
             name: string that should uniquely identify the chosen provider
                   (it is used to determine where cached tiles are stored)
             url: format string with the url. 'tbounds(minlon,minlat,maxlon,maxlat)' is used for tile bounds and 'tsize(width,height)' for tile size, in pixels. See examples.
+            max_connections: maximum number of tiles downloaded in parallel
+            rate: initial number of requests per second (see RateLimiter)
+            max_rate: maximum number of requests per second
+            max_retries: number of times a failed tile is retried before
+                         giving up on it
+            backoff: base delay before the first retry, in seconds. It is
+                     doubled on every attempt, with random jitter.
+            max_backoff: maximum delay between retries, in seconds
+            cache: a TileCache to keep downloaded tiles across runs, or None
+                   to delete them as soon as they are assembled
+            max_size: largest width or height of an image the provider
+                      returns, in pixels, see plan_mosaics()
+            formats: dict of the tile formats the provider supports (see
+                     TILE_FORMATS) to their name in the url. Defaults to
+                     PNG only
+            tile_format: format of the tiles to download
+
+        Raises:
+            ValueError if the provider does not support tile_format
         """
         self.name = name
+        formats = formats or {'png': 'image/png'}
+        if tile_format not in formats:
+            raise ValueError('{} cannot send {} tiles, only {}'.format(
+                name, tile_format, ', '.join(sorted(formats))))
+        self.tile_format = tile_format
+        self._content_type, self._tile_ext = TILE_FORMATS[tile_format]
         self._url = url
+        self._tformat = formats[tile_format]
+        self.max_connections = max_connections
+        self.rate_limiter = RateLimiter(rate, max_rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        self.max_size = max_size
+        self._mosaics = {}
+        # tile name -> validators of the tiles downloaded, see pop_validators()
+        self._validators = {}
+        self._cache_dirs = set()
+        self._session = None
+        self._executor = None
+        self._session_lock = threading.Lock()
+
+    def _get_session(self):
+        """Return the requests.Session shared by all download threads"""
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_connections)
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+            return self._session
+
+    def _get_executor(self):
+        """Return the pool of threads downloading tiles from the provider.
+
+        The pool is shared by all the buckets being fetched, so that at
+        most max_connections tiles are downloaded at any time.
+        """
+        with self._session_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_connections,
+                    thread_name_prefix='download-' + self.name)
+            return self._executor
+
+    def close(self):
+        """Close the pooled HTTP connections to the provider"""
+        with self._session_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
     def download(self, bucket, outpath, cache_dir, tnum=(1,1), theight=512,
-                 dry_run=False):
+                 dry_run=False, low_memory=False, formats=('png',),
+                 dds_compression='bc1', levels=(), png_compression=6,
+                 uniform='full', uniform_threshold=UNIFORM_THRESHOLD):
         """ Downloads a FG bucket and save in outpath.
         A bucket is the final image for FG. A tile is each one of the little images that create a bucket. Many online
         services won't allow downloading huge images at once, and you must cut buckets down into tiles.
 
         Params:
             bucket: a Bucket object
-            outpath: string, path to the output file
+            outpath: string, path to the output file. Formats other than PNG are written next to it, with their own extension
             cache_dir: directory where downloaded tiles are stored before they can be assembled
             tnum: (cols,rows) number of tiles in the bucket. Use (1,1), (2,2), (4,4)... other pairs are not tested
             theight: height of a tile, in pixels. The width depends on the latitude. Use power of two numbers: 512, 1028, 2048... The final image will have a theight of tsize*tnum
             dry_run: if True, do not donwload anything. Useful for testing
+            low_memory: if True, assemble the output one row of tiles at a
+                        time (see _join_streaming). Only possible when
+                        formats is ('png',)
+            formats: output formats, among 'png' and 'dds'
+            dds_compression: block compression of DDS files, see DDS_FORMATS
+            levels: (factor, outpath) pairs: also write lower resolution
+                    versions of the orthophoto, downsampled by factor, to
+                    these paths. No additional download is needed
+            png_compression: zlib compression level of PNG files, 0-9
+            uniform, uniform_threshold: what to do if all the tiles have
+                                        about the same colour, see
+                                        build_orthophoto()
+
+        Returns:
+            The colour of the bucket if it is uniform, NO_DATA if it has
+            no data, else None (see build_orthophoto()).
+
+        Raises:
+            TileDownloadError if some tiles could not be downloaded. The
+            tiles that were downloaded are kept in cache for the next try.
         """
+        ftiles = self.fetch_tiles(bucket, cache_dir, tnum=tnum,
+                                  theight=theight, dry_run=dry_run)
+        if dry_run:
+            return None
+        written, color = build_orthophoto(
+            ftiles, outpath, uniform=uniform,
+            uniform_threshold=uniform_threshold, tnum=tnum, formats=formats,
+            dds_compression=dds_compression, low_memory=low_memory,
+            levels=levels, png_compression=png_compression)
+        commit_orthophoto(written)
+        self.release_tiles(ftiles)
+        return color
+
+    def fetch_tiles(self, bucket, cache_dir, tnum=(1,1), theight=512,
+                    dry_run=False):
+        """ Downloads the tiles of a FG bucket to the cache.
+
+        Params: see download()
+
+        Returns:
+            The paths of the cached tiles, first cols, then rows (see
+            _join()).
 
-        # final size of a tile, in pixels. Width depends on the latitude. Both sizes must be power of two
-        tsize = (int(theight * ((get_tile_width(bucket.lat)) / TILE_HEIGHT)), theight)
-        # bounds of the bucket
-        bounds = bucket.get_bounds()
-        # width of the bucket, in degrees
-        bwidth = get_tile_width(bucket.lat)
-        # size of the tile, in degrees
-        gtwidth = bwidth / tnum[0]
-        gtheight = TILE_HEIGHT / tnum[1]
-        # Contains file paths (one for each tile that was successfully fetched)
+        Raises:
+            TileDownloadError if some tiles could not be downloaded. The
+            tiles that were downloaded are kept in cache for the next try.
+        """
+        tsize, tbounds_list = get_tiles(bucket, tnum, theight)
+        executor = self._get_executor()
+        queued = time.perf_counter()
+        futures = [executor.submit(self._download_and_cache_tile,
+                                   cache_dir, tbounds=tbounds,
+                                   tsize=tsize, dry_run=dry_run,
+                                   queued=queued)
+                   for tbounds in tbounds_list]
+        # Contains file paths (one for each tile that was successfully
+        # fetched), in the same order as tbounds_list
         ftiles = []
+        errors = []
+        for future in futures:
+            try:
+                ftiles.append(future.result())
+            except TileDownloadError as e:
+                errors.append(e)
+        if errors:
+            raise TileDownloadError(
+                '{} of {} tiles of bucket {} could not be downloaded: {}'
+                .format(len(errors), len(futures), bucket.get_index(),
+                        errors[0]),
+                retryable=all(e.retryable for e in errors))
+        return ftiles
+
+    def revalidate_tiles(self, bucket, cache_dir, validators, tnum=(1,1),
+                         theight=512, orthophoto=None):
+        """Check whether the tiles of a bucket changed since they were last
+        downloaded, with conditional requests.
+
+        Each tile is requested with the If-None-Match and If-Modified-Since
+        headers of its recorded validators, to which the server answers
+        304 Not Modified, with no body, if the tile did not change. Tiles
+        sent in full are compared by content hash, since not all servers
+        support conditional requests, and kept in cache so that
+        fetch_tiles() does not download them again. The new validators of
+        the tiles are kept, see pop_validators().
+
+        If some tile changed, the tiles that did not are cut from the
+        existing orthophoto, unless they are in a persistent cache (see
+        TileCache), so that only the changed tiles are downloaded. If none
+        changed, the tiles kept in cache are released (see
+        release_tiles()).
 
-        for r in range(0, tnum[1]):
-            for c in range(0, tnum[0]):
-                min_lon = bounds['min_lon'] + c * gtwidth
-                min_lat = bounds['min_lat'] + r * gtheight
-                max_lon = min_lon + gtwidth
-                max_lat = min_lat + gtheight
-                tbounds = (min_lon, min_lat, max_lon, max_lat)
-                ftiles.append(self._download_and_cache_tile(
-                    cache_dir, tbounds=tbounds, tsize=tsize, dry_run=dry_run))
-        if not dry_run:
-            logging.info('Joining tiles to %s', outpath)
-            with open(outpath, 'wb') as fout:
-                # note we always combine all tiles, even in the (1,1) case
-                self._join(fout, ftiles=ftiles, tnum=tnum,)
-
-            for f in ftiles: # the cached tiles are now assembled, remove them
-                logging.debug("Removing cached tile '%s'", f)
-                os.unlink(f)
+        Params:
+            cache_dir, tnum, theight: see download()
+            validators: validators of the tiles of the bucket, in the order
+                        of get_tiles(), as recorded in the manifest (see
+                        pop_validators()). None for the unknown ones
+            orthophoto: path of the existing PNG orthophoto of the bucket
+
+        Returns:
+            Whether any tile changed.
+
+        Raises:
+            TileDownloadError if some tiles could not be checked
+        """
+        tsize, tbounds_list = get_tiles(bucket, tnum, theight)
+        executor = self._get_executor()
+        futures = [executor.submit(self._revalidate_tile, cache_dir, tbounds,
+                                   tsize, tile_validators)
+                   for tbounds, tile_validators in zip(tbounds_list,
+                                                       validators)]
+        changed = False
+        # paths of the tiles sent in full, or None for each tile
+        kept = []
+        errors = []
+        for future in futures:
+            try:
+                tile_changed, path = future.result()
+                changed = tile_changed or changed
+                kept.append(path)
+            except TileDownloadError as e:
+                errors.append(e)
+        if errors:
+            kept = [path for path in kept if path is not None]
+            if kept:
+                self.release_tiles(kept)
+            raise TileDownloadError(
+                '{} of {} tiles of bucket {} could not be checked: {}'
+                .format(len(errors), len(futures), bucket.get_index(),
+                        errors[0]),
+                retryable=all(e.retryable for e in errors))
+        if not changed:
+            kept = [path for path in kept if path is not None]
+            if kept:
+                self.release_tiles(kept)
+            return False
+        if orthophoto is not None and (self.cache is None or
+                                       not self.cache.persistent):
+            missing = [(i, tbounds) for i, (tbounds, path) in
+                       enumerate(zip(tbounds_list, kept)) if path is None]
+            kept += self._cut_orthophoto(orthophoto, cache_dir, missing,
+                                         tnum, tsize)
+        if self.cache is not None:
+            # fetch_tiles() uses them again
+            self.cache.release(self.name, [os.path.basename(path)
+                                           for path in kept if path is not None])
+        return True
+
+    def _revalidate_tile(self, base_cache_dir, tbounds, tsize, validators):
+        """Check whether a tile changed, see revalidate_tiles().
+
+        Returns:
+            (changed, path): whether the tile changed, and the path it was
+            stored to in cache if it was sent in full, else None.
+        """
+        cache_dir = self._get_cache_dir(base_cache_dir)
+        fname = get_tile_name(tbounds, tsize, self._tile_ext)
+        fpath = os.path.join(cache_dir, fname)
+        tmp_file = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                    mode='wb', dir=cache_dir, prefix="tmp" + fname + ".",
+                    delete=False) as tmp_file:
+                result = self._download_tile(tmp_file, tbounds, tsize, False,
+                                             validators)
+            if result is None:
+                logging.debug("'%s' not modified", fname)
+                return False, None
+            self._validators[fname] = result
+            changed = validators is None or result[2] != validators[2]
+            if changed:
+                logging.info("'%s' changed", fname)
+            else:
+                logging.debug("'%s' downloaded again, but unchanged", fname)
+            os.replace(tmp_file.name, fpath)
+            if self.cache is not None:
+                self.cache.add(self.name, fname, os.path.getsize(fpath))
+            return changed, fpath
+        finally:
+            if tmp_file is not None and os.path.exists(tmp_file.name):
+                os.unlink(tmp_file.name)
+
+    def _cut_orthophoto(self, orthophoto, base_cache_dir, tiles, tnum, tsize):
+        """Store in cache the pixels of some tiles of a bucket, cut from
+        its existing orthophoto, see revalidate_tiles(). The tiles are saved
+        losslessly, like those of a mosaic (see _download_mosaic()).
+
+        Params:
+            orthophoto: path of the PNG orthophoto of the bucket
+            tiles: (position in the order of get_tiles(), tbounds) of the
+                   tiles to cut
+            tnum, tsize: see get_tiles()
+
+        Returns:
+            The paths of the tiles stored. Nothing is stored if the
+            orthophoto is missing, or not made of tiles of this size (e.g.
+            the tiny orthophoto of a uniform bucket): the tiles must then be
+            downloaded.
+        """
+        if not tiles or not os.path.exists(orthophoto):
+            return []
+        cache_dir = self._get_cache_dir(base_cache_dir)
+        stored = []
+        with Image.open(orthophoto) as im:
+            if im.size != (tsize[0] * tnum[0], tsize[1] * tnum[1]):
+                return []
+            with METRICS.time('decode'):
+                im.load()
+            for i, tbounds in tiles:
+                fname = get_tile_name(tbounds, tsize, self._tile_ext)
+                path = os.path.join(cache_dir, fname)
+                # the last row of tiles is the top of the image
+                left = (i % tnum[0]) * tsize[0]
+                upper = (tnum[1] - i // tnum[0] - 1) * tsize[1]
+                im.crop((left, upper, left + tsize[0],
+                         upper + tsize[1])).save(path + '.tmp', format='PNG',
+                                                 compress_level=1)
+                os.replace(path + '.tmp', path)
+                logging.debug("'%s' cut from %s", fname, orthophoto)
+                if self.cache is not None:
+                    self.cache.add(self.name, fname, os.path.getsize(path))
+                stored.append(path)
+        METRICS.count('orthophoto_tiles', len(stored))
+        return stored
+
+    def pop_validators(self, bucket, tnum=(1,1), theight=512):
+        """Return the (etag, last_modified, sha256) validators of the tiles
+        of a bucket downloaded by this ImageProvider, in the order of
+        get_tiles(), and forget them. Tiles that were not downloaded (e.g.
+        taken from the cache) have None; tiles cut from a mosaic only have
+        its Last-Modified date, see _download_mosaic().
+        See revalidate_tiles()
+        """
+        tsize, tbounds_list = get_tiles(bucket, tnum, theight)
+        return [self._validators.pop(
+                    get_tile_name(tbounds, tsize, self._tile_ext), None)
+                for tbounds in tbounds_list]
+
+    def select(self, bucket):
+        """Return the ImageProvider to download a bucket from: this one.
+        See AutoProvider"""
+        return self
+
+    def plan_mosaics(self, buckets, tnum=(1,1), theight=512):
+        """Group the tiles of many buckets into as few requests as possible.
+
+        Tiles have the same number of pixels per degree everywhere, so
+        neighbour tiles of the same width can be requested at once, and
+        the image cut at exact pixel boundaries. The tile grid is split in
+        blocks of at most max_size pixels, aligned on the grid so that the
+        same blocks are requested on every run, and the tiles needed in
+        each block are fetched with a single request (a Mosaic).
+
+        Nothing is downloaded here: a mosaic is fetched the first time one
+        of its tiles is needed, see _download_and_cache_tile().
+
+        Params:
+            buckets: the buckets that will be fetched
+            tnum, theight: see download()
+
+        Returns:
+            The number of requests planned.
+        """
+        self._mosaics = {}
+        if not self.max_size:
+            return 0
+        blocks = {}
+        for bucket in buckets:
+            tsize, tbounds_list = get_tiles(bucket, tnum, theight)
+            bx = self.max_size // tsize[0]
+            by = self.max_size // tsize[1]
+            if bx * by < 2:
+                continue
+            for tbounds in tbounds_list:
+                col = round(tbounds[0] / (tbounds[2] - tbounds[0]))
+                row = round(tbounds[1] / (tbounds[3] - tbounds[1]))
+                blocks.setdefault((tsize, col // bx, row // by), {})[
+                    (col, row)] = tbounds
+        count = 0
+        for (tsize, bx, by), tiles in blocks.items():
+            if len(tiles) < 2:
+                continue
+            min_col = min(col for col, row in tiles)
+            max_row = max(row for col, row in tiles)
+            width = max(col for col, row in tiles) - min_col + 1
+            height = max_row - min(row for col, row in tiles) + 1
+            mosaic = Mosaic(
+                (min(t[0] for t in tiles.values()), min(t[1] for t in tiles.values()),
+                 max(t[2] for t in tiles.values()), max(t[3] for t in tiles.values())),
+                (width * tsize[0], height * tsize[1]),
+                [(get_tile_name(tbounds, tsize, self._tile_ext),
+                  ((col - min_col) * tsize[0], (max_row - row) * tsize[1],
+                   (col - min_col + 1) * tsize[0], (max_row - row + 1) * tsize[1]))
+                 for (col, row), tbounds in tiles.items()])
+            for name, box in mosaic.tiles:
+                self._mosaics[name] = mosaic
+            count += 1
+        logging.info('%d tiles will be downloaded with %d requests',
+                     len(self._mosaics), count)
+        return count
+
+    def _fetch_from_mosaic(self, cache_dir, fname):
+        """Get a tile by downloading the mosaic it belongs to, if any, and
+        cutting it into tiles.
+
+        Returns:
+            True if the tile is now in cache_dir. If the server refuses the
+            mosaic, False: the tiles must be downloaded one by one.
+        """
+        mosaic = self._mosaics.get(fname)
+        if mosaic is None:
+            return False
+        with mosaic.lock:
+            if not mosaic.done:
+                try:
+                    self._download_mosaic(mosaic, cache_dir, fname)
+                except TileDownloadError as e:
+                    if e.retryable:
+                        raise
+                    logging.warning('%s; downloading the tiles one by one', e)
+                mosaic.done = True
+        if self.cache is not None:
+            return self.cache.lookup(self.name, fname)
+        return os.path.exists(os.path.join(cache_dir, fname))
+
+    def _download_mosaic(self, mosaic, cache_dir, fname):
+        """Download a mosaic, and save its tiles to cache_dir.
+
+        The tiles are saved losslessly, as PNG data whatever their
+        extension, and get the Last-Modified date of the mosaic as
+        validator, so that they can be revalidated one by one (see
+        revalidate_tiles()). The ETag of the mosaic is not kept: it does not
+        match the URL of any tile, and servers ignore If-Modified-Since when
+        If-None-Match is sent.
+        """
+        METRICS.count('mosaic_requests')
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix='tmpmosaic',
+                                         suffix='.' + self._tile_ext) as tmp_file:
+            validators = self._download_tile(tmp_file, mosaic.tbounds,
+                                             mosaic.tsize, False)
+            last_modified = validators[1] if validators is not None else None
+            tmp_file.seek(0)
+            with Image.open(tmp_file) as im:
+                with METRICS.time('decode'):
+                    im.load()
+                for name, box in mosaic.tiles:
+                    path = os.path.join(cache_dir, name)
+                    if not os.path.exists(path):
+                        # Saved as PNG whatever the extension, so that lossy
+                        # tiles are not compressed twice; PIL reads the
+                        # format from the contents. Compress little: cached
+                        # tiles do not live long.
+                        im.crop(box).save(path + '.tmp', format='PNG',
+                                          compress_level=1)
+                        os.replace(path + '.tmp', path)
+                        if last_modified:
+                            self._validators[name] = (None, last_modified,
+                                                      None)
+                    if self.cache is not None:
+                        self.cache.add(self.name, name, os.path.getsize(path))
+                        # Only fname is about to be used
+                        self.cache.release(self.name, [name])
+                    METRICS.count('mosaic_tiles')
+
+    def release_tiles(self, ftiles):
+        """Remove cached tiles once the bucket they belong to is assembled.
+
+        With a persistent cache, the tiles are kept, and only evicted when
+        the cache is full.
+        """
+        names = [os.path.basename(f) for f in ftiles]
+        if self.cache is not None and self.cache.persistent:
+            self.cache.release(self.name, names)
+            return
+        for f in ftiles:
+            logging.debug("Removing cached tile '%s'", f)
+            os.unlink(f)
+        if self.cache is not None:
+            self.cache.forget(self.name, names)
 
     def _download_and_cache_tile(self, base_cache_dir, tbounds, tsize=(512, 256),
-                                 dry_run=False):
+                                 dry_run=False, queued=None):
         """ Downloads a tile from the remote server and returns a file object.
         A bucket is the final image for FG. A tile is each one of the little images that create a bucket. Many online
         services won't allow downloading huge images at once, and you must cut buckets down into tiles.
@@ -322,58 +2031,163 @@ class ImageProvider:
             tbounds: bounds of the tile, in degrees
             tsize: size of the tile, in pixels
             dry_run: if True, do not donwload anything. Useful for testing
+            queued: time.perf_counter() when the download was queued, to
+                    measure how long it waited for a connection
 
         Returns:
             A path to the cached file corresponding to the tile.
         """
-        # Provider-specific directory for storing cached downloaded tiles
-        cache_dir = os.path.join(base_cache_dir, self.name)
-        os.makedirs(cache_dir, exist_ok=True)
-
-        # The .08f gives us millimeter precision, so we can be sure not to
-        # inadvertently reuse a cached tile that doesn't quite correspond to
-        # the current tbounds.
-        fname = "tile-{w}x{h}_{min_lon:.08f}-{min_lat:.08f}" \
-                            "_{max_lon:.08f}-{max_lat:.08f}.png" \
-            .format(w=tsize[0], h=tsize[1], min_lon=tbounds[0],
-                    min_lat=tbounds[1], max_lon=tbounds[2], max_lat=tbounds[3])
+        if queued is not None:
+            METRICS.observe('queue_wait', time.perf_counter() - queued)
+        cache_dir = self._get_cache_dir(base_cache_dir)
+        fname = get_tile_name(tbounds, tsize, self._tile_ext)
         fpath = os.path.join(cache_dir, fname)
 
-        if os.path.exists(fpath):
+        if self.cache is not None and self.cache.lookup(self.name, fname):
+            logging.info("'%s' already in cache, not downloading it again",
+                         fname)
+            METRICS.count('cache_hits')
+        elif self.cache is None and os.path.exists(fpath):
             logging.info("'%s' already in cache, not downloading it again",
                          fname)
+            METRICS.count('cache_hits')
+        elif not dry_run and self._fetch_from_mosaic(cache_dir, fname):
+            logging.info("'%s' cut from a mosaic", fname)
         else:
+            METRICS.count('cache_misses')
             tmp_file = None
             try:
                 with tempfile.NamedTemporaryFile(
                         mode='wb', dir=cache_dir, prefix="tmp" + fname + ".",
                         delete=False) as tmp_file:
-                    self._download_tile(tmp_file, tbounds, tsize, dry_run)
+                    validators = self._download_tile(tmp_file, tbounds, tsize,
+                                                     dry_run)
                 # When the rename() happens, we know the file is complete so
                 # it can be kept in cache for later reuse.
                 if not dry_run:
                     os.rename(tmp_file.name, fpath)
                     logging.info("'%s' successfully fetched", fname)
+                    self._validators[fname] = validators
+                    if self.cache is not None:
+                        self.cache.add(self.name, fname,
+                                       os.path.getsize(fpath))
             finally:
                 if tmp_file is not None and os.path.exists(tmp_file.name):
                     os.unlink(tmp_file.name)
 
         return fpath
 
-    def _download_tile(self, dest_file, tbounds, tsize, dry_run):
-        url = self._url.format(tbounds=tbounds, tsize=tsize)
-        logging.info('Downloading tile=%s from url=%s', dest_file.name, url)
+    def _get_cache_dir(self, base_cache_dir):
+        """Return the provider-specific directory for storing cached
+        downloaded tiles, creating it if needed"""
+        cache_dir = os.path.join(base_cache_dir, self.name)
+        if cache_dir not in self._cache_dirs:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._cache_dirs.add(cache_dir)
+        return cache_dir
 
-        if not dry_run:
-            response = requests.get(url)
+    def _download_tile(self, dest_file, tbounds, tsize, dry_run,
+                       validators=None):
+        """Download a tile to dest_file, retrying on transient errors.
 
-            if response.status_code != 200:
-                raise Exception('Failed to download orthophoto. status={}'.format(response.status_code))
-            if response.headers['Content-Type'] != 'image/png':
-                raise Exception('Received invalid response type. Expected "image/png", got content_type="{}"'.format(response.headers['Content-Type']))
+        Overloaded servers (429, 503...) and network errors are retried up
+        to max_retries times, waiting for the Retry-After delay sent by
+        the server or else an exponential backoff with full jitter.
 
-            for chunk in response.iter_content(chunk_size=128):
-                dest_file.write(chunk)
+        Params:
+            validators: (etag, last_modified, sha256) of the version of the
+                        tile we have, to send a conditional request
+
+        Returns:
+            The (etag, last_modified, sha256) validators of the downloaded
+            tile, or None if the server answered that the tile did not
+            change since 'validators' (or with dry_run).
+        """
+        url = self._url.format(tbounds=tbounds, tsize=tsize,
+                               tformat=self._tformat)
+        logging.info('Downloading tile=%s from url=%s', dest_file.name, url)
+
+        if dry_run:
+            return None
+
+        headers = {}
+        if validators is not None:
+            etag, last_modified = validators[0], validators[1]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        attempt = 0
+        while True:
+            with METRICS.time('rate_limit_wait'):
+                self.rate_limiter.acquire()
+            try:
+                dest_file.seek(0)
+                dest_file.truncate()
+                result = self._try_download_tile(dest_file, url, headers)
+            except TileDownloadError as e:
+                if not e.retryable or attempt >= self.max_retries:
+                    raise
+                if e.retry_after is not None:
+                    delay = e.retry_after
+                else:
+                    delay = random.uniform(
+                        0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                attempt += 1
+                METRICS.count('http_retries')
+                logging.warning('%s; retrying in %.1f s (attempt %d of %d)',
+                                e, delay, attempt, self.max_retries)
+                time.sleep(delay)
+            else:
+                self.rate_limiter.speed_up()
+                return result
+
+    def _try_download_tile(self, dest_file, url, headers=None):
+        """Make a single attempt at downloading url to dest_file.
+        Returns the validators of the tile, see _download_tile()"""
+        METRICS.count('http_requests')
+        try:
+            start = time.perf_counter()
+            with self._get_session().get(url, stream=True, headers=headers,
+                                         timeout=(30, 300)) as response:
+                # Includes connecting, when no connection could be reused
+                METRICS.observe('http_ttfb', time.perf_counter() - start)
+                if response.status_code == 304 and headers:
+                    METRICS.count('http_not_modified')
+                    return None
+                if response.status_code != 200:
+                    METRICS.count('http_errors')
+                if response.status_code in RETRYABLE_STATUS_CODES:
+                    retry_after = parse_retry_after(
+                        response.headers.get('Retry-After'))
+                    if response.status_code in (429, 503):
+                        self.rate_limiter.slow_down(retry_after)
+                    raise TileDownloadError(
+                        'Failed to download orthophoto. status={}'.format(response.status_code),
+                        retry_after=retry_after)
+                if response.status_code != 200:
+                    raise TileDownloadError(
+                        'Failed to download orthophoto. status={}'.format(response.status_code),
+                        retryable=False)
+                content_type = response.headers.get('Content-Type')
+                if (content_type or '').split(';')[0].strip() != self._content_type:
+                    raise TileDownloadError(
+                        'Received invalid response type. Expected "{}", got content_type="{}"'.format(self._content_type, content_type),
+                        retryable=False)
+
+                digest = hashlib.sha256()
+                with METRICS.time('http_transfer'):
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        dest_file.write(chunk)
+                        digest.update(chunk)
+                        METRICS.count('http_bytes', len(chunk))
+                return (response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'),
+                        digest.hexdigest())
+        except requests.RequestException as e:
+            raise TileDownloadError(
+                'Failed to download orthophoto: {}'.format(e)) from e
 
     def _join(self, fout, ftiles, tnum=(1,1)):
         """ Join a collection of files (tile images) into a single file.
@@ -383,33 +2197,1556 @@ class ImageProvider:
             ftiles: the array of files with the files. First cols, then rows.
             tnum: (cols,rows) in tiles for a bucket
         """
+        self._assemble(ftiles, tnum).save(fout)
+
+    @staticmethod
+    def _assemble(ftiles, tnum=(1,1)):
+        """ Join a collection of files (tile images) into a single image.
+
+        Params:
+            ftiles: the array of files with the files. First cols, then rows.
+            tnum: (cols,rows) in tiles for a bucket
+
+        Returns:
+            The assembled PIL image.
+        """
         try:
-            images = [Image.open(x) for x in ftiles]
+            with METRICS.time('decode'):
+                images = [Image.open(x) for x in ftiles]
+                for im in images:
+                    im.load()
         except UnidentifiedImageError:
             logging.error("PIL.UnidentifiedImageError: this usually means that a tile couldn't be downloaded. Exiting")
             raise
+        METRICS.count('tiles_decoded', len(images))
         width = images[0].size[0]
         height = images[0].size[1]
-        new_im = Image.new('RGB', (width * tnum[0], height * tnum[1]))
-        for c in range(0, tnum[0]):
-            for r in range(0, tnum[1]):
-                # remember: for paste(), (0,0) is the upper left corner
-                new_im.paste(images[r * tnum[0] + c], (c * width, (tnum[1] - r - 1) * height))
-        new_im.save(fout)
+        with METRICS.time('paste'):
+            new_im = Image.new('RGB', (width * tnum[0], height * tnum[1]))
+            for c in range(0, tnum[0]):
+                for r in range(0, tnum[1]):
+                    # remember: for paste(), (0,0) is the upper left corner
+                    new_im.paste(images[r * tnum[0] + c], (c * width, (tnum[1] - r - 1) * height))
+        return new_im
 
+    @staticmethod
+    def _join_streaming(fout, ftiles, tnum=(1,1), compress_level=6):
+        """ Join a collection of files (tile images) into a single PNG file, one row of tiles at a time.
 
-def main():
-    parser = argparse.ArgumentParser(description="Download photoscenery for a tile. Provide either index OR lon and lat")
+        The result has the same pixels as _join(), but only one row of
+        tiles is decoded and held in memory at any time, whatever the
+        number of tiles of the bucket.
+
+        Params:
+            fout: File object to save the final image
+            ftiles: the array of files with the files. First cols, then rows.
+            tnum: (cols,rows) in tiles for a bucket
+            compress_level: zlib compression level, 0-9
+        """
+        try:
+            with Image.open(ftiles[0]) as first:
+                width, height = first.size
+        except UnidentifiedImageError:
+            logging.error("PIL.UnidentifiedImageError: this usually means that a tile couldn't be downloaded. Exiting")
+            raise
+
+        def bands():
+            # the last row of tiles is the top of the image
+            for r in range(tnum[1] - 1, -1, -1):
+                band = Image.new('RGB', (width * tnum[0], height))
+                for c in range(0, tnum[0]):
+                    with Image.open(ftiles[r * tnum[0] + c]) as tile:
+                        with METRICS.time('decode'):
+                            tile.load()
+                        with METRICS.time('paste'):
+                            band.paste(tile, (c * width, 0))
+                    METRICS.count('tiles_decoded')
+                yield band.tobytes()
+
+        write_png(fout, width * tnum[0], height * tnum[1], bands(),
+                  compress_level)
+
+
+class AutoProvider:
+    """Download each bucket from the first of several ImageProviders that
+    covers it entirely (see Coverage), e.g. the regional providers first
+    and a global one as fallback.
+
+    It has the methods of ImageProvider that work on whole buckets, so it
+    can be used in its place. Buckets that no provider covers are never
+    requested.
+    """
+
+    name = 'auto'
+
+    def __init__(self, providers, coverages=None):
+        """Construct an AutoProvider.
+
+        Params:
+            providers: ImageProviders, best first
+            coverages: dict of Coverage by provider name. Defaults to the
+                       areas in COVERAGE. Providers missing from it cover
+                       the whole world
+        """
+        self.providers = list(providers)
+        if coverages is None:
+            coverages = {provider.name: Coverage(COVERAGE[provider.name])
+                         for provider in self.providers
+                         if provider.name in COVERAGE}
+        self.coverages = coverages
+        self.max_connections = sum(provider.max_connections
+                                   for provider in self.providers)
+
+    def select(self, bucket):
+        """Return the ImageProvider to download a bucket from, or None if
+        no provider covers it"""
+        for provider in self.providers:
+            coverage = self.coverages.get(provider.name)
+            if coverage is None or bucket in coverage:
+                return provider
+        return None
+
+    def download(self, bucket, *args, **kwargs):
+        """See ImageProvider.download()
+
+        Raises:
+            ValueError if no provider covers the bucket
+        """
+        provider = self.select(bucket)
+        if provider is None:
+            raise ValueError('No provider among {} covers bucket {}'.format(
+                ', '.join(p.name for p in self.providers), bucket.get_index()))
+        return provider.download(bucket, *args, **kwargs)
+
+    def plan_mosaics(self, buckets, tnum=(1,1), theight=512):
+        """See ImageProvider.plan_mosaics()"""
+        by_provider = collections.defaultdict(list)
+        for bucket in buckets:
+            provider = self.select(bucket)
+            if provider is not None:
+                by_provider[provider].append(bucket)
+        return sum(provider.plan_mosaics(by_provider[provider], tnum, theight)
+                   for provider in self.providers)
+
+    def close(self):
+        for provider in self.providers:
+            provider.close()
+
+
+def _png_chunk(fout, chunk_type, data):
+    fout.write(struct.pack('>I', len(data)))
+    fout.write(chunk_type)
+    fout.write(data)
+    fout.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _paeth_filter(rows, prev_row):
+    """Apply the PNG Paeth filter to a (height, width * 3) uint8 array.
+
+    prev_row is the row right above the first one (zeros for the first
+    row of the image).
+    """
+    a = numpy.zeros(rows.shape, dtype=numpy.int16)  # left
+    a[:, 3:] = rows[:, :-3]
+    b = numpy.empty(rows.shape, dtype=numpy.int16)  # up
+    b[0] = prev_row
+    b[1:] = rows[:-1]
+    c = numpy.zeros(rows.shape, dtype=numpy.int16)  # upper left
+    c[:, 3:] = b[:, :-3]
+    p = a + b - c
+    pa = numpy.abs(p - a)
+    pb = numpy.abs(p - b)
+    pc = numpy.abs(p - c)
+    predictor = numpy.where((pa <= pb) & (pa <= pc), a,
+                            numpy.where(pb <= pc, b, c))
+    return (rows - predictor).astype(numpy.uint8)
+
+
+def write_png(fout, width, height, bands, compress_level=6):
+    """Write an RGB PNG image whose rows are produced incrementally.
+
+    Params:
+        fout: File object to save the image
+        width, height: size of the image, in pixels
+        bands: iterable of bytes objects with the raw RGB data of
+               consecutive rows (a whole number of rows each), from top to
+               bottom
+        compress_level: zlib compression level, 0-9
+    """
+    stride = width * 3
+    fout.write(b'\x89PNG\r\n\x1a\n')
+    _png_chunk(fout, b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                          8, 2, 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    prev_row = numpy.zeros(stride, dtype=numpy.uint8) if numpy else None
+    for band in bands:
+        nrows = len(band) // stride
+        # filter a few rows at a time to keep temporary arrays small
+        for start in range(0, nrows, 64):
+            end = min(nrows, start + 64)
+            if numpy is not None:
+                rows = numpy.frombuffer(
+                    band, dtype=numpy.uint8, count=(end - start) * stride,
+                    offset=start * stride).reshape(end - start, stride)
+                filtered = numpy.empty((end - start, stride + 1),
+                                       dtype=numpy.uint8)
+                filtered[:, 0] = 4  # Paeth
+                filtered[:, 1:] = _paeth_filter(rows, prev_row)
+                prev_row = rows[-1]
+                data = compressor.compress(filtered.tobytes())
+            else:
+                # no filtering: each row is prefixed with filter type 0
+                data = compressor.compress(b''.join(
+                    b'\x00' + band[i * stride:(i + 1) * stride]
+                    for i in range(start, end)))
+            if data:
+                _png_chunk(fout, b'IDAT', data)
+    _png_chunk(fout, b'IDAT', compressor.flush())
+    _png_chunk(fout, b'IEND', b'')
+
+
+# DDS block compression formats: name -> (FourCC, bytes per 4x4 block)
+DDS_FORMATS = {
+    'bc1': (b'DXT1', 8),
+    'bc3': (b'DXT5', 16),
+}
+
+# Number of rows of 4x4 blocks encoded at once. Bounds the size of the
+# temporary arrays of the DDS encoder.
+DDS_STRIP_ROWS = 16
+
+
+def _expand_565(packed):
+    """Convert packed RGB565 colors to 8-bit RGB, as the GPU does"""
+    r = (packed >> 11) & 0x1f
+    g = (packed >> 5) & 0x3f
+    b = packed & 0x1f
+    return numpy.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4),
+                        (b << 3) | (b >> 2)], axis=-1).astype(numpy.float32)
+
+
+def _encode_color_blocks(colors):
+    """Encode 4x4 blocks of RGB pixels as BC1 color blocks.
+
+    Endpoints are the corners of the bounding box of the block colors,
+    slightly inset, along the diagonal that follows the correlation of
+    the channels. The 4-color mode is always used (color0 > color1), so
+    the result is also valid as the color part of a BC3 block.
+
+    Params:
+        colors: (N, 16, 3) uint8 array
+
+    Returns:
+        (N, 8) uint8 array
+    """
+    colors = colors.astype(numpy.float32)
+    lo = colors.min(axis=1)
+    hi = colors.max(axis=1)
+    inset = (hi - lo) / 16.0
+    lo += inset
+    hi -= inset
+    # For channels varying opposite to the green one, the endpoints must
+    # be taken on the other diagonal of the bounding box.
+    centered = colors - colors.mean(axis=1, keepdims=True)
+    cov = (centered * centered[:, :, 1:2]).sum(axis=1)
+    flip = cov < 0
+    e0 = numpy.where(flip, lo, hi)
+    e1 = numpy.where(flip, hi, lo)
+
+    def pack(e):
+        e = numpy.rint(e).astype(numpy.uint32)
+        return (((e[:, 0] * 31 + 127) // 255) << 11 |
+                ((e[:, 1] * 63 + 127) // 255) << 5 |
+                ((e[:, 2] * 31 + 127) // 255))
+
+    c0 = pack(e0)
+    c1 = pack(e1)
+    swap = c0 < c1
+    c0, c1 = numpy.where(swap, c1, c0), numpy.where(swap, c0, c1)
+    p0 = _expand_565(c0)
+    p1 = _expand_565(c1)
+    palette = numpy.stack([p0, p1, (2 * p0 + p1) / 3, (p0 + 2 * p1) / 3],
+                          axis=1)
+    dist = ((colors[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=3)
+    indices = dist.argmin(axis=2).astype(numpy.uint32)
+    # a single color: color0 == color1 would select the 3-color mode, in
+    # which index 0 is still color0
+    indices[c0 == c1] = 0
+    bits = (indices << (2 * numpy.arange(16, dtype=numpy.uint32))).sum(
+        axis=1, dtype=numpy.uint32)
+
+    out = numpy.empty((len(colors), 8), dtype=numpy.uint8)
+    out[:, 0:2] = c0.astype('<u2').view(numpy.uint8).reshape(-1, 2)
+    out[:, 2:4] = c1.astype('<u2').view(numpy.uint8).reshape(-1, 2)
+    out[:, 4:8] = bits.astype('<u4').view(numpy.uint8).reshape(-1, 4)
+    return out
+
+
+def _encode_alpha_blocks(alpha):
+    """Encode 4x4 blocks of alpha values as BC3 alpha blocks.
+
+    Params:
+        alpha: (N, 16) uint8 array
+
+    Returns:
+        (N, 8) uint8 array
+    """
+    a0 = alpha.max(axis=1).astype(numpy.int32)
+    a1 = alpha.min(axis=1).astype(numpy.int32)
+    # 8-alpha mode (a0 > a1): a0, a1, then 6 interpolated values
+    weights = numpy.array([7, 0, 6, 5, 4, 3, 2, 1], dtype=numpy.int32)
+    palette = (weights * a0[:, None] + (7 - weights) * a1[:, None]) // 7
+    dist = numpy.abs(alpha.astype(numpy.int32)[:, :, None] -
+                     palette[:, None, :])
+    indices = dist.argmin(axis=2).astype(numpy.uint64)
+    indices[a0 == a1] = 0
+    bits = (indices << (3 * numpy.arange(16, dtype=numpy.uint64))).sum(
+        axis=1, dtype=numpy.uint64)
+
+    out = numpy.empty((len(alpha), 8), dtype=numpy.uint8)
+    out[:, 0] = a0
+    out[:, 1] = a1
+    out[:, 2:8] = bits.astype('<u8').view(numpy.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+
+def _encode_dds_level(im, compression):
+    """Yield the compressed blocks of one mipmap level, strip by strip"""
+    channels = 4 if compression == 'bc3' else 3
+    pixels = numpy.asarray(im.convert('RGBA' if channels == 4 else 'RGB'))
+    height, width = pixels.shape[:2]
+    # Pad to whole blocks by repeating the last row/column
+    pixels = numpy.pad(pixels, ((0, -height % 4), (0, -width % 4), (0, 0)),
+                       mode='edge')
+    bwidth = pixels.shape[1] // 4
+    for y in range(0, pixels.shape[0], 4 * DDS_STRIP_ROWS):
+        strip = pixels[y:y + 4 * DDS_STRIP_ROWS]
+        bheight = strip.shape[0] // 4
+        blocks = strip.reshape(bheight, 4, bwidth, 4, channels) \
+                      .transpose(0, 2, 1, 3, 4).reshape(-1, 16, channels)
+        color = _encode_color_blocks(blocks[:, :, :3])
+        if compression == 'bc3':
+            yield numpy.hstack([_encode_alpha_blocks(blocks[:, :, 3]),
+                                color]).tobytes()
+        else:
+            yield color.tobytes()
+
+
+def write_dds(fout, im, compression='bc1', mipmaps=True):
+    """Write an image as a block-compressed DDS file.
+
+    Params:
+        fout: File object to save the image
+        im: PIL image
+        compression: 'bc1' (DXT1) or 'bc3' (DXT5), see DDS_FORMATS
+        mipmaps: if True, also write the full chain of mipmaps, down to 1x1
+    """
+    if numpy is None:
+        raise RuntimeError('NumPy is required to write DDS files')
+    fourcc, block_size = DDS_FORMATS[compression]
+    width, height = im.size
+    levels = [im]
+    while mipmaps and levels[-1].size != (1, 1):
+        w, h = levels[-1].size
+        levels.append(levels[-1].resize((max(1, w // 2), max(1, h // 2)),
+                                        Image.BOX))
+
+    # DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT | DDSD_LINEARSIZE
+    flags = 0x1 | 0x2 | 0x4 | 0x1000 | 0x80000
+    caps = 0x1000               # DDSCAPS_TEXTURE
+    if mipmaps:
+        flags |= 0x20000        # DDSD_MIPMAPCOUNT
+        caps |= 0x8 | 0x400000  # DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+    linear_size = ((width + 3) // 4) * ((height + 3) // 4) * block_size
+    fout.write(b'DDS ')
+    fout.write(struct.pack('<7I44x', 124, flags, height, width, linear_size,
+                           0, len(levels)))
+    # DDS_PIXELFORMAT, with DDPF_FOURCC
+    fout.write(struct.pack('<2I4s20x', 32, 0x4, fourcc))
+    fout.write(struct.pack('<I16x', caps))
+    for level in levels:
+        for data in _encode_dds_level(level, compression):
+            fout.write(data)
+
+
+def get_format_path(outpath, fmt):
+    """Return the path of the 'fmt' version of the orthophoto at outpath"""
+    return os.path.splitext(outpath)[0] + '.' + fmt
+
+
+def assemble_orthophoto(ftiles, outpath, tnum=(1,1), formats=('png',),
+                        dds_compression='bc1', low_memory=False, levels=(),
+                        png_compression=6):
+    """Assemble the tiles of a bucket and encode the orthophoto.
+
+    The files are written under temporary names next to their final
+    location; commit_orthophoto() gives them their final names. This
+    function is self-contained, so that it can run in a worker process.
+
+    Params:
+        ftiles: paths of the tiles, first cols, then rows
+        outpath: path of the PNG orthophoto. Other formats are written next
+                 to it, with their own extension.
+        tnum: (cols,rows) number of tiles in the bucket
+        formats: output formats, among 'png' and 'dds'
+        dds_compression: block compression of DDS files, see DDS_FORMATS
+        low_memory: if True and formats is ('png',), assemble the image one
+                    row of tiles at a time
+        levels: (factor, outpath) pairs, for lower resolution versions of
+                the orthophoto, downsampled by an integer factor
+        png_compression: zlib compression level of PNG files, 0-9. Level 1
+                         is several times faster than the default 6, for
+                         files slightly larger
+
+    Returns:
+        A list of (temporary path, final path) pairs.
+    """
+    written = []
+    if low_memory and tuple(formats) == ('png',) and not levels:
+        logging.info('Joining tiles to %s', outpath)
+        # Tiles are decoded while the PNG is encoded: leave their time out
+        before = METRICS.total('decode') + METRICS.total('paste')
+        start = time.perf_counter()
+        with open(outpath + '.tmp', 'wb') as f:
+            fout = TimedFile(f)
+            ImageProvider._join_streaming(fout, ftiles=ftiles, tnum=tnum,
+                                          compress_level=png_compression)
+        _observe_write(start, fout, METRICS.total('decode') +
+                       METRICS.total('paste') - before)
+        return [(outpath + '.tmp', outpath)]
+
+    im = ImageProvider._assemble(ftiles, tnum=tnum)
+    for factor, level_outpath in [(1, outpath)] + list(levels):
+        # Image.reduce() averages factor x factor blocks of pixels
+        if factor > 1:
+            with METRICS.time('reduce'):
+                level_im = im.reduce(factor)
+        else:
+            level_im = im
+        written += _write_orthophoto(level_im, level_outpath, formats,
+                                     dds_compression, png_compression)
+    return written
+
+
+def _write_orthophoto(im, outpath, formats, dds_compression, png_compression):
+    """Encode an image in each of formats, under temporary names next to
+    outpath. Returns a list of (temporary path, final path) pairs"""
+    written = []
+    for fmt in formats:
+        path = get_format_path(outpath, fmt)
+        logging.info('Writing %s', path)
+        start = time.perf_counter()
+        with open(path + '.tmp', 'wb') as f:
+            fout = TimedFile(f)
+            if fmt == 'dds':
+                write_dds(fout, im, dds_compression)
+            else:
+                im.save(fout, format='PNG', compress_level=png_compression)
+        _observe_write(start, fout)
+        written.append((path + '.tmp', path))
+    return written
+
+
+def _is_transparent(im):
+    """Whether an image is fully transparent. Images without an alpha
+    channel are not, and are not decoded"""
+    if im.mode not in ('RGBA', 'LA', 'PA') and 'transparency' not in im.info:
+        return False
+    return im.convert('RGBA').getextrema()[3][1] == 0
+
+
+def has_no_data(ftiles):
+    """Whether all the tiles of a bucket are fully transparent, which is
+    how some providers answer outside of their coverage. The check stops
+    at the first tile with data"""
+    for path in ftiles:
+        with Image.open(path) as tile:
+            if not _is_transparent(tile):
+                return False
+    return True
+
+
+def _get_tile_stats(path):
+    """Return the (mean, stddev) of the RGB bands of a downsampled view of
+    a tile, or None if the tile is fully transparent"""
+    with Image.open(path) as tile:
+        # JPEG tiles are decoded directly at a fraction of their size
+        tile.draft('RGB', (UNIFORM_VIEW, UNIFORM_VIEW))
+        if _is_transparent(tile):
+            return None
+        im = tile.convert('RGB')
+        factor = min(im.size) // UNIFORM_VIEW
+        if factor > 1:
+            # averages blocks of pixels, which smooths noise and waves out
+            im = im.reduce(factor)
+        stat = ImageStat.Stat(im)
+        return stat.mean, stat.stddev
+
+
+def get_uniform_color(ftiles, threshold=UNIFORM_THRESHOLD):
+    """Check whether the tiles of a bucket all have about the same colour,
+    like the sea, or the blank images some providers return outside of
+    their coverage.
+
+    The tiles are checked one by one, and the first one that is not
+    uniform ends the check, so that a bucket with land in it costs one
+    extra decoding of a tile at most. Fully transparent tiles (no data)
+    match any colour, but have none: a bucket needs at least one tile with
+    data to have a colour.
+
+    Params:
+        ftiles: paths of the tiles of the bucket
+        threshold: maximum standard deviation of the bands of a tile, and
+                   maximum difference between the mean colours of the tiles
+
+    Returns:
+        The (r, g, b) colour of the bucket, None if it is not uniform, or
+        NO_DATA if all its tiles are fully transparent.
+    """
+    colors = []
+    for path in ftiles:
+        stats = _get_tile_stats(path)
+        if stats is None:
+            continue
+        mean, stddev = stats
+        if max(stddev) > threshold:
+            return None
+        colors.append(mean)
+        if any(max(band) - min(band) > threshold for band in zip(*colors)):
+            return None
+    if not colors:
+        return NO_DATA
+    return tuple(round(sum(band) / len(band)) for band in zip(*colors))
+
+
+def build_orthophoto(ftiles, outpath, uniform='full',
+                     uniform_threshold=UNIFORM_THRESHOLD, **options):
+    """Assemble the orthophoto of a bucket with assemble_orthophoto(),
+    unless its tiles are uniform (see get_uniform_color()). Nothing is
+    written for buckets with no data at all, whatever the policy.
+
+    Params:
+        ftiles, outpath, options: see assemble_orthophoto()
+        uniform: what to do with uniform buckets, among UNIFORM_POLICIES:
+                 'full' only checks for no data (see has_no_data()) and
+                 writes the full orthophoto,
+                 'tiny' writes a UNIFORM_SIZE orthophoto of their colour,
+                 'skip' writes nothing
+        uniform_threshold: see get_uniform_color()
+
+    Returns:
+        (written, color): the files written, see assemble_orthophoto(),
+        and the colour of the bucket if it is uniform, NO_DATA if it has
+        no data, else None.
+    """
+    with METRICS.time('uniform_check'):
+        if uniform == 'full':
+            color = NO_DATA if has_no_data(ftiles) else None
+        else:
+            color = get_uniform_color(ftiles, uniform_threshold)
+    if color is None:
+        return assemble_orthophoto(ftiles, outpath, **options), None
+    if color == NO_DATA:
+        METRICS.count('no_data_buckets')
+        logging.info('Bucket of %s has no data, skipped', outpath)
+        return [], NO_DATA
+    METRICS.count('uniform_buckets')
+    logging.info('Bucket of %s is uniform, of colour %s', outpath, color)
+    if uniform == 'skip':
+        return [], color
+    im = Image.new('RGB', (UNIFORM_SIZE, UNIFORM_SIZE), color)
+    written = []
+    for factor, path in [(1, outpath)] + list(options.get('levels', ())):
+        written += _write_orthophoto(im, path,
+                                     options.get('formats', ('png',)),
+                                     options.get('dds_compression', 'bc1'),
+                                     options.get('png_compression', 6))
+    return written, color
+
+
+def _observe_write(start, fout, excluded=0.0):
+    """Record the time spent encoding and writing an orthophoto to the
+    TimedFile fout since 'start', less 'excluded' seconds"""
+    METRICS.observe('encode', time.perf_counter() - start - fout.seconds -
+                    excluded)
+    METRICS.observe('file_write', fout.seconds)
+    METRICS.count('bytes_written', fout.bytes)
+
+
+def commit_orthophoto(written):
+    """Give the files written by assemble_orthophoto() their final names"""
+    with METRICS.time('commit'):
+        for tmp_path, path in written:
+            os.replace(tmp_path, path)
+
+
+def convert_png_to_dds(path, compression='bc1'):
+    """Write a DDS version of the PNG orthophoto at path.
+
+    The DDS file is written under a temporary name first, so that an
+    interrupted conversion never leaves a truncated DDS file behind.
+
+    Returns:
+        The path of the DDS file.
+    """
+    dds_path = get_format_path(path, 'dds')
+    tmp_path = dds_path + '.tmp'
+    with Image.open(path) as im:
+        with METRICS.time('decode'):
+            im.load()
+        start = time.perf_counter()
+        with open(tmp_path, 'wb') as f:
+            fout = TimedFile(f)
+            write_dds(fout, im, compression)
+        _observe_write(start, fout)
+    os.replace(tmp_path, dds_path)
+    return dds_path
+
+
+def convert_tree_to_dds(root, compression='bc1', jobs=None):
+    """Convert all the PNG files under root that have no DDS version yet.
+
+    The conversions run in parallel in a pool of 'jobs' processes (one per
+    CPU by default).
+    """
+    todo = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        names = set(filenames)
+        for name in filenames:
+            if name.endswith('.png') and \
+               get_format_path(name, 'dds') not in names:
+                todo.append(os.path.join(dirpath, name))
+    logging.info('%d PNG files to convert to DDS under %s', len(todo), root)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for n, (dds_path, metrics) in enumerate(executor.map(
+                _run_with_metrics, [convert_png_to_dds] * len(todo), todo,
+                [compression] * len(todo)), 1):
+            METRICS.merge(metrics)
+            logging.info('[%d/%d] %s', n, len(todo), dds_path)
+
+
+def get_output_path(scenery_folder, bucket):
+    """Return the path of the orthophoto for a bucket in a scenery folder"""
+    return os.path.join(os.path.abspath(scenery_folder), 'Orthophotos',
+                        bucket.get_base_path(),
+                        str(bucket.get_index()) + '.png')
+
+
+def get_bucket_outputs(args, bucket):
+    """Return where the orthophoto(s) of a bucket go, from the command line.
+
+    Returns:
+        A (outpath, levels) tuple, see ImageProvider.download(). With
+        --levels, each level goes to its own scenery folder (see
+        --level_folder), and outpath is the one of the highest level.
+    """
+    if not args['levels']:
+        return get_output_path(args['scenery_folder'], bucket), []
+    cols = sorted(args['levels'], reverse=True)
+    paths = [get_output_path(args['level_folder'].format(
+                 scenery_folder=args['scenery_folder'], cols=c), bucket)
+             for c in cols]
+    return paths[0], [(cols[0] // c, path)
+                      for c, path in zip(cols[1:], paths[1:])]
+
+
+MANIFEST_NAME = 'manifest.jsonl'
+# Validators of the tiles of the orthophotos, for --refresh
+VALIDATORS_NAME = 'validators.jsonl'
+
+# Value of the settings missing from the entries written by older versions
+MANIFEST_DEFAULTS = {'tile_format': 'png'}
+
+orthophoto_cre = re.compile(r'^(\d+)\.(png|dds)$')
+
+
+class OrthophotoIndex:
+    """The orthophotos present in the Orthophotos/ directory of a scenery
+    folder, and the settings they were made with.
+
+    Files are listed with os.scandir(), one 1x1 degree directory at a
+    time and only once, rather than stat'ed one by one. The settings
+    (provider, theight, cols...) come from the manifest, a JSON Lines file
+    in the Orthophotos/ directory, to which a line is appended each time an
+    orthophoto is written; the last line of a bucket wins.
+
+    The validators of the tiles of the orthophotos (see --refresh) are
+    kept in another JSON Lines file next to the manifest, which is only
+    read when they are needed, see get_tiles().
+    """
+
+    def __init__(self, root):
+        """Construct an OrthophotoIndex.
+
+        Params:
+            root: the Orthophotos/ directory
+        """
+        self.root = root
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.validators_path = os.path.join(root, VALIDATORS_NAME)
+        # bucket index -> set of formats present on disk
+        self.present = {}
+        # bucket index -> last manifest entry
+        self.entries = self._load(self.manifest_path)
+        # bucket index -> last validators entry, loaded by get_tiles()
+        self._tiles = None
+        self._scanned = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(path):
+        """Read a JSON Lines file of entries by bucket index, and compact
+        it if most of its lines were superseded"""
+        entries = {}
+        lines = 0
+        try:
+            with open(path) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['index']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # e.g. a line cut short by a crash
+                        logging.warning('Ignoring invalid line %d of %s',
+                                        lines, path)
+        except FileNotFoundError:
+            return entries
+        if lines > 1000 and lines > 2 * len(entries):
+            OrthophotoIndex._compact(path, entries)
+        return entries
+
+    @staticmethod
+    def _compact(path, entries):
+        """Rewrite a JSON Lines file with only the last entry of each
+        bucket"""
+        logging.debug('Compacting %s', path)
+        with open(path + '.tmp', 'w') as f:
+            for entry in entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def _scan(self, base_path):
+        if base_path in self._scanned:
+            return
+        self._scanned.add(base_path)
+        try:
+            with os.scandir(os.path.join(self.root, base_path)) as it:
+                for entry in it:
+                    m = orthophoto_cre.match(entry.name)
+                    if m:
+                        self.present.setdefault(int(m.group(1)), set()).add(
+                            m.group(2))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, bucket, formats=('png',)):
+        """Whether all the requested formats of the orthophoto of a bucket
+        are present, or the bucket was skipped as uniform (--uniform skip)
+        or for having no data"""
+        entry = self.entries.get(bucket.get_index())
+        if entry is not None and 'uniform' in entry and not entry['formats']:
+            return True
+        self._scan(bucket.get_base_path())
+        present = self.present.get(bucket.get_index(), ())
+        return all(fmt in present for fmt in formats)
+
+    def is_stale(self, bucket, settings, max_age=None):
+        """Whether the orthophoto of a bucket was made with other settings,
+        or more than max_age seconds ago, according to the manifest.
+
+        Orthophotos missing from the manifest (e.g. made by hand, or by an
+        older version of creator.py) are never stale.
+        """
+        entry = self.entries.get(bucket.get_index())
+        if entry is None:
+            return False
+        if any(entry.get(k, MANIFEST_DEFAULTS.get(k)) != v
+               for k, v in settings.items()):
+            return True
+        return max_age is not None and time.time() - entry['time'] > max_age
+
+    def record(self, bucket, formats=('png',), **settings):
+        """Append the settings an orthophoto was just written with to the
+        manifest"""
+        entry = dict(index=bucket.get_index(), formats=list(formats),
+                     time=round(time.time()), **settings)
+        with self._lock:
+            self.entries[entry['index']] = entry
+            self.present.setdefault(entry['index'], set()).update(formats)
+            with open(self.manifest_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def get_tiles(self, bucket):
+        """Return the recorded validators of the tiles of the orthophoto of
+        a bucket, see record_tiles(), or None"""
+        with self._lock:
+            if self._tiles is None:
+                self._tiles = self._load(self.validators_path)
+            entry = self._tiles.get(bucket.get_index())
+        return entry['tiles'] if entry is not None else None
+
+    def record_tiles(self, bucket, tiles):
+        """Append the validators of the tiles an orthophoto was just made
+        of, see ImageProvider.pop_validators()"""
+        entry = {'index': bucket.get_index(), 'tiles': tiles}
+        with self._lock:
+            if self._tiles is not None:
+                self._tiles[entry['index']] = entry
+            with open(self.validators_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def get_orthophoto_root(outpath):
+    """Return the Orthophotos/ directory an orthophoto path is in"""
+    return os.path.dirname(os.path.dirname(os.path.dirname(outpath)))
+
+
+def get_orthophoto_settings(args, cols=None, provider=None):
+    """The settings recorded in the manifest, from the command line.
+    provider is the name of the provider actually used, with --provider
+    auto"""
+    return {'provider': provider or args['provider'], 'theight': args['theight'],
+            'cols': cols or args['cols'], 'tile_format': args['tile_format']}
+
+
+def record_orthophotos(indexes, args, bucket, outpath, levels, color=None,
+                       provider=None, tiles=None):
+    """Record in the manifests the orthophotos just written for a bucket.
+
+    Params:
+        indexes: dict of OrthophotoIndex by Orthophotos/ directory, filled
+                 as needed
+        args: command line options
+        bucket, outpath, levels: see ImageProvider.download()
+        color: the colour of the bucket if it is uniform, or NO_DATA. With
+               --uniform skip, or for NO_DATA, no file was written for it
+        provider: name of the provider the bucket was downloaded from, see
+                  get_orthophoto_settings()
+        tiles: validators of the tiles of the bucket, see
+               ImageProvider.pop_validators(). Recorded for the full
+               resolution orthophoto only, and only with --refresh
+    """
+    formats = OUTPUT_FORMATS[args['format']]
+    settings = {}
+    if color == NO_DATA:
+        settings['uniform'] = NO_DATA
+        formats = ()
+    elif color is not None:
+        settings['uniform'] = list(color)
+        if args['uniform'] == 'skip':
+            formats = ()
+    for factor, path in [(1, outpath)] + list(levels):
+        root = get_orthophoto_root(path)
+        if root not in indexes:
+            indexes[root] = OrthophotoIndex(root)
+        settings.update(get_orthophoto_settings(args, args['cols'] // factor,
+                                                provider))
+        indexes[root].record(bucket, formats, **settings)
+        if factor == 1 and args['refresh'] and tiles and any(tiles):
+            indexes[root].record_tiles(bucket, tiles)
+
+
+def get_download_options(args):
+    """Keyword arguments for ImageProvider.download() from the command line"""
+    return {
+        'tnum': (args['cols'], args['cols']),
+        'theight': args['theight'],
+        'dry_run': args['dry_run'],
+        'low_memory': args['low_memory'],
+        'formats': OUTPUT_FORMATS[args['format']],
+        'dds_compression': args['dds_compression'],
+        'png_compression': args['png_compression'],
+        'uniform': args['uniform'],
+        'uniform_threshold': args['uniform_threshold'],
+    }
+
+
+def _init_worker(log_level):
+    """Initializer of the worker processes of BucketPipeline"""
+    logging.basicConfig(level=log_level)
+
+
+class BucketPipeline:
+    """Download, assemble and write the orthophotos of many buckets.
+
+    The work is split in three stages connected by bounded queues, so
+    that the network and the CPUs are kept busy at the same time:
+
+     - network: 'fetchers' threads download the tiles of the buckets to
+       the cache, through the shared connection pool of the provider;
+     - CPU: a pool of 'jobs' processes decodes and assembles the tiles
+       and encodes the orthophotos (see assemble_orthophoto());
+     - writer: a thread moves the finished files into place in the
+       Orthophotos/ directory and removes the assembled tiles from cache.
+
+    At most 'max_pending' downloaded buckets wait for a worker process,
+    and at most 'jobs' + 1 buckets are being assembled at any time, so
+    memory and cache use do not grow with the number of buckets.
+    """
+
+    def __init__(self, provider, cache_dir, download_options, jobs=None,
+                 fetchers=None, max_pending=None, on_written=None,
+                 revalidate=None, on_unchanged=None):
+        """Construct a BucketPipeline.
+
+        Params:
+            provider: ImageProvider (or AutoProvider) the tiles are
+                      downloaded from
+            cache_dir: directory where downloaded tiles are stored before
+                       they can be assembled
+            download_options: keyword arguments of ImageProvider.download()
+            jobs: number of worker processes. Defaults to the number of CPUs
+            fetchers: number of buckets downloaded at the same time.
+                      Defaults to the provider's max_connections
+            max_pending: maximum number of downloaded buckets waiting for a
+                         worker process. Defaults to 2 * jobs
+            on_written: function called with each job whose files are in
+                        place, and the colour of the bucket if it is
+                        uniform (see build_orthophoto()), in the writer
+                        thread
+            revalidate: dict of the recorded validators of the tiles of
+                        the buckets (by index) to make again only if their
+                        tiles changed, see ImageProvider.revalidate_tiles()
+            on_unchanged: function called with each job of 'revalidate'
+                          whose tiles did not change, in a fetch thread
+        """
+        self.provider = provider
+        self.cache_dir = cache_dir
+        self.options = dict(download_options)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.fetchers = fetchers or provider.max_connections
+        self.max_pending = max_pending or 2 * self.jobs
+        self.on_written = on_written
+        self.revalidate = revalidate or {}
+        self.on_unchanged = on_unchanged
+
+    def run(self, jobs):
+        """Process a list of buckets.
+
+        Params:
+            jobs: list of (bucket, outpath, levels) tuples, see
+                  ImageProvider.download()
+
+        Returns:
+            The jobs that could not be processed.
+        """
+        tnum = self.options['tnum']
+        theight = self.options['theight']
+        dry_run = self.options['dry_run']
+        assemble_options = {k: self.options[k] for k in
+                            ('tnum', 'formats', 'dds_compression',
+                             'low_memory', 'png_compression', 'uniform',
+                             'uniform_threshold')}
+
+        todo = queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        fetched = queue.Queue(maxsize=self.max_pending)
+        assembled = queue.Queue()
+        slots = threading.Semaphore(self.jobs + 1)
+        failed = []
+        progress = {'written': 0}
+
+        def fetch():
+            try:
+                while True:
+                    try:
+                        job = todo.get_nowait()
+                    except queue.Empty:
+                        break
+                    item = fetch_job(job)
+                    if item is not None:
+                        fetched.put(item)
+            finally:
+                fetched.put(None)
+
+        def fetch_job(job):
+            bucket = job[0]
+            try:
+                provider = self.provider.select(bucket)
+                if provider is None:
+                    logging.warning('No provider covers bucket %s',
+                                    bucket.get_index())
+                    failed.append(job)
+                    return None
+                validators = self.revalidate.get(bucket.get_index())
+                if validators is not None and not dry_run and \
+                        not provider.revalidate_tiles(
+                            bucket, self.cache_dir, validators,
+                            tnum=tnum, theight=theight, orthophoto=job[1]):
+                    logging.info('Bucket %s has not changed',
+                                 bucket.get_index())
+                    METRICS.count('buckets_unchanged')
+                    if self.on_unchanged is not None:
+                        self.on_unchanged(job)
+                    return None
+                ftiles = provider.fetch_tiles(
+                    bucket, self.cache_dir, tnum=tnum, theight=theight,
+                    dry_run=dry_run)
+            except TileDownloadError as e:
+                logging.warning('%s. Deferring bucket %s', e,
+                                bucket.get_index())
+                failed.append(job)
+                return None
+            except Exception as e:
+                logging.error('Could not download bucket %s: %s',
+                              bucket.get_index(), e)
+                failed.append(job)
+                return None
+            return job, ftiles, provider
+
+        def write():
+            while True:
+                item = assembled.get()
+                if item is None:
+                    break
+                (bucket, outpath, levels), ftiles, provider, future = item
+                try:
+                    (written, color), metrics = future.result()
+                    METRICS.merge(metrics)
+                    commit_orthophoto(written)
+                    provider.release_tiles(ftiles)
+                    if self.on_written is not None:
+                        self.on_written((bucket, outpath, levels), color)
+                    METRICS.count('buckets_written')
+                    progress['written'] += 1
+                    if written:
+                        logging.info('[%d/%d] Bucket %s written to %s',
+                                     progress['written'], len(jobs),
+                                     bucket.get_index(), outpath)
+                    else:
+                        logging.info('[%d/%d] Bucket %s %s, skipped',
+                                     progress['written'], len(jobs),
+                                     bucket.get_index(),
+                                     'has no data' if color == NO_DATA
+                                     else 'is uniform')
+                except Exception as e:
+                    logging.error('Could not assemble bucket %s: %s',
+                                  bucket.get_index(), e)
+                    failed.append((bucket, outpath, levels))
+                finally:
+                    slots.release()
+
+        fetch_threads = [threading.Thread(target=fetch, daemon=True)
+                         for _ in range(min(self.fetchers, len(jobs)))]
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        with ProcessPoolExecutor(
+                max_workers=self.jobs,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(logging.getLogger().getEffectiveLevel(),)) \
+                as executor:
+            for thread in fetch_threads:
+                thread.start()
+            running = len(fetch_threads)
+            while running:
+                item = fetched.get()
+                if item is None:
+                    running -= 1
+                    continue
+                (bucket, outpath, levels), ftiles, provider = item
+                if dry_run:
+                    continue
+                with METRICS.time('worker_wait'):
+                    slots.acquire()
+                future = executor.submit(_run_with_metrics,
+                                         build_orthophoto, ftiles,
+                                         outpath, levels=levels,
+                                         **assemble_options)
+                future.add_done_callback(
+                    lambda f, item=item: assembled.put(item + (f,)))
+        # leaving the with block waited for all the worker processes
+        assembled.put(None)
+        writer.join()
+        return failed
+
+
+def download_region(provider, buckets, args):
+    """Download the orthophotos of many buckets, see BucketPipeline.
+
+    Buckets whose orthophoto already exists are skipped, unless
+    --overwrite was given, or --sync was given and the orthophoto is stale
+    (see OrthophotoIndex.is_stale()). With --refresh, the tiles of the
+    existing orthophotos are checked with conditional requests instead, and
+    only the orthophotos whose tiles changed are made again (see
+    ImageProvider.revalidate_tiles()). Buckets that no provider covers
+    (with --provider auto) are skipped. Buckets whose tiles could not all
+    be downloaded are deferred to the end of the run and tried once more.
+
+    Returns:
+        The list of buckets that could not be downloaded.
+    """
+    formats = OUTPUT_FORMATS[args['format']]
+    max_age = args['max_age'] * 86400 if args['max_age'] is not None else None
+    sync = args['sync'] or max_age is not None
+    indexes = {}
+    jobs = []
+    dirs = set()
+    stale = 0
+    uncovered = 0
+    used = collections.Counter()
+    # bucket index -> recorded validators of its tiles, with --refresh
+    refresh = {}
+    tnum = (args['cols'], args['cols'])
+    for bucket in buckets:
+        selected = provider.select(bucket)
+        if selected is None:
+            uncovered += 1
+            continue
+        full_out_path, levels = get_bucket_outputs(args, bucket)
+        paths = [(1, full_out_path)] + list(levels)
+        if not (args['dry_run'] or args['overwrite']):
+            done = True
+            for factor, path in paths:
+                root = get_orthophoto_root(path)
+                if root not in indexes:
+                    indexes[root] = OrthophotoIndex(root)
+                if not indexes[root].exists(bucket, formats):
+                    done = False
+                elif sync and indexes[root].is_stale(
+                        bucket, get_orthophoto_settings(
+                            args, args['cols'] // factor, selected.name),
+                        max_age):
+                    stale += 1
+                    done = False
+            tiles = None
+            if done and args['refresh']:
+                root = get_orthophoto_root(full_out_path)
+                tiles = indexes[root].get_tiles(bucket)
+                if (tiles is None or len(tiles) != tnum[0] * tnum[1] or
+                        indexes[root].is_stale(bucket, get_orthophoto_settings(
+                            args, provider=selected.name))):
+                    tiles = None
+            if done and tiles is None:
+                logging.debug('%s already exists, skipping', full_out_path)
+                continue
+            if done:
+                refresh[bucket.get_index()] = tiles
+        for factor, path in paths:
+            dir_out_path = os.path.dirname(path)
+            if not args['dry_run'] and dir_out_path not in dirs:
+                os.makedirs(dir_out_path, exist_ok=True)
+                dirs.add(dir_out_path)
+        jobs.append((bucket, full_out_path, levels))
+        used[selected.name] += 1
+    logging.info('%d buckets in the requested region, %d to download',
+                 len(buckets), len(jobs))
+    if stale:
+        logging.info('%d orthophotos are stale', stale)
+    if refresh:
+        logging.info('%d orthophotos will be made again if their tiles '
+                     'changed', len(refresh))
+    if uncovered:
+        logging.warning('%d buckets are not covered by any provider, '
+                        'skipping them', uncovered)
+    if len(used) > 1:
+        logging.info('Providers: %s', ', '.join(
+            '%s (%d buckets)' % item for item in used.most_common()))
+
+    def on_written(job, color):
+        bucket = job[0]
+        selected = provider.select(bucket)
+        tiles = selected.pop_validators(bucket, tnum, args['theight'])
+        # Tiles that were not modified keep the validators they had
+        previous = refresh.get(bucket.get_index())
+        if previous is not None:
+            tiles = [new or old for new, old in zip(tiles, previous)]
+        record_orthophotos(indexes, args, *job, color=color,
+                           provider=selected.name, tiles=tiles)
+
+    def on_unchanged(job):
+        bucket = job[0]
+        tiles = provider.select(bucket).pop_validators(bucket, tnum,
+                                                       args['theight'])
+        # Tiles sent in full again may come with new validators, e.g. a
+        # server that does not support conditional requests
+        if any(tiles):
+            previous = refresh[bucket.get_index()]
+            indexes[get_orthophoto_root(job[1])].record_tiles(
+                bucket, [new or old for new, old in zip(tiles, previous)])
+
+    if args['mosaic'] and not args['dry_run']:
+        provider.plan_mosaics([job[0] for job in jobs
+                               if job[0].get_index() not in refresh],
+                              tnum, args['theight'])
+
+    pipeline = BucketPipeline(provider, args['cache_dir'],
+                              get_download_options(args), jobs=args['jobs'],
+                              on_written=None if args['dry_run'] else on_written,
+                              revalidate=refresh, on_unchanged=on_unchanged)
+    deferred = pipeline.run(jobs)
+    if deferred:
+        logging.info('Retrying %d deferred buckets', len(deferred))
+        deferred = pipeline.run(deferred)
+    for bucket, full_out_path, levels in deferred:
+        logging.error('Giving up on bucket %s', bucket.get_index())
+    return [job[0] for job in deferred]
+
+
+KNOT = 1.852 / 3600             # km/s
+
+
+class FGPropertyClient:
+    """Read properties from the property server of a running FlightGear
+    (started with --telnet=PORT)."""
+
+    def __init__(self, host, port, timeout=10.0):
+        self.address = (host, port)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, self.timeout)
+        self._file = self._sock.makefile('rb')
+        # In 'data' mode, 'get' answers with the bare value
+        self._sock.sendall(b'data\r\n')
+
+    def get(self, path):
+        """Return the value of a property, as a string"""
+        if self._sock is None:
+            self._connect()
+        try:
+            self._sock.sendall(('get %s\r\n' % path).encode())
+            return self._file.readline().decode().strip()
+        except OSError:
+            self.close()
+            raise
+
+    def get_position(self):
+        """Return the (lat, lon, heading, groundspeed in knots) of the
+        aircraft"""
+        return (float(self.get('/position/latitude-deg')),
+                float(self.get('/position/longitude-deg')),
+                float(self.get('/orientation/heading-deg')),
+                float(self.get('/velocities/groundspeed-kt')))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._file = None
+
+
+class Prefetcher:
+    """Download the orthophotos of the buckets ahead of an aircraft.
+
+    Each position update (see update()) projects the track of the aircraft
+    'lookahead' seconds ahead, and schedules the buckets within 'distance'
+    of it by the time the aircraft will reach them, in a priority queue.
+    Buckets that are no longer ahead of the aircraft are cancelled, unless
+    they are already being downloaded. 'workers' threads take the most
+    urgent bucket from the queue and download it with the ImageProvider,
+    so the tile cache and connection pool are the usual ones.
+    """
+
+    def __init__(self, provider, args, distance, lookahead, workers=2):
+        """Construct a Prefetcher.
+
+        Params:
+            provider: ImageProvider (or AutoProvider) the tiles are
+                      downloaded from
+            args: command line options, see get_bucket_outputs() and
+                  get_download_options()
+            distance: distance from the track, in km
+            lookahead: how far ahead to look, in seconds of flight
+            workers: number of buckets downloaded at the same time
+        """
+        self.provider = provider
+        self.args = args
+        self.distance = distance
+        self.lookahead = lookahead
+        self.workers = workers
+        self.formats = OUTPUT_FORMATS[args['format']]
+        self.position = None
+        # heap of (time the aircraft gets there, bucket index, time queued)
+        self._heap = []
+        self._queued = set()
+        self._in_progress = {}
+        self._done = set()
+        self._indexes = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self.stats = {'written': 0, 'failed': 0, 'cancelled': 0, 'late': 0,
+                      'updates': 0}
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name='prefetch-%d' % i)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.provider.close()
+
+    def _exists(self, bucket):
+        outpath, levels = get_bucket_outputs(self.args, bucket)
+        for path in [outpath] + [path for factor, path in levels]:
+            root = get_orthophoto_root(path)
+            if root not in self._indexes:
+                self._indexes[root] = OrthophotoIndex(root)
+            if not self._indexes[root].exists(bucket, self.formats):
+                return False
+        return True
+
+    def update(self, lat, lon, heading, speed):
+        """Schedule the buckets ahead of a new position of the aircraft.
+
+        Params:
+            lat, lon: position, in degrees
+            heading: true heading, in degrees
+            speed: groundspeed, in knots
+        """
+        now = time.time()
+        # Below a few knots, only look around the aircraft
+        km_per_s = max(speed, 0.0) * KNOT
+        ahead = km_per_s * self.lookahead
+        end = (lat + ahead * math.cos(math.radians(heading)) / KM_PER_DEGREE,
+               lon + ahead * math.sin(math.radians(heading)) / _get_scale(lat))
+        route = [(lat, lon), end] if ahead > 0 else [(lat, lon)]
+        found = _find_buckets_near_route(_get_route_segments(route),
+                                         self.distance)
+        heap = []
+        with self._cond:
+            self.position = {'lat': lat, 'lon': lon, 'heading': heading,
+                             'speed': speed, 'time': now}
+            self.stats['updates'] += 1
+            queued = {index: t for eta, index, t in self._heap}
+            for index, (center, along, bucket) in found.items():
+                if index in self._done or index in self._in_progress:
+                    continue
+                if index not in queued and (self.provider.select(bucket) is None
+                                            or self._exists(bucket)):
+                    self._done.add(index)
+                    continue
+                eta = now + along / km_per_s if km_per_s > 0 else now
+                heap.append((eta, index, queued.get(index, now)))
+            heapq.heapify(heap)
+            cancelled = len(set(queued) - {index for eta, index, t in heap})
+            self.stats['cancelled'] += cancelled
+            self._heap = heap
+            self._cond.notify_all()
+        if cancelled:
+            logging.debug('Cancelled %d buckets behind the aircraft', cancelled)
+
+    def _next(self):
+        """Wait for the most urgent bucket, or return None to stop"""
+        with self._cond:
+            while not self._heap and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            eta, index, queued = heapq.heappop(self._heap)
+            self._in_progress[index] = eta
+            return eta, index, queued
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            eta, index, queued = item
+            METRICS.observe('prefetch_wait', time.time() - queued)
+            bucket = Bucket.from_index(index)
+            outpath, levels = get_bucket_outputs(self.args, bucket)
+            try:
+                for path in [outpath] + [path for factor, path in levels]:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                with METRICS.time('prefetch_build'):
+                    color = self.provider.download(
+                        bucket, outpath, self.args['cache_dir'], levels=levels,
+                        **get_download_options(self.args))
+                with self._cond:
+                    selected = self.provider.select(bucket)
+                    record_orthophotos(
+                        self._indexes, self.args, bucket, outpath, levels,
+                        color=color, provider=selected.name,
+                        tiles=selected.pop_validators(
+                            bucket, (self.args['cols'], self.args['cols']),
+                            self.args['theight']))
+            except Exception as e:
+                logging.error('Could not prefetch bucket %s: %s', index, e)
+                with self._cond:
+                    del self._in_progress[index]
+                    self.stats['failed'] += 1
+                continue
+            # Positive: written before the aircraft got there
+            margin = eta - time.time()
+            with self._cond:
+                del self._in_progress[index]
+                self._done.add(index)
+                self.stats['written'] += 1
+                if margin < 0:
+                    self.stats['late'] += 1
+            if margin >= 0:
+                logging.info('Bucket %s written, %.0f s before the aircraft '
+                             'gets there', index, margin)
+            else:
+                logging.info('Bucket %s written, %.0f s late', index, -margin)
+
+    def status(self):
+        """Return the state of the prefetcher, as a JSON-compatible dict"""
+        now = time.time()
+        with self._cond:
+            status = dict(self.stats, position=self.position,
+                          queue_depth=len(self._heap),
+                          in_progress=sorted(self._in_progress),
+                          next=[{'index': index, 'eta_s': round(eta - now, 1)}
+                                for eta, index, t in heapq.nsmallest(10, self._heap)])
+        stages = METRICS.summary()['stages']
+        status['latency'] = {k: stages[k] for k in ('prefetch_wait', 'prefetch_build')
+                             if k in stages}
+        return status
+
+
+class PrefetchHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP interface of a Prefetcher (self.server.prefetcher).
+
+    GET or POST /position?lat=..&lon=..&heading=..&speed=.. (groundspeed in
+    knots) updates the position of the aircraft. A POST can also send them
+    as a JSON object. GET /status returns the state of the prefetcher.
+    """
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+    def _send_json(self, code, value):
+        data = json.dumps(value).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self, body=None):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/status':
+            self._send_json(200, self.server.prefetcher.status())
+        elif url.path == '/position':
+            values = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+            values.update(body or {})
+            try:
+                position = [float(values[k]) for k in ('lat', 'lon')] + \
+                           [float(values.get(k, 0)) for k in ('heading', 'speed')]
+            except (KeyError, ValueError):
+                self._send_json(400, {'error': 'expected lat, lon, heading and speed'})
+                return
+            self.server.prefetcher.update(*position)
+            self._send_json(200, {'queue_depth': self.server.prefetcher.status()['queue_depth']})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {'error': 'invalid JSON'})
+            return
+        self.do_GET(body)
+
+
+def run_daemon(provider, args):
+    """Prefetch the orthophotos ahead of the aircraft until interrupted.
+
+    The position is polled from FlightGear with --fg_telnet, and can
+    always be sent to the HTTP endpoint on --daemon PORT, which also
+    serves the status.
+    """
+    prefetcher = Prefetcher(provider, args, args['corridor'] / 2,
+                            args['lookahead'] * 60, workers=args['jobs'] or 2)
+    prefetcher.start()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args['daemon']),
+                                             PrefetchHandler)
+    server.daemon_threads = True
+    server.prefetcher = prefetcher
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name='prefetch-http').start()
+    logging.info('Prefetching; status on http://127.0.0.1:%d/status',
+                 server.server_address[1])
+    client = None
+    if args['fg_telnet']:
+        host, port = args['fg_telnet'].rsplit(':', 1)
+        client = FGPropertyClient(host, int(port))
+    try:
+        while True:
+            if client is not None:
+                try:
+                    prefetcher.update(*client.get_position())
+                except (OSError, ValueError) as e:
+                    logging.warning('Cannot read the position from FlightGear: %s', e)
+            time.sleep(args['poll'])
+    except KeyboardInterrupt:
+        logging.info('Stopping')
+    finally:
+        server.shutdown()
+        if client is not None:
+            client.close()
+        prefetcher.stop()
+
+
+def get_parser():
+    """Return the command line parser of creator.py"""
+    parser = argparse.ArgumentParser(description="Download photoscenery for a tile. Provide either index OR lon and lat, or one or more bounding boxes")
     parser.add_argument('--index', type=int, required=False, help="FG tile index to download. It has preference on lat,lon")
     parser.add_argument('--lon', type=float, required=False, help="Longitude included inside the tile to download. Ignored if an index is provided")
     parser.add_argument('--lat', type=float, required=False, help="Latitude included inside the tile to download. Ignored if an index is provided")
+    parser.add_argument('--bbox', type=parse_bbox, action='append', metavar='LAT_LL,LON_LL,LAT_UR,LON_UR', help="""\
+Download every bucket intersecting this bounding box (LL = lower left, UR =
+upper right corner). Can be given several times to download several regions.
+Use --bbox=... if the first coordinate is negative.""")
+    parser.add_argument('--route', type=load_route, metavar='ROUTE', help="""\
+Download every bucket within --corridor of a route, in order along the route.
+ROUTE is a GPX file, a FlightGear route manager file, or a list of 'lat,lon'
+waypoints separated by semicolons, e.g. --route "47.26,11.34;47.80,13.00".""")
+    parser.add_argument('--corridor', type=float, default=20.0, metavar='KM', help="""\
+Width of the corridor along --route, in kilometres (half of it on each side).
+Defaults to %(default)s""")
+    parser.add_argument('--airport', type=parse_point, action='append', metavar='LAT,LON', help="""\
+Download every bucket within --airport_radius of this point. Can be given
+several times. With --route, the airports are downloaded when the route gets
+there.""")
+    parser.add_argument('--airport_radius', '--airport-radius', type=float, default=10.0, metavar='KM', help="""\
+Radius around --airport, in kilometres. Defaults to %(default)s""")
+    parser.add_argument('--daemon', type=int, metavar='PORT', help="""\
+Keep running, and download the buckets ahead of the aircraft before it gets
+there (within --corridor of its track, --lookahead minutes ahead). The position
+is read from FlightGear with --fg_telnet, and/or sent to
+http://127.0.0.1:PORT/position?lat=..&lon=..&heading=..&speed=.. (groundspeed
+in knots). http://127.0.0.1:PORT/status shows the queue.""")
+    parser.add_argument('--fg_telnet', '--fg-telnet', metavar='HOST:PORT', help="""\
+With --daemon, poll the position of the aircraft from the property server of
+FlightGear, started with --telnet=PORT""")
+    parser.add_argument('--lookahead', type=float, default=10.0, metavar='MINUTES', help="""\
+With --daemon, how far ahead of the aircraft to download, in minutes of flight.
+Defaults to %(default)s""")
+    parser.add_argument('--poll', type=float, default=5.0, metavar='SECONDS', help="""\
+With --fg_telnet, interval between position updates. Defaults to %(default)s""")
     parser.add_argument('--info_only', '--info-only', dest='info_only', action='store_true', default=False, help="Print bucket information and exit.")
     parser.add_argument('--theight', type=int, required=False, default=2048, help='''
         Height of a tile, in pixels. Defaults to 2048. The final image will have theight*cols pixels. Use only power of two numbers.
         Note that most orthophoto servers will not serve orthophotos with any dimension greater than 4096.
     ''')
     parser.add_argument('--cols', type=int, default=1, help="Number of rows and cols for tiles in a bucket. Use only power of two numbers ")
-    parser.add_argument('--provider', default='ArcGIS', help="Name of the image provider. Currently: ArcGIS (default, covers the whole world), PNOA (Spain), or USGS (United States)")
+    parser.add_argument('--levels', type=parse_levels, metavar='COLS,COLS,...', help="""\
+Write the orthophotos at several resolutions, e.g. --levels 1,2,4. The tiles are
+downloaded once, for the highest number of cols, and the lower resolutions are
+computed from them. Replaces --cols. Each level is written to its own scenery
+folder, see --level_folder""")
+    parser.add_argument('--level_folder', '--level-folder', default=os.path.join('{scenery_folder}', 'cols{cols}'), help="""\
+Scenery folder of each level with --levels. {scenery_folder} is replaced with
+--scenery_folder and {cols} with the cols of the level. Defaults to %(default)s""")
+    parser.add_argument('--provider', default='ArcGIS', help="Name of the image provider. Currently: ArcGIS (default, covers the whole world), PNOA (Spain), USGS (United States), GeoportalPL (Poland), geoservices.bayern.de (Bavaria), or auto: for each bucket, the first of --providers that covers it entirely")
+    parser.add_argument('--providers', type=parse_providers, default=list(AUTO_PROVIDERS), metavar='NAMES', help="Comma-separated providers tried in turn by --provider auto, best first. The last one should cover the whole world: buckets that none covers are skipped. Defaults to %s" % ','.join(AUTO_PROVIDERS))
     parser.add_argument('--dry_run', '--dry-run', dest='dry_run', action='store_true', default=False, help="If set, do not download anything, but show what would be downloaded.")
     parser.add_argument('--verbose', dest='verbose', action='store_true', default=False, help="If set, be verbose")
     parser.add_argument('--scenery_folder', '--scenery-folder', type=str, required=False, default=os.getcwd(), help="Scenery directory, for the output")
@@ -422,17 +3759,190 @@ Clear the tile cache directory (for creator.py) associated to PROVIDER.
 Specify 'ALL' in order to clear the tile cache directories of all providers.
 Only use this option if you really know what you are doing, otherwise you are
 likely to download the same files several times from the same provider.""")
+    parser.add_argument('--cache_size', '--cache-size', type=int, metavar='MB', help="""\
+Keep downloaded tiles in the cache directory after they are assembled, up to
+MB megabytes (the least recently used tiles are deleted first). Assembling the
+same area again, e.g. in another format, then needs no download.""")
+    parser.add_argument('--cache_stats', '--cache-stats', action='store_true', default=False, help="Print the number and size of the tiles kept in the cache directory and exit")
+    parser.add_argument('--refresh', action='store_true', help="""\
+With --bbox or --route, check whether the tiles of the orthophotos that
+already exist changed, with conditional requests, and only make again the
+orthophotos whose tiles changed. Only works for the orthophotos that were
+also downloaded with --refresh, which records the validators (ETag,
+Last-Modified and hash) of their tiles""")
     parser.add_argument('--overwrite', dest='overwrite', action='store_true', default=False, help='Overwrite the orthophoto if it already exists')
-    args = vars(parser.parse_args())
+    parser.add_argument('--connections', type=int, required=False, help="Maximum number of tiles downloaded in parallel. Defaults to a provider-specific value")
+    parser.add_argument('--rate', type=float, required=False, help="Initial number of requests per second. Defaults to a provider-specific value. The rate is lowered automatically if the server is overloaded")
+    parser.add_argument('--retries', type=int, default=5, help="Number of times a failed tile download is retried (default 5)")
+    parser.add_argument('--low_memory', '--low-memory', dest='low_memory', action='store_true', default=False, help="Assemble the orthophoto one row of tiles at a time, so that memory use does not grow with --cols. Only used with --format png")
+    parser.add_argument('--png_compression', '--png-compression', dest='png_compression', type=int, choices=range(10), default=6, metavar='LEVEL', help="zlib compression level of the PNG orthophotos, 0-9 (default 6). Level 1 encodes several times faster, for files about 10%% larger. PNG is lossless at any level")
+    parser.add_argument('--tile_format', '--tile-format', dest='tile_format', choices=sorted(TILE_FORMATS), default='png', help="""\
+Format of the tiles requested to the provider (default png). jpeg tiles are
+several times smaller and faster to download, but lossy. Not all the
+providers support every format""")
+    parser.add_argument('--uniform', choices=UNIFORM_POLICIES, default='full', help="""\
+What to do with the buckets whose tiles all have about the same colour, like
+the sea or the blank images returned outside the coverage of a provider:
+full writes the orthophoto as usual (default, no check of the colour), tiny
+writes a %dx%d orthophoto of that colour, skip writes nothing. Buckets whose
+tiles are all transparent get no orthophoto, whatever the policy. Uniform
+buckets are recorded in the manifest, and skipped buckets are not downloaded again
+unless --overwrite is given""" % (UNIFORM_SIZE, UNIFORM_SIZE))
+    parser.add_argument('--uniform_threshold', '--uniform-threshold', type=float, default=UNIFORM_THRESHOLD, metavar='LEVELS', help="Maximum standard deviation of the colour of a uniform tile, in levels of 0-255 (default %(default)s)")
+    parser.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default='png', help="Format of the orthophotos: png (default), dds (no PNG is written), or both. DDS files need NumPy")
+    parser.add_argument('--dds_compression', '--dds-compression', choices=sorted(DDS_FORMATS), default='bc1', help="Block compression of DDS files: bc1 (DXT1, default) or bc3 (DXT5)")
+    parser.add_argument('--convert_dds', '--convert-dds', metavar='DIR', help="Convert all the PNG orthophotos under DIR that have no DDS version yet, using all CPU cores, and exit")
+    parser.add_argument('--jobs', type=int, required=False, help="Number of processes used for CPU intensive work. Defaults to the number of CPUs")
+    parser.add_argument('--mosaic', action='store_true', help="""\
+With --bbox or --route, download neighbour tiles (of the same or of other
+buckets) with a single request, up to the largest image size the provider
+allows, and cut them apart. This makes fewer requests for the same pixels""")
+    parser.add_argument('--sync', action='store_true', help="""\
+With --bbox, also download again the orthophotos that were made with another
+provider, --theight or --cols, according to the manifest.jsonl file that
+creator.py keeps in the Orthophotos directory""")
+    parser.add_argument('--max_age', '--max-age', type=float, metavar='DAYS', help="""\
+With --bbox, also download again the orthophotos older than DAYS days,
+according to the manifest (implies --sync)""")
+    parser.add_argument('--metrics_json', '--metrics-json', metavar='FILE', help="""\
+At the end of the run, write the time spent in each stage (HTTP, queues,
+decoding, pasting, encoding, writing...) and counters such as bytes downloaded
+and cache hits to FILE, as JSON""")
+    parser.add_argument('--metrics_prom', '--metrics-prom', metavar='FILE', help="""\
+Same as --metrics_json, in the Prometheus text format (e.g. for the textfile
+collector of node_exporter)""")
+    parser.add_argument('--profile', metavar='FILE', help="""\
+Sample the stacks of all threads during the run and write them to FILE, in the
+folded format read by flamegraph.pl or speedscope""")
+    return parser
+
+
+def parse_args(argv=None):
+    """Parse the command line (sys.argv by default) into a dict of options"""
+    args = vars(get_parser().parse_args(argv))
+    if args['levels']:
+        args['cols'] = max(args['levels'])
+    return args
+
+
+def get_provider(args):
+    """Create the ImageProvider selected on the command line, or an
+    AutoProvider with --provider auto
+
+    Raises:
+        ValueError if the provider is unknown, or cannot send --tile_format
+    """
+    cache = None
+    if args['cache_size'] is not None:
+        cache = TileCache(args['cache_dir'], args['cache_size'] * 1000000)
+    elif os.path.exists(os.path.join(args['cache_dir'], TileCache.INDEX_NAME)):
+        # keep the index of an earlier persistent cache up to date
+        cache = TileCache(args['cache_dir'], persistent=False)
+    if args['provider'] == 'auto':
+        return AutoProvider([_get_provider(name, args, cache)
+                             for name in args['providers']])
+    return _get_provider(args['provider'], args, cache)
+
+
+def _get_provider(provider_name, args, cache=None):
+    if provider_name not in URLS:
+        raise ValueError('Unknown provider {}, use one of {} or auto'.format(
+            provider_name, ', '.join(URLS)))
+    provider_options = dict(PROVIDER_OPTIONS.get(provider_name, {}))
+    if args['connections'] is not None:
+        provider_options['max_connections'] = args['connections']
+    if args['rate'] is not None:
+        provider_options['rate'] = args['rate']
+        provider_options['max_rate'] = max(
+            args['rate'], provider_options.get('max_rate', args['rate']))
+    provider_options['max_retries'] = args['retries']
+    provider_options['tile_format'] = args['tile_format']
+    provider_options['cache'] = cache
+    return ImageProvider(provider_name, URLS[provider_name],
+                         **provider_options)
+
+
+def main():
+    args = parse_args()
 
     logging.basicConfig(level=(logging.DEBUG if args['verbose'] else logging.INFO))
 
+    profiler = None
+    if args['profile']:
+        profiler = SamplingProfiler()
+        profiler.start()
+    try:
+        run(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args['profile'])
+            logging.info('Profile written to %s', args['profile'])
+        if args['verbose']:
+            METRICS.log_summary()
+        if args['metrics_json']:
+            METRICS.write_json(args['metrics_json'])
+        if args['metrics_prom']:
+            METRICS.write_prometheus(args['metrics_prom'])
+
+
+def run(args):
+    """Do what the command line asks for, see main()"""
+    if numpy is None and (args['format'] != 'png' or args['convert_dds']):
+        logging.error('NumPy is required to write DDS files. Install it, '
+                      'or use --format png')
+        sys.exit(1)
+
+    if args['convert_dds']:
+        convert_tree_to_dds(args['convert_dds'], args['dds_compression'],
+                            args['jobs'])
+        sys.exit(0)
+
+    if args['cache_stats']:
+        print_cache_stats(args['cache_dir'])
+        sys.exit(0)
+
     if args['clear_cache'] is None:
         cache_cleared = False
     else:
         clear_cache(args['cache_dir'], args['clear_cache'])
         cache_cleared = True
 
+    try:
+        provider = get_provider(args)
+    except ValueError as e:
+        logging.error('%s', e)
+        sys.exit(1)
+
+    if args['daemon'] is not None:
+        run_daemon(provider, args)
+        sys.exit(0)
+
+    if args['bbox'] or args['route'] or args['airport']:
+        regions = [buckets_in_bbox(*bbox) for bbox in args['bbox'] or []]
+        if args['route'] or args['airport']:
+            regions.append(plan_route(args['route'], args['corridor'] / 2,
+                                      args['airport'] or [],
+                                      args['airport_radius']))
+        buckets = []
+        seen = set()
+        for region in regions:
+            for bucket in region:
+                if bucket.get_index() not in seen:
+                    seen.add(bucket.get_index())
+                    buckets.append(bucket)
+        if args['info_only']:
+            for bucket in buckets:
+                print('Bucket: %s. Index: %s' % (bucket, bucket.get_index()))
+            sys.exit(0)
+        failed = download_region(provider, buckets, args)
+        if failed:
+            logging.error('%d buckets could not be downloaded: %s',
+                          len(failed),
+                          ' '.join(str(b.get_index()) for b in failed))
+            sys.exit(1)
+        sys.exit(0)
+
     index = args['index']
     lon = args['lon']
     lat = args['lat']
@@ -445,8 +3955,8 @@ likely to download the same files several times from the same provider.""")
     elif cache_cleared:         # allow using --clear-cache on its own
         sys.exit(0)
     else:
-        logging.error('You gotta give me lon, lat or index (or some other '
-                      'action like --clear-cache)!')
+        logging.error('You gotta give me lon, lat, index or bbox (or some '
+                      'other action like --clear-cache)!')
         sys.exit(1)
 
     print('Bucket: %s. Index: %s' % (bucket, bucket.get_index()))
@@ -456,22 +3966,44 @@ likely to download the same files several times from the same provider.""")
 
 
     # create the output directory
-    dir_out_path = os.path.join(os.path.abspath(args['scenery_folder']), 'Orthophotos', bucket.get_base_path())
+    full_out_path, levels = get_bucket_outputs(args, bucket)
+    paths = [full_out_path] + [path for factor, path in levels]
 
     if not args['dry_run']:
-        os.makedirs(dir_out_path, exist_ok=True)
-    full_out_path = os.path.join(dir_out_path, str(bucket.get_index()) + '.png')
-
-    if not (args['dry_run'] or args['overwrite']) and os.path.exists(full_out_path):
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    indexes = {}
+    for path in paths:
+        root = get_orthophoto_root(path)
+        if root not in indexes:
+            indexes[root] = OrthophotoIndex(root)
+    if not (args['dry_run'] or args['overwrite']) and all(
+            indexes[get_orthophoto_root(path)].exists(
+                bucket, OUTPUT_FORMATS[args['format']]) for path in paths):
         logging.error('Target orthophoto already exists, skipping. Pass --overwrite to override this check.')
         sys.exit(1)
 
-    provider_name = args['provider']
-    provider = ImageProvider(provider_name, URLS[provider_name])
-    provider.download(bucket, full_out_path, args['cache_dir'],
-                      tnum=(args['cols'], args['cols']),
-                      theight=args['theight'], dry_run=args['dry_run'])
-
+    selected = provider.select(bucket)
+    if selected is None:
+        logging.error('No provider covers this bucket. Try other --providers')
+        sys.exit(1)
+    if selected is not provider:
+        logging.info('Downloading from %s', selected.name)
+
+    try:
+        color = provider.download(bucket, full_out_path, args['cache_dir'],
+                                  levels=levels, **get_download_options(args))
+    except TileDownloadError as e:
+        logging.error('%s. Run the same command again to download the '
+                      'missing tiles', e)
+        sys.exit(1)
+    if not args['dry_run']:
+        record_orthophotos(indexes, args, bucket, full_out_path, levels,
+                           color=color, provider=selected.name,
+                           tiles=selected.pop_validators(
+                               bucket, (args['cols'], args['cols']),
+                               args['theight']))
 
 
 if __name__ == '__main__':
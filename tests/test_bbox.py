@@ -0,0 +1,85 @@
+import argparse
+import unittest
+
+import util  # noqa: F401
+import creator
+
+
+class BucketsInBboxTest(unittest.TestCase):
+
+    def check_bbox(self, lat_ll, lon_ll, lat_ur, lon_ur):
+        buckets = creator.buckets_in_bbox(lat_ll, lon_ll, lat_ur, lon_ur)
+        indices = [b.get_index() for b in buckets]
+        self.assertEqual(len(indices), len(set(indices)), 'duplicate buckets')
+        # every point strictly inside the box is in one of the buckets
+        lon_ur_unwrapped = lon_ur + 360.0 if lon_ll > lon_ur else lon_ur
+        steps = 200
+        for i in range(1, steps):
+            lat = lat_ll + (lat_ur - lat_ll) * i / steps
+            for j in range(1, steps):
+                lon = lon_ll + (lon_ur_unwrapped - lon_ll) * j / steps
+                if lon >= 180.0:
+                    lon -= 360.0
+                self.assertIn(creator.Bucket.from_lon_lat(lon, lat).get_index(),
+                              indices, (lon, lat))
+        # and every bucket intersects the box
+        for bucket in buckets:
+            b = bucket.get_bounds()
+            self.assertLess(b['min_lat'], lat_ur)
+            self.assertGreater(b['max_lat'], lat_ll)
+            if lon_ll <= lon_ur:
+                self.assertLess(b['min_lon'], lon_ur)
+                self.assertGreater(b['max_lon'], lon_ll)
+        return buckets
+
+    def test_bbox(self):
+        self.check_bbox(47.1967, 11.1984, 47.5321, 11.7682)
+
+    def test_grid_aligned(self):
+        buckets = self.check_bbox(47.0, 11.0, 47.25, 11.5)
+        self.assertEqual(len(buckets), 4)
+
+    def test_latitude_bands(self):
+        self.check_bbox(21.8, -1.2, 22.3, -0.4)
+        self.check_bbox(-62.4, 100.3, -61.6, 103.1)
+        self.check_bbox(82.7, -20.0, 83.4, 20.0)
+
+    def test_antimeridian(self):
+        buckets = self.check_bbox(-17.3, 179.6, -16.9, -179.7)
+        lons = {b.lon for b in buckets}
+        self.assertIn(179, lons)
+        self.assertIn(-180, lons)
+
+    def test_point(self):
+        buckets = creator.buckets_in_bbox(47.1, 11.1, 47.1, 11.1)
+        self.assertEqual([b.get_index() for b in buckets],
+                         [creator.Bucket.from_lon_lat(11.1, 47.1).get_index()])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, creator.buckets_in_bbox,
+                          48.0, 11.0, 47.0, 12.0)
+
+
+class ParseBboxTest(unittest.TestCase):
+
+    def test_parse_bbox(self):
+        self.assertEqual(creator.parse_bbox('-33.9,18.4,-33.8,18.6'),
+                         (-33.9, 18.4, -33.8, 18.6))
+        # crossing the antimeridian
+        self.assertEqual(creator.parse_bbox('-17.3,179.6,-16.9,-179.7'),
+                         (-17.3, 179.6, -16.9, -179.7))
+
+    def test_invalid(self):
+        for value in ('47,11,48', '47,11,48,x', '48,11,47,12',
+                      '-95,11,47,12', '47,11,91,12', '47,-181,48,12',
+                      '47,11,48,180.5'):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              creator.parse_bbox, value)
+
+    def test_command_line(self):
+        args = creator.parse_args(['--bbox=-33.9,18.4,-33.8,18.6'])
+        self.assertEqual(args['bbox'], [(-33.9, 18.4, -33.8, 18.6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
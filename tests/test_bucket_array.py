@@ -0,0 +1,82 @@
+import random
+import unittest
+
+import util  # noqa: F401
+import creator
+
+
+def edge_points():
+    """Positions on the edges of the latitude bands and of the tile grid,
+    and just on either side of them"""
+    lats = []
+    for band in creator.TILE_WIDTH_BANDS + (-90.0, 0.0):
+        lats += [band, band - 1e-9, band + 1e-9, band + 0.125, band - 0.125]
+    lats = [lat for lat in lats if -90.0 <= lat < 90.0]
+    points = []
+    for lat in lats:
+        width = creator.get_tile_width(lat)
+        for lon in (-180.0, -180.0 + width, -width, 0.0, width,
+                    180.0 - width, 180.0 - 1e-9, 11.0, -11.0):
+            for d in (0.0, 1e-9, -1e-9):
+                if -180.0 <= lon + d < 180.0:
+                    points.append((lon + d, lat))
+    return points
+
+
+def random_points(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.uniform(-180.0, 180.0), rng.uniform(-90.0, 89.999))
+            for _ in range(n)]
+
+
+class BucketArrayTest(unittest.TestCase):
+    """BucketArray gives the same results as Bucket, element by element"""
+
+    def setUp(self):
+        self.points = random_points(2000) + edge_points()
+        lons, lats = zip(*self.points)
+        self.array = creator.BucketArray.from_lon_lat(lons, lats)
+        self.buckets = [creator.Bucket.from_lon_lat(lon, lat)
+                        for lon, lat in self.points]
+
+    def assertSameBuckets(self, array, buckets):
+        self.assertEqual(len(array), len(buckets))
+        for i, bucket in enumerate(buckets):
+            self.assertEqual(
+                (array.lon[i], array.lat[i], array.x[i], array.y[i]),
+                (bucket.lon, bucket.lat, bucket.x, bucket.y),
+                'bucket of %r' % (self.points[i],))
+
+    def test_from_lon_lat(self):
+        self.assertSameBuckets(self.array, self.buckets)
+
+    def test_get_index(self):
+        self.assertEqual(self.array.get_index().tolist(),
+                         [b.get_index() for b in self.buckets])
+
+    def test_from_index(self):
+        indices = [b.get_index() for b in self.buckets]
+        self.assertSameBuckets(
+            creator.BucketArray.from_index(indices),
+            [creator.Bucket.from_index(index) for index in indices])
+        self.assertSameBuckets(creator.BucketArray.from_index(indices),
+                               self.buckets)
+
+    def test_get_bounds(self):
+        bounds = self.array.get_bounds()
+        for i, bucket in enumerate(self.buckets):
+            for key, value in bucket.get_bounds().items():
+                self.assertEqual(bounds[key][i], value, key)
+
+    def test_get_base_path(self):
+        self.assertEqual(self.array.get_base_path(),
+                         [b.get_base_path() for b in self.buckets])
+
+    def test_getitem(self):
+        self.assertEqual(self.array[3].get_index(),
+                         self.buckets[3].get_index())
+        self.assertSameBuckets(self.array[:10], self.buckets[:10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+import util  # noqa: F401
+import creator
+
+
+def inside_triangle(lon, lat, triangle):
+    """Whether a point is inside a triangle, or on its edges"""
+    signs = []
+    for (x0, y0), (x1, y1) in zip(triangle, triangle[1:] + triangle[:1]):
+        signs.append((x1 - x0) * (lat - y0) - (y1 - y0) * (lon - x0))
+    return all(s >= 0 for s in signs) or all(s <= 0 for s in signs)
+
+
+def corners(bucket):
+    bounds = bucket.get_bounds()
+    return [(lon, lat) for lon in (bounds['min_lon'], bounds['max_lon'])
+            for lat in (bounds['min_lat'], bounds['max_lat'])]
+
+
+def indices(buckets):
+    return sorted(bucket.get_index() for bucket in buckets)
+
+
+class CoverageTest(unittest.TestCase):
+
+    def covered(self, coverage, lat_ll, lon_ll, lat_ur, lon_ur):
+        return [bucket for bucket in creator.buckets_in_bbox(
+            lat_ll, lon_ll, lat_ur, lon_ur) if bucket in coverage]
+
+    def test_rectangle(self):
+        coverage = creator.Coverage([[(10.0, 47.0), (11.0, 47.0),
+                                      (11.0, 48.0), (10.0, 48.0)]])
+        expected = creator.buckets_in_bbox(47.0, 10.0, 48.0, 11.0)
+        self.assertEqual(len(coverage), len(expected))
+        self.assertEqual(indices(self.covered(coverage, 46.5, 9.5, 48.5, 11.5)),
+                         indices(expected))
+
+    def test_partial_buckets_are_not_covered(self):
+        # buckets are 1/4 degree wide there
+        coverage = creator.Coverage([[(10.05, 47.05), (10.95, 47.05),
+                                      (10.95, 47.95), (10.05, 47.95)]])
+        self.assertEqual(indices(self.covered(coverage, 46.5, 9.5, 48.5, 11.5)),
+                         indices(creator.buckets_in_bbox(47.125, 10.25,
+                                                         47.875, 10.75)))
+
+    def test_triangle(self):
+        # the vertex at 47.3 is in the middle of a row of buckets
+        triangle = [(10.0, 47.0), (12.0, 47.3), (10.2, 48.0)]
+        coverage = creator.Coverage([triangle])
+        self.assertGreater(len(coverage), 0)
+        for bucket in creator.buckets_in_bbox(46.5, 9.5, 48.5, 12.5):
+            self.assertEqual(
+                bucket in coverage,
+                all(inside_triangle(lon, lat, triangle)
+                    for lon, lat in corners(bucket)),
+                bucket.get_index())
+
+    def test_hole(self):
+        outer = [(10.0, 47.0), (11.0, 47.0), (11.0, 48.0), (10.0, 48.0)]
+        hole = [(10.25, 47.25), (10.75, 47.25), (10.75, 47.75), (10.25, 47.75)]
+        coverage = creator.Coverage([outer, hole])
+        self.assertNotIn(creator.Bucket.from_lon_lat(10.5, 47.5), coverage)
+        self.assertIn(creator.Bucket.from_lon_lat(10.1, 47.5), coverage)
+        self.assertEqual(len(coverage),
+                         len(creator.buckets_in_bbox(47.0, 10.0, 48.0, 11.0)) -
+                         len(creator.buckets_in_bbox(47.25, 10.25, 47.75, 10.75)))
+
+    def test_provider_coverages(self):
+        inside = {'PNOA': (-3.70, 40.42),                # Madrid
+                  'USGS': (-104.99, 39.74),              # Denver
+                  'GeoportalPL': (21.01, 52.23),         # Warsaw
+                  'geoservices.bayern.de': (11.58, 48.14)}   # Munich
+        outside = (-30.0, 40.0)                          # the Atlantic
+        for name, polygons in creator.COVERAGE.items():
+            coverage = creator.Coverage(polygons)
+            self.assertIn(creator.Bucket.from_lon_lat(*inside[name]),
+                          coverage, name)
+            self.assertNotIn(creator.Bucket.from_lon_lat(*outside),
+                             coverage, name)
+
+
+class AutoProviderTest(unittest.TestCase):
+
+    def test_select(self):
+        regional = creator.ImageProvider('regional', '')
+        world = creator.ImageProvider('world', '')
+        coverage = creator.Coverage([[(10.0, 47.0), (11.0, 47.0),
+                                      (11.0, 48.0), (10.0, 48.0)]])
+        auto = creator.AutoProvider([regional, world],
+                                    {'regional': coverage})
+        self.assertIs(auto.select(creator.Bucket.from_lon_lat(10.5, 47.5)),
+                      regional)
+        self.assertIs(auto.select(creator.Bucket.from_lon_lat(12.5, 47.5)),
+                      world)
+        auto = creator.AutoProvider([regional], {'regional': coverage})
+        self.assertIsNone(auto.select(creator.Bucket.from_lon_lat(12.5, 47.5)))
+        with self.assertRaises(ValueError):
+            auto.download(creator.Bucket.from_lon_lat(12.5, 47.5), 'out.png',
+                          'cache')
+        auto.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
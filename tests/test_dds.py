@@ -0,0 +1,75 @@
+import io
+import struct
+import unittest
+
+import numpy
+from PIL import Image
+
+from util import make_image
+import creator
+
+
+class WriteDdsTest(unittest.TestCase):
+
+    def write(self, im, compression='bc1', mipmaps=True):
+        fout = io.BytesIO()
+        creator.write_dds(fout, im, compression, mipmaps)
+        return fout.getvalue()
+
+    def decode(self, data):
+        with Image.open(io.BytesIO(data)) as result:
+            self.assertEqual(result.format, 'DDS')
+            return numpy.asarray(result.convert('RGBA'), dtype=numpy.int32)
+
+    def test_header_and_size(self):
+        for compression, block_size in (('bc1', 8), ('bc3', 16)):
+            data = self.write(make_image(64, 32), compression)
+            self.assertEqual(data[:4], b'DDS ')
+            height, width, linear_size, depth, mipmaps = struct.unpack(
+                '<5I', data[12:32])
+            self.assertEqual((width, height, mipmaps), (64, 32, 7))
+            self.assertEqual(linear_size, 16 * 8 * block_size)
+            self.assertEqual(data[84:88],
+                             creator.DDS_FORMATS[compression][0])
+            # 64x32, 32x16, ... 1x1, each rounded up to whole blocks
+            blocks = sum(((w + 3) // 4) * ((h + 3) // 4) for w, h in
+                         ((64, 32), (32, 16), (16, 8), (8, 4), (4, 2),
+                          (2, 1), (1, 1)))
+            self.assertEqual(len(data), 128 + blocks * block_size)
+
+    def test_no_mipmaps(self):
+        data = self.write(make_image(16, 8), mipmaps=False)
+        self.assertEqual(struct.unpack('<I', data[28:32])[0], 1)
+        self.assertEqual(len(data), 128 + 4 * 2 * 8)
+
+    def test_solid_color(self):
+        im = Image.new('RGB', (32, 16), (200, 120, 40))
+        for compression in ('bc1', 'bc3'):
+            pixels = self.decode(self.write(im, compression))
+            self.assertEqual(pixels.shape, (16, 32, 4))
+            # RGB565 rounding
+            self.assertLessEqual(
+                numpy.abs(pixels[:, :, :3] - (200, 120, 40)).max(), 4)
+            self.assertTrue((pixels[:, :, 3] == 255).all())
+
+    def test_gradient(self):
+        im = Image.linear_gradient('L').resize((64, 64)).convert('RGB')
+        pixels = self.decode(self.write(im))
+        expected = numpy.asarray(im, dtype=numpy.int32)
+        self.assertLess(numpy.abs(pixels[:, :, :3] - expected).mean(), 4.0)
+
+    def test_odd_size(self):
+        im = make_image(30, 10)
+        pixels = self.decode(self.write(im, mipmaps=False))
+        self.assertEqual(pixels.shape, (10, 30, 4))
+
+    def test_alpha(self):
+        im = make_image(16, 16).convert('RGBA')
+        alpha = numpy.tile(numpy.arange(16, dtype=numpy.uint8) * 17, (16, 1))
+        im.putalpha(Image.fromarray(alpha, 'L'))
+        pixels = self.decode(self.write(im, 'bc3'))
+        self.assertLessEqual(numpy.abs(pixels[:, :, 3] - alpha).max(), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from util import get_stub_url, start_stub_server
+import creator
+
+
+class MosaicTest(unittest.TestCase):
+
+    TNUM = (2, 2)
+    THEIGHT = 64
+
+    def setUp(self):
+        self.server = start_stub_server(self)
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        # two neighbour buckets: 4 x 2 tiles
+        self.buckets = creator.buckets_in_bbox(47.0, 11.0, 47.1, 11.4)
+        self.assertEqual(len(self.buckets), 2)
+
+    def get_provider(self, max_size=4096, tile_format='png'):
+        provider = creator.ImageProvider(
+            'ArcGIS', get_stub_url(self.server), max_size=max_size,
+            formats=creator.PROVIDER_OPTIONS['ArcGIS']['formats'],
+            tile_format=tile_format)
+        self.addCleanup(provider.close)
+        return provider
+
+    def fetch(self, provider):
+        """Fetch the tiles of the buckets, and return {tbounds: path}"""
+        tiles = {}
+        for bucket in self.buckets:
+            tsize, tbounds_list = creator.get_tiles(bucket, self.TNUM,
+                                                    self.THEIGHT)
+            ftiles = provider.fetch_tiles(bucket, self.cache_dir, self.TNUM,
+                                          self.THEIGHT)
+            tiles.update(zip(tbounds_list, ftiles))
+        return tsize, tiles
+
+    def check_tiles(self, tsize, tiles, mosaics, fmt):
+        """Check that every tile is the right crop of the stub image of the
+        mosaic it belongs to"""
+        for mosaic_bounds, mosaic_size in mosaics:
+            data = self.server.get_image(mosaic_size[0], mosaic_size[1], fmt)
+            with Image.open(io.BytesIO(data)) as im:
+                im.load()
+            # pixels per degree
+            sx = mosaic_size[0] / (mosaic_bounds[2] - mosaic_bounds[0])
+            sy = mosaic_size[1] / (mosaic_bounds[3] - mosaic_bounds[1])
+            for tbounds, path in tiles.items():
+                if not (mosaic_bounds[0] <= tbounds[0] < mosaic_bounds[2] and
+                        mosaic_bounds[1] <= tbounds[1] < mosaic_bounds[3]):
+                    continue
+                left = round((tbounds[0] - mosaic_bounds[0]) * sx)
+                upper = round((mosaic_bounds[3] - tbounds[3]) * sy)
+                with Image.open(path) as tile:
+                    # lossless, whatever the format of the mosaic
+                    self.assertEqual(tile.format, 'PNG')
+                    self.assertEqual(tile.size, tsize)
+                    self.assertEqual(
+                        tile.convert('RGB').tobytes(),
+                        im.crop((left, upper, left + tsize[0],
+                                 upper + tsize[1])).convert('RGB').tobytes(),
+                        path)
+
+    def test_single_request(self):
+        provider = self.get_provider()
+        self.assertEqual(provider.plan_mosaics(self.buckets, self.TNUM,
+                                               self.THEIGHT), 1)
+        tsize, tiles = self.fetch(provider)
+        self.assertEqual(self.server.stats['requests'], 1)
+        self.assertEqual(len(tiles), 8)
+        self.check_tiles(tsize, tiles,
+                         [((11.0, 47.0, 11.5, 47.125),
+                           (4 * tsize[0], 2 * tsize[1]))], 'PNG')
+
+    def test_jpeg_tiles_are_not_compressed_again(self):
+        provider = self.get_provider(tile_format='jpeg')
+        provider.plan_mosaics(self.buckets, self.TNUM, self.THEIGHT)
+        tsize, tiles = self.fetch(provider)
+        self.assertTrue(all(path.endswith('.jpg') for path in tiles.values()))
+        self.check_tiles(tsize, tiles,
+                         [((11.0, 47.0, 11.5, 47.125),
+                           (4 * tsize[0], 2 * tsize[1]))], 'JPEG')
+
+    def test_blocks(self):
+        # 128x64 pixel tiles, in blocks of 2 x 4 tiles aligned on the grid
+        provider = self.get_provider(max_size=256)
+        self.assertEqual(provider.plan_mosaics(self.buckets, self.TNUM,
+                                               self.THEIGHT), 2)
+        tsize, tiles = self.fetch(provider)
+        self.assertEqual(self.server.stats['requests'], 2)
+        self.check_tiles(tsize, tiles,
+                         [((11.0, 47.0, 11.25, 47.125), (256, 128)),
+                          ((11.25, 47.0, 11.5, 47.125), (256, 128))], 'PNG')
+
+    def test_too_small_for_mosaics(self):
+        provider = self.get_provider(max_size=100)
+        self.assertEqual(provider.plan_mosaics(self.buckets, self.TNUM,
+                                               self.THEIGHT), 0)
+        self.fetch(provider)
+        self.assertEqual(self.server.stats['requests'], 8)
+
+    def test_without_plan(self):
+        tsize, tiles = self.fetch(self.get_provider())
+        self.assertEqual(self.server.stats['requests'], 8)
+        for path in tiles.values():
+            self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
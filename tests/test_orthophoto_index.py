@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import util  # noqa: F401
+import creator
+
+
+SETTINGS = {'provider': 'ArcGIS', 'theight': 256, 'cols': 2,
+            'tile_format': 'png'}
+
+
+class OrthophotoIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scenery = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.scenery)
+        self.root = os.path.join(self.scenery, 'Orthophotos')
+        os.makedirs(self.root)
+        self.bucket = creator.Bucket.from_lon_lat(11.1, 47.1)
+
+    def write_orthophoto(self, bucket, fmt='png'):
+        path = creator.get_format_path(
+            creator.get_output_path(self.scenery, bucket), fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb'):
+            pass
+
+    def test_exists(self):
+        self.write_orthophoto(self.bucket)
+        other = creator.Bucket.from_lon_lat(11.4, 47.1)
+        index = creator.OrthophotoIndex(self.root)
+        self.assertTrue(index.exists(self.bucket))
+        self.assertFalse(index.exists(self.bucket, ('png', 'dds')))
+        self.assertFalse(index.exists(other))
+
+    def test_scans_each_directory_once(self):
+        self.write_orthophoto(self.bucket)
+        index = creator.OrthophotoIndex(self.root)
+        with mock.patch.object(creator.os, 'scandir',
+                               wraps=creator.os.scandir) as scandir:
+            for lon in (11.1, 11.4, 11.6, 11.9):
+                index.exists(creator.Bucket.from_lon_lat(lon, 47.1))
+        self.assertEqual(scandir.call_count, 1)
+
+    def test_record(self):
+        index = creator.OrthophotoIndex(self.root)
+        index.record(self.bucket, ('png', 'dds'), **SETTINGS)
+        self.assertTrue(index.exists(self.bucket, ('png', 'dds')))
+        # the manifest is read back by the next run
+        index = creator.OrthophotoIndex(self.root)
+        entry = index.entries[self.bucket.get_index()]
+        self.assertEqual(entry['formats'], ['png', 'dds'])
+        self.assertEqual(entry['cols'], 2)
+
+    def test_uniform_skipped(self):
+        index = creator.OrthophotoIndex(self.root)
+        index.record(self.bucket, (), uniform=[0, 0, 80], **SETTINGS)
+        index = creator.OrthophotoIndex(self.root)
+        self.assertTrue(index.exists(self.bucket))
+
+    def test_is_stale(self):
+        index = creator.OrthophotoIndex(self.root)
+        other = creator.Bucket.from_lon_lat(11.4, 47.1)
+        self.assertFalse(index.is_stale(self.bucket, SETTINGS))
+        index.record(self.bucket, **SETTINGS)
+        self.assertFalse(index.is_stale(self.bucket, SETTINGS))
+        self.assertTrue(index.is_stale(self.bucket, dict(SETTINGS, cols=4)))
+        self.assertTrue(index.is_stale(self.bucket,
+                                       dict(SETTINGS, provider='USGS')))
+        self.assertFalse(index.is_stale(other, dict(SETTINGS, cols=4)))
+        entry = index.entries[self.bucket.get_index()]
+        with mock.patch.object(creator.time, 'time',
+                               return_value=entry['time'] + 100):
+            self.assertFalse(index.is_stale(self.bucket, SETTINGS, 1000))
+            self.assertTrue(index.is_stale(self.bucket, SETTINGS, 10))
+
+    def test_manifest_defaults(self):
+        # entries written before --tile_format existed
+        with open(os.path.join(self.root, creator.MANIFEST_NAME), 'w') as f:
+            f.write(json.dumps({
+                'index': self.bucket.get_index(), 'formats': ['png'],
+                'time': 0, 'provider': 'ArcGIS', 'theight': 256,
+                'cols': 2}) + '\n')
+        index = creator.OrthophotoIndex(self.root)
+        self.assertFalse(index.is_stale(self.bucket, SETTINGS))
+        self.assertTrue(index.is_stale(self.bucket,
+                                       dict(SETTINGS, tile_format='jpeg')))
+
+    def test_invalid_lines(self):
+        index = creator.OrthophotoIndex(self.root)
+        index.record(self.bucket, **SETTINGS)
+        with open(index.manifest_path, 'a') as f:
+            f.write('{"index": 12, "formats"')
+        with self.assertLogs(level='WARNING'):
+            index = creator.OrthophotoIndex(self.root)
+        self.assertEqual(list(index.entries), [self.bucket.get_index()])
+
+    def test_compact(self):
+        index = creator.OrthophotoIndex(self.root)
+        for cols in range(1, 1202):
+            index.record(self.bucket, **dict(SETTINGS, cols=cols))
+        index = creator.OrthophotoIndex(self.root)
+        with open(index.manifest_path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['cols'], 1201)
+
+
+if __name__ == '__main__':
+    unittest.main()
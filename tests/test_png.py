@@ -0,0 +1,39 @@
+import io
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from util import make_image
+import creator
+
+
+class WritePngTest(unittest.TestCase):
+
+    def check_png(self, width, height, band_rows, compress_level=6):
+        im = make_image(width, height)
+        data = im.tobytes()
+        stride = width * 3
+        bands = [data[start * stride:(start + band_rows) * stride]
+                 for start in range(0, height, band_rows)]
+        fout = io.BytesIO()
+        creator.write_png(fout, width, height, bands, compress_level)
+        fout.seek(0)
+        with Image.open(fout) as result:
+            self.assertEqual(result.format, 'PNG')
+            self.assertEqual(result.mode, 'RGB')
+            self.assertEqual(result.size, (width, height))
+            self.assertEqual(result.tobytes(), data)
+
+    def test_write_png(self):
+        self.check_png(64, 48, 48)
+        self.check_png(37, 150, 7)
+        self.check_png(200, 130, 100, compress_level=1)
+
+    def test_write_png_without_numpy(self):
+        with mock.patch.object(creator, 'numpy', None):
+            self.check_png(37, 150, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
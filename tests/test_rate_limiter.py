@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+import util  # noqa: F401
+import creator
+
+
+class FakeClock:
+    """Stands for time.monotonic() and time.sleep()"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+        self.slept += delay
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        for name in ('monotonic', 'sleep'):
+            patcher = mock.patch.object(creator.time, name,
+                                        getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_acquire_rate(self):
+        limiter = creator.RateLimiter(4.0)
+        for _ in range(9):
+            limiter.acquire()
+        # one token to start with, then one every 1/4 s
+        self.assertAlmostEqual(self.clock.slept, 2.0)
+
+    def test_burst_cuts_once(self):
+        limiter = creator.RateLimiter(8.0)
+        for _ in range(8):
+            limiter.slow_down()
+        self.assertEqual(limiter.rate, 4.0)
+
+    def test_cut_again_after_window(self):
+        limiter = creator.RateLimiter(8.0)
+        limiter.slow_down()
+        self.clock.now += 0.2           # less than 1 / 4 s
+        limiter.slow_down()
+        self.assertEqual(limiter.rate, 4.0)
+        self.clock.now += 0.1
+        limiter.slow_down()
+        self.assertEqual(limiter.rate, 2.0)
+
+    def test_min_rate(self):
+        limiter = creator.RateLimiter(1.0, min_rate=0.5)
+        for _ in range(5):
+            limiter.slow_down()
+            self.clock.now += 10.0
+        self.assertEqual(limiter.rate, 0.5)
+
+    def test_speed_up(self):
+        limiter = creator.RateLimiter(2.0, max_rate=4.0)
+        limiter.slow_down()
+        self.assertEqual(limiter.rate, 1.0)
+        limiter.speed_up()
+        self.assertAlmostEqual(limiter.rate, 1.1)
+        for _ in range(100):
+            limiter.speed_up()
+        self.assertEqual(limiter.rate, 4.0)
+
+    def test_retry_after(self):
+        limiter = creator.RateLimiter(100.0)
+        limiter.acquire()
+        limiter.slow_down(retry_after=5.0)
+        # even within the congestion window, Retry-After pauses requests
+        limiter.slow_down(retry_after=7.0)
+        self.assertEqual(limiter.rate, 50.0)
+        limiter.acquire()
+        self.assertGreaterEqual(self.clock.slept, 7.0)
+
+
+class ParseRetryAfterTest(unittest.TestCase):
+
+    def test_parse_retry_after(self):
+        self.assertIsNone(creator.parse_retry_after(None))
+        self.assertEqual(creator.parse_retry_after('12'), 12.0)
+        self.assertEqual(creator.parse_retry_after('-3'), 0.0)
+        self.assertEqual(creator.parse_retry_after(
+            'Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertIsNone(creator.parse_retry_after('soon'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from util import get_stub_url, start_stub_server
+import creator
+
+
+class RefreshTest(unittest.TestCase):
+    """--refresh, against the stub server of benchmark.py"""
+
+    def setUp(self):
+        self.server = start_stub_server(self)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.dict(creator.URLS,
+                                  {'ArcGIS': get_stub_url(self.server)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bucket = creator.Bucket.from_lon_lat(11.1, 47.06)
+        self.outpath = creator.get_output_path(
+            os.path.join(self.tmp, 'scenery'), self.bucket)
+        self.root = creator.get_orthophoto_root(self.outpath)
+
+    def run_region(self, *argv):
+        """Download the bucket, and return the requests it took"""
+        args = creator.parse_args([
+            '--scenery_folder', os.path.join(self.tmp, 'scenery'),
+            '--cache_dir', os.path.join(self.tmp, 'cache'),
+            '--cols', '2', '--theight', '64', '--jobs', '1'] + list(argv))
+        provider = creator.get_provider(args)
+        self.addCleanup(provider.close)
+        before = dict(self.server.stats)
+        failed = creator.download_region(provider, [self.bucket], args)
+        self.assertEqual(failed, [])
+        # nothing is left behind for the next buckets
+        self.assertEqual(provider._validators, {})
+        return {k: v - before[k] for k, v in self.server.stats.items()}
+
+    def read_lines(self, name):
+        with open(os.path.join(self.root, name)) as f:
+            return [json.loads(line) for line in f]
+
+    def read_tiles(self):
+        """The pixels of the tiles of the orthophoto, in the order of
+        get_tiles()"""
+        with Image.open(self.outpath) as im:
+            im.load()
+        w, h = im.size[0] // 2, im.size[1] // 2
+        return [im.crop((c * w, (1 - r) * h, (c + 1) * w, (2 - r) * h))
+                .tobytes() for r in range(2) for c in range(2)]
+
+    def test_unchanged(self):
+        self.assertEqual(self.run_region('--refresh')['requests'], 4)
+        stats = self.run_region('--refresh')
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['not_modified'], 4)
+        self.assertEqual(len(self.read_lines(creator.MANIFEST_NAME)), 1)
+        self.assertEqual(len(self.read_lines(creator.VALIDATORS_NAME)), 1)
+        self.assertFalse(os.listdir(os.path.join(self.tmp, 'cache',
+                                                 'ArcGIS')))
+
+    def test_new_validators_are_saved(self):
+        self.run_region('--refresh')
+        # as if the server changed the ETags, but not the images
+        entry = self.read_lines(creator.VALIDATORS_NAME)[-1]
+        expected = entry['tiles']
+        entry['tiles'] = [['"old"'] + tile[1:] for tile in expected]
+        with open(os.path.join(self.root, creator.VALIDATORS_NAME), 'w') as f:
+            f.write(json.dumps(entry) + '\n')
+        stats = self.run_region('--refresh')
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['not_modified'], 0)
+        # the orthophoto is not made again, but its validators are updated
+        self.assertEqual(len(self.read_lines(creator.MANIFEST_NAME)), 1)
+        self.assertEqual(self.read_lines(creator.VALIDATORS_NAME)[-1]['tiles'],
+                         expected)
+        self.assertEqual(self.run_region('--refresh')['not_modified'], 4)
+
+    def test_changed_tile(self):
+        self.run_region('--refresh')
+        old_tiles = self.read_tiles()
+        # the first tile requested changes
+        get_image = self.server.get_image
+        lock = threading.Lock()
+        calls = []
+
+        def changed_image(width, height, fmt):
+            with lock:
+                calls.append((width, height))
+                if len(calls) > 1:
+                    return get_image(width, height, fmt)
+            bio = io.BytesIO()
+            Image.new('RGB', (width, height), (255, 0, 0)).save(bio, fmt)
+            return bio.getvalue()
+
+        with mock.patch.object(self.server, 'get_image', changed_image):
+            stats = self.run_region('--refresh')
+        # the changed tile is not downloaded again, and the others are cut
+        # from the orthophoto
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['not_modified'], 3)
+        self.assertEqual(len(self.read_lines(creator.MANIFEST_NAME)), 2)
+        new_tiles = self.read_tiles()
+        red = Image.new('RGB', (len(new_tiles[0]) // 3 // 64, 64),
+                        (255, 0, 0)).tobytes()
+        self.assertEqual(sorted(new == old for new, old in
+                                zip(new_tiles, old_tiles)),
+                         [False, True, True, True])
+        self.assertIn(red, new_tiles)
+        # the new validators of the changed tile are recorded
+        entries = self.read_lines(creator.VALIDATORS_NAME)
+        self.assertEqual(sorted(new == old for new, old in
+                                zip(entries[-1]['tiles'], entries[0]['tiles'])),
+                         [False, True, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
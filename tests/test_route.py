@@ -0,0 +1,107 @@
+import math
+import unittest
+
+import util  # noqa: F401
+import creator
+
+
+def point_rect_distance(lat, lon, bounds):
+    """Distance from a point to the bounds of a bucket, in km"""
+    kx = creator._get_scale(lat)
+    dlon = max(bounds['min_lon'] - lon, 0, lon - bounds['max_lon'])
+    dlat = max(bounds['min_lat'] - lat, 0, lat - bounds['max_lat'])
+    return math.hypot(dlon * kx, dlat * creator.KM_PER_DEGREE)
+
+
+def sample_route(route, step=0.005):
+    """Points along a route, at most step degrees apart"""
+    points = [route[0]]
+    for (alat, alon), (blat, blon) in zip(route[:-1], route[1:]):
+        n = max(1, math.ceil(max(abs(blat - alat), abs(blon - alon)) / step))
+        points += [(alat + (blat - alat) * i / n, alon + (blon - alon) * i / n)
+                   for i in range(1, n + 1)]
+    return points
+
+
+class PlanRouteTest(unittest.TestCase):
+
+    def check_corridor(self, route, distance):
+        buckets = creator.plan_route(route, distance)
+        indices = [b.get_index() for b in buckets]
+        self.assertEqual(len(indices), len(set(indices)), 'duplicate buckets')
+        points = sample_route(route)
+        lats = [p[0] for p in points]
+        lons = [p[1] for p in points]
+        margin = distance / creator.KM_PER_DEGREE / math.cos(
+            math.radians(max(abs(min(lats)), abs(max(lats))) + 1)) + 0.5
+        candidates = creator.buckets_in_bbox(
+            min(lats) - margin, min(lons) - margin,
+            max(lats) + margin, max(lons) + margin)
+        # flat distances are accurate to a small fraction of the distance
+        slack = 0.02 * distance + 0.1
+        for bucket in candidates:
+            bounds = bucket.get_bounds()
+            d = min(point_rect_distance(lat, lon, bounds)
+                    for lat, lon in points)
+            if d < distance - slack:
+                self.assertIn(bucket.get_index(), indices)
+            elif d > distance + slack:
+                self.assertNotIn(bucket.get_index(), indices)
+        return buckets
+
+    def test_corridor(self):
+        route = [(47.26, 11.35), (47.5, 11.9), (47.8, 12.0)]
+        indices = [b.get_index() for b in self.check_corridor(route, 10.0)]
+        # sorted along the route
+        positions = [indices.index(creator.Bucket.from_lon_lat(lon, lat)
+                                   .get_index())
+                     for lat, lon in sample_route(route, 0.1)]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_narrow_corridor(self):
+        self.check_corridor([(40.1, -3.9), (40.6, -3.1)], 1.0)
+
+    def test_single_point(self):
+        buckets = self.check_corridor([(47.26, 11.35)], 5.0)
+        self.assertEqual(buckets[0].get_index(),
+                         creator.Bucket.from_lon_lat(11.35, 47.26).get_index())
+
+    def test_antimeridian(self):
+        buckets = creator.plan_route([(-17.8, 179.8), (-17.7, -179.8)], 3.0)
+        lons = [b.lon for b in buckets]
+        self.assertIn(179, lons)
+        self.assertIn(-180, lons)
+        # the short way: nothing near the prime meridian
+        self.assertTrue(all(abs(lon) > 170 for lon in lons))
+        self.assertEqual(buckets[0].lon, 179)
+        self.assertEqual(buckets[-1].lon, -180)
+
+    def test_airports(self):
+        route = [(47.0, 11.0), (48.0, 11.0)]
+        airport = (47.5, 11.8)
+        buckets = creator.plan_route(route, 2.0, [airport], 5.0)
+        indices = [b.get_index() for b in buckets]
+        airport_index = creator.Bucket.from_lon_lat(11.8, 47.5).get_index()
+        self.assertIn(airport_index, indices)
+        # the airport comes at its position along the route
+        self.assertLess(indices.index(
+            creator.Bucket.from_lon_lat(11.0, 47.2).get_index()),
+            indices.index(airport_index))
+        self.assertGreater(indices.index(
+            creator.Bucket.from_lon_lat(11.0, 47.8).get_index()),
+            indices.index(airport_index))
+
+    def test_airports_without_route(self):
+        airports = [(40.03, -3.47), (47.5, 11.8)]
+        buckets = creator.plan_route([], 0.0, airports, 3.0)
+        # airports in order, each from its own bucket outwards
+        self.assertEqual(buckets[0].get_index(),
+                         creator.Bucket.from_lon_lat(-3.47, 40.03).get_index())
+        lons = [b.lon for b in buckets]
+        self.assertEqual(lons, sorted(lons))
+        self.assertIn(creator.Bucket.from_lon_lat(11.8, 47.5).get_index(),
+                      [b.get_index() for b in buckets])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import util  # noqa: F401
+import creator
+
+
+class TileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        os.makedirs(os.path.join(self.cache_dir, 'p'))
+        self.time = 1000.0
+        patcher = mock.patch.object(creator.time, 'time', lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store(self, cache, name, size=100, provider='p'):
+        """Put a tile in cache, as ImageProvider does"""
+        with open(os.path.join(self.cache_dir, provider, name), 'wb') as f:
+            f.write(b'x' * size)
+        cache.add(provider, name, size)
+        cache.release(provider, [name])
+        self.time += 1
+
+    def on_disk(self):
+        return sorted(os.listdir(os.path.join(self.cache_dir, 'p')))
+
+    def test_lookup(self):
+        cache = creator.TileCache(self.cache_dir)
+        self.assertFalse(cache.lookup('p', 'tile-a.png'))
+        self.store(cache, 'tile-a.png')
+        self.assertTrue(cache.lookup('p', 'tile-a.png'))
+        self.assertFalse(cache.lookup('q', 'tile-a.png'))
+        cache.close()
+        # and across runs
+        cache = creator.TileCache(self.cache_dir)
+        self.assertTrue(cache.lookup('p', 'tile-a.png'))
+        self.assertEqual(cache.stats(), {'p': (1, 100)})
+        cache.close()
+
+    def test_evict_lru(self):
+        cache = creator.TileCache(self.cache_dir, max_bytes=250)
+        self.store(cache, 'tile-a.png')
+        self.store(cache, 'tile-b.png')
+        # a is used again, so b is the least recently used
+        self.assertTrue(cache.lookup('p', 'tile-a.png'))
+        cache.release('p', ['tile-a.png'])
+        self.time += 1
+        self.store(cache, 'tile-c.png')
+        self.assertEqual(self.on_disk(), ['tile-a.png', 'tile-c.png'])
+        self.assertFalse(cache.lookup('p', 'tile-b.png'))
+        self.assertEqual(cache.stats(), {'p': (2, 200)})
+        cache.close()
+
+    def test_pinned_tiles_are_not_evicted(self):
+        cache = creator.TileCache(self.cache_dir, max_bytes=150)
+        self.store(cache, 'tile-a.png')
+        self.assertTrue(cache.lookup('p', 'tile-a.png'))
+        self.store(cache, 'tile-b.png')
+        # a is in use: b goes, even though it is the most recent
+        self.assertEqual(self.on_disk(), ['tile-a.png'])
+        cache.release('p', ['tile-a.png'])
+        cache.close()
+
+    def test_forget(self):
+        cache = creator.TileCache(self.cache_dir)
+        self.store(cache, 'tile-a.png')
+        self.store(cache, 'tile-b.png')
+        cache.forget('p', ['tile-a.png'])
+        self.assertFalse(cache.lookup('p', 'tile-a.png'))
+        self.assertTrue(cache.lookup('p', 'tile-b.png'))
+        cache.forget('ALL')
+        self.assertEqual(cache.stats(), {})
+        cache.close()
+
+    def test_index_checked_against_disk(self):
+        cache = creator.TileCache(self.cache_dir)
+        self.store(cache, 'tile-a.png')
+        self.store(cache, 'tile-b.png')
+        cache.close()
+        os.remove(os.path.join(self.cache_dir, 'p', 'tile-a.png'))
+        with open(os.path.join(self.cache_dir, 'p', 'tile-c.png'), 'wb') as f:
+            f.write(b'x' * 50)
+        with open(os.path.join(self.cache_dir, 'p', 'tmptile-d.png.1'), 'wb'):
+            pass
+        cache = creator.TileCache(self.cache_dir)
+        self.assertFalse(cache.lookup('p', 'tile-a.png'))
+        self.assertTrue(cache.lookup('p', 'tile-b.png'))
+        self.assertTrue(cache.lookup('p', 'tile-c.png'))
+        self.assertEqual(cache.stats(), {'p': (2, 150)})
+        cache.close()
+
+    def test_non_persistent(self):
+        cache = creator.TileCache(self.cache_dir)
+        self.store(cache, 'tile-a.png')
+        cache.close()
+        cache = creator.TileCache(self.cache_dir, persistent=False)
+        provider = creator.ImageProvider('p', '', cache=cache)
+        self.assertTrue(cache.lookup('p', 'tile-a.png'))
+        provider.release_tiles([os.path.join(self.cache_dir, 'p',
+                                             'tile-a.png')])
+        self.assertEqual(self.on_disk(), [])
+        self.assertEqual(cache.stats(), {})
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from util import make_image
+import creator
+
+
+class UniformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def save_tiles(self, images, ext='png'):
+        paths = []
+        for i, im in enumerate(images):
+            path = os.path.join(self.tmp, 'tile-%d.%s' % (i, ext))
+            im.save(path)
+            paths.append(path)
+        return paths
+
+    def blank(self, color=(0, 0, 0, 0), mode='RGBA'):
+        return Image.new(mode, (128, 128), color)
+
+    def test_uniform(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB'),
+                                  self.blank((11, 61, 121), 'RGB')])
+        self.assertEqual(creator.get_uniform_color(ftiles), (10, 60, 120))
+
+    def test_jpeg(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB')] * 2,
+                                 'jpg')
+        color = creator.get_uniform_color(ftiles)
+        self.assertIsNotNone(color)
+        self.assertTrue(all(abs(a - b) <= 2
+                            for a, b in zip(color, (10, 60, 120))))
+
+    def test_not_uniform(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB'),
+                                  make_image(128, 128)])
+        self.assertIsNone(creator.get_uniform_color(ftiles))
+        # each tile is uniform, but not of the same colour
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB'),
+                                  self.blank((10, 60, 140), 'RGB')])
+        self.assertIsNone(creator.get_uniform_color(ftiles))
+        self.assertEqual(creator.get_uniform_color(ftiles, threshold=25),
+                         (10, 60, 130))
+
+    def test_transparent_tiles_match_any_colour(self):
+        ftiles = self.save_tiles([self.blank(),
+                                  self.blank((10, 60, 120, 255))])
+        self.assertEqual(creator.get_uniform_color(ftiles), (10, 60, 120))
+
+    def test_no_data(self):
+        ftiles = self.save_tiles([self.blank(), self.blank()])
+        self.assertEqual(creator.get_uniform_color(ftiles), creator.NO_DATA)
+        self.assertTrue(creator.has_no_data(ftiles))
+        ftiles = self.save_tiles([self.blank(), make_image(128, 128)])
+        self.assertFalse(creator.has_no_data(ftiles))
+
+    def build(self, ftiles, uniform):
+        outpath = os.path.join(self.tmp, 'out', 'ortho.png')
+        level = os.path.join(self.tmp, 'level', 'ortho.png')
+        for path in (outpath, level):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        written, color = creator.build_orthophoto(
+            ftiles, outpath, uniform=uniform, tnum=(1, 2),
+            formats=('png',), levels=[(2, level)])
+        creator.commit_orthophoto(written)
+        return [final for tmp, final in written], color
+
+    def test_tiny(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB')] * 2)
+        written, color = self.build(ftiles, 'tiny')
+        self.assertEqual(color, (10, 60, 120))
+        self.assertEqual(len(written), 2)
+        for path in written:
+            with Image.open(path) as im:
+                self.assertEqual(im.size,
+                                 (creator.UNIFORM_SIZE, creator.UNIFORM_SIZE))
+                self.assertEqual(im.getpixel((0, 0)), (10, 60, 120))
+
+    def test_skip(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB')] * 2)
+        self.assertEqual(self.build(ftiles, 'skip'), ([], (10, 60, 120)))
+
+    def test_full(self):
+        ftiles = self.save_tiles([self.blank((10, 60, 120), 'RGB')] * 2)
+        written, color = self.build(ftiles, 'full')
+        self.assertIsNone(color)
+        with Image.open(written[0]) as im:
+            self.assertEqual(im.size, (128, 256))
+
+    def test_no_data_is_never_written(self):
+        ftiles = self.save_tiles([self.blank(), self.blank()])
+        for uniform in creator.UNIFORM_POLICIES:
+            self.assertEqual(self.build(ftiles, uniform),
+                             ([], creator.NO_DATA), uniform)
+        self.assertFalse(os.listdir(os.path.join(self.tmp, 'out')))
+
+    def test_no_data_is_recorded(self):
+        scenery = os.path.join(self.tmp, 'scenery')
+        bucket = creator.Bucket.from_lon_lat(11.1, 47.1)
+        outpath = creator.get_output_path(scenery, bucket)
+        os.makedirs(os.path.dirname(outpath))
+        args = {'format': 'png', 'uniform': 'tiny', 'provider': 'ArcGIS',
+                'theight': 256, 'cols': 2, 'tile_format': 'png',
+                'refresh': False}
+        indexes = {}
+        creator.record_orthophotos(indexes, args, bucket, outpath, (),
+                                   color=creator.NO_DATA)
+        index = creator.OrthophotoIndex(creator.get_orthophoto_root(outpath))
+        self.assertTrue(index.exists(bucket))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""Helpers shared by the tests"""
+
+import os
+import sys
+import threading
+import urllib.parse
+
+import numpy
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_image(width, height, seed=0):
+    """A reproducible RGB test image, with noise and smooth gradients"""
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:height, 0:width]
+    pixels = numpy.stack([
+        rng.integers(0, 256, (height, width)),
+        255 * x // max(1, width - 1),
+        255 * y // max(1, height - 1)], axis=-1).astype(numpy.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def start_stub_server(test, **options):
+    """Run the stub server of benchmark.py for the duration of a test.
+    options are those of benchmark.StubServer"""
+    import benchmark
+    server = benchmark.StubServer(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+def get_stub_url(server, provider='ArcGIS'):
+    """The URL of a provider, pointed to a stub server"""
+    import creator
+    parts = urllib.parse.urlsplit(creator.URLS[provider])
+    return urllib.parse.urlunsplit(
+        ('http', '127.0.0.1:%d' % server.server_address[1], parts.path,
+         parts.query, ''))